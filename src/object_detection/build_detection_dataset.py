@@ -2,155 +2,442 @@ import math
 import os
 import glob
 import cv2
-import threading
 import numpy as np
+import functools
+import json
 import random
+import time
 import xml.etree.ElementTree as ep
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import detection_config as config
-from shapely.geometry import Polygon
 from utils.DatasetStats import DatasetStats
+from utils.background_cache import BackgroundCache
+from utils.dataset_writer import DatasetWriter
+from utils.generation_manifest import GenerationManifest
+from utils.index_leases import LeaseManager
+from utils.instance_masks import encode_instances, rle_area
+from utils.hdf5_dataset_writer import Hdf5ShardWriter, merge_hdf5_shards, read_hdf5_image_ids
+from utils.occupancy_grid import OccupancyGrid
+from utils.scene_recipes import SceneRecipes, merge_recipe_shards, read_recipe_indices
+from utils.sprite_bank import SpriteBank
+from utils.stage_profiler import StageProfiler, format_profile_summary, save_profile
 
-stats = DatasetStats()
 
+writer_instance = None
+background_cache_instance = None
+profiler_instance = None
 
-def build_dataset(image_save_path, mask_save_path, annotation_save_path, thread_id, total_threads, limit, mutex, offset=0, is_binary_mask=True, simple_annotation_format=True, is_save_mask=True):
-    global stats
+
+def build_dataset(image_save_path, mask_save_path, annotation_save_path, indices, seed=None, is_binary_mask=True, simple_annotation_format=True, is_save_mask=True, hdf5_shard_path=None, manifest=None,
+                  instance_save_path=None, extra_shapes=(), recipe_shard_path=None):
     local_stats = DatasetStats()
-    bkg_image_paths = [config.background_folder + x for x in os.listdir(config.background_folder)]
-    labels_to_images = {}
-    rotation_angles = [cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_180, cv2.ROTATE_90_COUNTERCLOCKWISE]
-    mutex.acquire()
-    try:
-        if not os.path.exists(image_save_path):
-            os.makedirs(image_save_path)
-        if not os.path.exists(mask_save_path) and is_save_mask:
-            os.makedirs(mask_save_path)
-        if not os.path.exists(annotation_save_path):
-            os.makedirs(annotation_save_path)
-    finally:
-        mutex.release()
+    profiler = get_profiler()
+    writer = get_writer()
+    backgrounds = get_background_cache()
+    labels_to_images, sprite_bank = get_fruit_sources()
+    hdf5_writer = None
+    if hdf5_shard_path is not None:
+        hdf5_writer = Hdf5ShardWriter(hdf5_shard_path)
+    recipes = None
+    if recipe_shard_path is not None:
+        recipes = []
+    # when the images also go in shards, an index is complete only once the shards of its chunk are saved
+    has_shards = hdf5_writer is not None or recipes is not None
+
+    for img_count in indices:
+        rng = get_image_rng(seed, img_count)
+        recipe = None
+        if recipes is not None:
+            recipe = {'index': img_count}
+            recipes.append(recipe)
+        canvas, mask_canvas, anchors, instance_map = compose_scene(rng, backgrounds, labels_to_images, local_stats, is_binary_mask=is_binary_mask,
+                                                                   is_save_mask=is_save_mask, sprite_bank=sprite_bank,
+                                                                   is_save_instances=instance_save_path is not None, profiler=profiler, recipe=recipe)
+        # the scene is composed once and resized to each output resolution
+        scene = (canvas, mask_canvas, instance_map, anchors)
+        entries = []
+        canvas, anchors = add_output_entries(entries, scene, config.img_shape[:2], image_save_path, mask_save_path, annotation_save_path, instance_save_path,
+                                             img_count, writer, simple_annotation_format, profiler)
+        for shape in extra_shapes:
+            add_output_entries(entries, scene, shape, get_resolution_folder(image_save_path, shape), get_resolution_folder(mask_save_path, shape),
+                               get_resolution_folder(annotation_save_path, shape), get_resolution_folder(instance_save_path, shape),
+                               img_count, writer, simple_annotation_format, profiler)
+        if recipe is not None:
+            # the fruits of the recipe are in the same order as the anchors
+            for fruit, anchor in zip(recipe['fruits'], anchors):
+                fruit['box'] = (anchor[0][1], anchor[0][0], anchor[3][1], anchor[3][0])
+        # the files are encoded and written in the background while the next scene is generated
+        # the index is recorded in the manifest once all its files are written, unless it also goes in a shard
+        on_written = None
+        if manifest is not None and not has_shards:
+            on_written = functools.partial(manifest.record, img_count)
+        # time spent waiting for a free slot in the writer queue, i.e. the scene generation is faster than the disk
+        with profiler.stage('writer_queue_wait'):
+            writer.add_sample(entries, on_written=on_written)
+        # like DataGenerator.parse_csv, images without boxes are not added to the HDF5 dataset
+        if hdf5_writer is not None and len(anchors) > 0:
+            with profiler.stage('hdf5_write'):
+                hdf5_writer.add(str(img_count), cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB), anchors_to_labels(anchors))
+    if hdf5_writer is not None:
+        hdf5_writer.close()
+    if recipes is not None:
+        SceneRecipes(recipes, config.img_shape[:2], sprite_bank is not None).save(recipe_shard_path)
+    with profiler.stage('writer_queue_wait'):
+        writer.flush()
+    if manifest is not None and has_shards:
+        # the shards are only complete once they are saved, so the indices of the chunk are recorded together
+        manifest.record(*indices)
+    # the timings of the chunk are sent to the main process, the profiler of the worker starts again from zero for the next chunk
+    return local_stats, len(indices), profiler.pop()
+
+
+def add_output_entries(entries, scene, shape, image_save_path, mask_save_path, annotation_save_path, instance_save_path, img_count, writer,
+                       simple_annotation_format=True, profiler=None):
+    """
+    Resizes the scene returned by compose_scene to shape (height, width), adds the files to write to entries
+    and returns the resized canvas and anchors
+    """
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    canvas, mask_canvas, instance_map, anchors = scene
+    skewed_height, skewed_width = canvas.shape[:2]
+    height, width = shape
+    image_name = str(img_count) + writer.extension
+    with profiler.stage('output_resize'):
+        canvas = cv2.resize(canvas, (width, height))
+    anchors = resize_bounding_boxes(anchors, skewed_width, skewed_height, width, height)
+    if config.write_image_files:
+        annotation_file, annotation = format_annotation(anchors, img_count, image_name, simple_format=simple_annotation_format)
+        entries.append((image_save_path + image_name, 'image', canvas))
+        entries.append((annotation_save_path + annotation_file, 'text', annotation))
+    if mask_canvas is not None:
+        with profiler.stage('output_resize'):
+            mask_canvas = cv2.resize(mask_canvas, (width, height))
+        entries.append((mask_save_path + str(img_count) + writer.mask_extension, 'mask', mask_canvas))
+    if instance_map is not None:
+        with profiler.stage('instance_rle'):
+            instance_map = cv2.resize(instance_map, (width, height), interpolation=cv2.INTER_NEAREST)
+            entries.append((instance_save_path + str(img_count) + '.json', 'text', format_instances(instance_map, anchors, image_name)))
+    return canvas, anchors
+
+
+def get_extra_shapes():
+    """Returns the (height, width) of each resolution in config.extra_output_resolutions"""
+    shapes = []
+    for resolution in config.extra_output_resolutions:
+        if isinstance(resolution, int):
+            # the length of the shortest side, the other side keeps the aspect ratio of config.img_shape (like the FRCNN resize)
+            height, width = config.img_shape[:2]
+            ratio = resolution / min(height, width)
+            shapes.append((round_number(height * ratio), round_number(width * ratio)))
+        else:
+            shapes.append((resolution[0], resolution[1]))
+    return shapes
+
+
+def get_resolution_folder(folder, shape):
+    # e.g. Train/images/ -> Train/300x300/images/
+    if folder is None:
+        return None
+    parent, name = os.path.split(os.path.normpath(folder))
+    return os.path.join(parent, '%dx%d' % shape, name) + '/'
+
+
+def anchors_to_labels(anchors):
+    # one (class_id, xmin, ymin, xmax, ymax) row per box, the format used by the SSD DataGenerator
+    return np.array([(config.fruit_labels.index(anchor[4]), anchor[0][1], anchor[0][0], anchor[3][1], anchor[3][0]) for anchor in anchors], dtype=np.int32)
+
+
+def get_writer():
+    # the writer threads are kept for the lifetime of the worker process and shared by all the chunks it generates
+    global writer_instance
+    if writer_instance is None:
+        writer_instance = DatasetWriter(image_format=config.image_format, png_compression=config.png_compression, quality=config.image_quality,
+                                        num_threads=config.writer_threads, queue_size=config.writer_queue_size, report_interval=config.report_interval,
+                                        profiler=get_profiler())
+    return writer_instance
+
+
+def get_profiler():
+    # when profile_generation is False, the profiler does not record anything
+    global profiler_instance
+    if profiler_instance is None:
+        profiler_instance = StageProfiler(enabled=config.profile_generation)
+    return profiler_instance
+
+
+def get_background_paths():
+    # sorted so that a background index means the same file in every worker
+    return sorted(config.background_folder + x for x in os.listdir(config.background_folder))
 
+
+def get_background_cache():
+    # each worker process decodes a background only the first time it is used, the cache is kept for the lifetime of the process
+    global background_cache_instance
+    if background_cache_instance is None:
+        background_cache_instance = BackgroundCache(get_background_paths(), max_bytes=config.background_cache_size_mb * 1024 * 1024,
+                                                    cache_resized=config.background_skew_buckets > 0)
+    return background_cache_instance
+
+
+def get_labels_to_images():
+    labels_to_images = {}
     with open(config.labels_file, mode='r') as f:
         lines = f.readlines()
         source_labels = [x.strip() for x in lines]
         for source_label in source_labels:
             label = source_label.strip('*')
-            labels_to_images[label] = glob.glob(config.source_dataset_train_folder + source_label + '/*')
-
-    for index in range(limit):
-        skew_factor_w = random.uniform(config.img_skew_range[0], config.img_skew_range[1])
-        skew_factor_h = random.uniform(config.img_skew_range[0], config.img_skew_range[1])
-        skewed_width = math.floor(config.img_shape[1] * skew_factor_w)
-        skewed_height = math.floor(config.img_shape[0] * skew_factor_h)
-        img_count = index * total_threads + thread_id + offset
-        canvas = cv2.imread(bkg_image_paths[random.randint(0, len(bkg_image_paths) - 1)])
-        canvas = cv2.resize(canvas, (skewed_width, skewed_height))
-        canvas = enhance_image(canvas)
-        if random.randint(0, 99) > 70:
+            labels_to_images[label] = sorted(glob.glob(config.source_dataset_train_folder + source_label + '/*'))
+    return labels_to_images
+
+
+def get_fruit_sources():
+    # when the sprite bank is used, the fruits are taken from the precomputed crops and masks instead of the source images
+    if config.use_sprite_bank:
+        return None, SpriteBank(config.sprite_bank_path)
+    return get_labels_to_images(), None
+
+
+def get_image_rng(seed, img_count):
+    # every image gets its own generator derived from its index, so the generated dataset
+    # does not depend on the number of workers or on the order in which the indices are processed
+    if seed is None:
+        return random.Random()
+    return random.Random('%s:%d' % (seed, img_count))
+
+
+def snap_skew_factor(skew_factor):
+    # round the skew factor to the nearest of config.background_skew_buckets values spread evenly over config.img_skew_range,
+    # so the backgrounds are only resized to a few sizes that can be cached
+    if config.background_skew_buckets <= 0:
+        return skew_factor
+    if config.background_skew_buckets == 1:
+        return (config.img_skew_range[0] + config.img_skew_range[1]) / 2
+    step = (config.img_skew_range[1] - config.img_skew_range[0]) / (config.background_skew_buckets - 1)
+    return config.img_skew_range[0] + round((skew_factor - config.img_skew_range[0]) / step) * step
+
+
+def compose_scene(rng, backgrounds, labels_to_images, local_stats=None, is_binary_mask=True, is_save_mask=True, sprite_bank=None, is_save_instances=False,
+                  profiler=None, recipe=None):
+    """
+    Returns the canvas, the mask canvas (None unless is_save_mask), the anchors and the instance map (None unless is_save_instances).
+    In the instance map, the pixels of the fruit described by anchors[k - 1] have the value k and the background is 0.
+    If recipe is a dictionary, the random choices that lead to the scene are stored in it (see SceneRecipes), so render_scene can reproduce it.
+    """
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    skew_factor_w = snap_skew_factor(rng.uniform(config.img_skew_range[0], config.img_skew_range[1]))
+    skew_factor_h = snap_skew_factor(rng.uniform(config.img_skew_range[0], config.img_skew_range[1]))
+    skewed_width = math.floor(config.img_shape[1] * skew_factor_w)
+    skewed_height = math.floor(config.img_shape[0] * skew_factor_h)
+    background_index = rng.randint(0, len(backgrounds) - 1)
+    # the cached background is read-only, apply_enhancement returns a new image that the fruits are added to
+    with profiler.stage('background'):
+        canvas = backgrounds.get(background_index, skewed_width, skewed_height)
+    contrast_factor, brightness_factor = sample_enhancement(rng=rng)
+    with profiler.stage('enhance_image'):
+        canvas = apply_enhancement(canvas, contrast_factor, brightness_factor)
+        is_blurred = rng.randint(0, 99) > 70
+        if is_blurred:
             canvas = cv2.blur(canvas, ksize=(10, 10))
-        mask_canvas = None
-        if is_save_mask:
-            mask_canvas = np.zeros((skewed_height, skewed_width, config.img_shape[2]), dtype=np.uint8)
-        anchors = []
-        for i in range(config.fruits_in_image):
-            fruit_label_index = random.randint(1, len(config.fruit_labels) - 1)
-            fruit_label = config.fruit_labels[fruit_label_index]
-            fruit_image_path = labels_to_images[fruit_label][random.randint(0, len(labels_to_images[fruit_label]) - 1)]
-            fruit_img_size = random.randint(min(config.min_fruit_size, skewed_height, skewed_width), min(config.max_fruit_size, skewed_height, skewed_width))
-            rotate_index = random.randint(0, 3)
-            initial_fruit_image = cv2.imread(fruit_image_path)
-            successfully_added_img = False
-            attempts = 3
-            while not successfully_added_img and attempts > 0:
-                fruit_image = cv2.resize(initial_fruit_image, (fruit_img_size, fruit_img_size))
-                if rotate_index < 3:
-                    fruit_image = cv2.rotate(fruit_image, rotateCode=rotation_angles[rotate_index])
-                fruit_mask = build_mask(fruit_image)
-                non_empty_cols = np.where(np.amax(fruit_mask, axis=0) > 0)[0]
-                non_empty_rows = np.where(np.amax(fruit_mask, axis=1) > 0)[0]
-                top_most_px = min(non_empty_rows)
-                bottom_most_px = max(non_empty_rows)
-                left_most_px = min(non_empty_cols)
-                right_most_px = max(non_empty_cols)
-                fruit_mask = fruit_mask[top_most_px:bottom_most_px + 1, left_most_px:right_most_px + 1]
-                fruit_image = fruit_image[top_most_px:bottom_most_px + 1, left_most_px:right_most_px + 1]
-                fruit_image, fruit_mask = apply_partial_cropping(fruit_image, fruit_mask, probability=40, crop_ratio=0.3)
-                w, h = fruit_image.shape[:2]
-                if min(w, h) < config.min_fruit_size or max(w, h) > config.max_fruit_size:
-                    ratio = min(min(w, h) / config.min_fruit_size, config.max_fruit_size / max(w, h))
-                    fruit_image = cv2.resize(fruit_image, (int(h * ratio), int(w * ratio)))
-                    fruit_mask = build_mask(fruit_image)
-                fruit_image = enhance_image(fruit_image)
-                # pad the image by a percentage so the resulting bounding box is slightly bigger than the fruit
-                w, h = fruit_image.shape[:2]
-                fruit_image = cv2.copyMakeBorder(fruit_image,
-                                                 top=min(int(h * config.bounding_box_padding), config.max_padding),
-                                                 bottom=min(int(h * config.bounding_box_padding), config.max_padding),
-                                                 left=min(int(w * config.bounding_box_padding), config.max_padding),
-                                                 right=min(int(w * config.bounding_box_padding), config.max_padding),
-                                                 borderType=cv2.BORDER_CONSTANT, value=[0, 0, 0])
-                fruit_mask = cv2.copyMakeBorder(fruit_mask,
-                                                top=min(int(h * config.bounding_box_padding), config.max_padding),
-                                                bottom=min(int(h * config.bounding_box_padding), config.max_padding),
-                                                left=min(int(w * config.bounding_box_padding), config.max_padding),
-                                                right=min(int(w * config.bounding_box_padding), config.max_padding),
-                                                borderType=cv2.BORDER_CONSTANT, value=[0, 0, 0])
-                if not is_binary_mask:
-                    fruit_mask = color_mask(fruit_mask, config.color_map[fruit_label_index])
-                successfully_added_img, w, h = add_image_and_mask_to_canvas(canvas, fruit_image, mask_canvas, fruit_mask, anchors, fruit_label)
-                if successfully_added_img:
+    if recipe is not None:
+        recipe.update({'background': background_index, 'width': skewed_width, 'height': skewed_height, 'contrast': contrast_factor,
+                       'brightness': brightness_factor, 'blur': is_blurred, 'fruits': []})
+    mask_canvas = None
+    if is_save_mask:
+        mask_canvas = np.zeros((skewed_height, skewed_width, config.img_shape[2]), dtype=np.uint8)
+    instance_map = None
+    if is_save_instances:
+        instance_map = np.zeros((skewed_height, skewed_width), dtype=np.uint16)
+    anchors = []
+    occupancy_grid = OccupancyGrid(skewed_height, skewed_width, config.overlap_factor)
+    for i in range(config.fruits_in_image):
+        fruit_label_index = rng.randint(1, len(config.fruit_labels) - 1)
+        fruit_label = config.fruit_labels[fruit_label_index]
+        if sprite_bank is not None:
+            fruit_source_index = rng.randint(0, sprite_bank.count(fruit_label) - 1)
+            fruit_source = None
+        else:
+            fruit_source_index = rng.randint(0, len(labels_to_images[fruit_label]) - 1)
+            with profiler.stage('fruit_decode'):
+                fruit_source = cv2.imread(labels_to_images[fruit_label][fruit_source_index])
+        fruit_img_size = rng.randint(min(config.min_fruit_size, skewed_height, skewed_width), min(config.max_fruit_size, skewed_height, skewed_width))
+        rotate_index = rng.randint(0, 3)
+        successfully_added_img = False
+        attempts = 3
+        while not successfully_added_img and attempts > 0:
+            fruit_image, fruit_mask = prepare_fruit(fruit_source, fruit_label, fruit_source_index, fruit_img_size, rotate_index, sprite_bank, profiler)
+            crop = sample_partial_cropping(fruit_image.shape, probability=40, crop_ratio=0.3, rng=rng)
+            enhancement = sample_enhancement(rng=rng)
+            fruit_image, fruit_mask = finish_fruit(fruit_image, fruit_mask, fruit_label_index, crop, enhancement, sprite_bank is not None, is_binary_mask, profiler)
+            with profiler.stage('placement'):
+                successfully_added_img, w, h = add_image_and_mask_to_canvas(canvas, fruit_image, mask_canvas, fruit_mask, anchors, fruit_label, occupancy_grid,
+                                                                              rng=rng, instance_map=instance_map)
+            profiler.count('placement_attempts')
+            if successfully_added_img:
+                profiler.count('fruits_added')
+                if local_stats is not None:
                     update_stats(local_stats, h, w)
-                else:
-                    attempts -= 1
-                    fruit_img_size = round_number(fruit_img_size * 0.8)
-                    if fruit_img_size < config.min_fruit_size:
-                        break
-        canvas = cv2.resize(canvas, (config.img_shape[1], config.img_shape[0]))
-        cv2.imwrite(image_save_path + str(img_count) + '.png', canvas)
-        if mask_canvas is not None:
-            mask_canvas = cv2.resize(mask_canvas, (config.img_shape[1], config.img_shape[0]))
-            cv2.imwrite(mask_save_path + str(img_count) + '.png', mask_canvas)
-        anchors = resize_bounding_boxes(anchors, skewed_width, skewed_height, config.img_shape[1], config.img_shape[0])
-        write_annotation_to_file(annotation_save_path, anchors, img_count, simple_format=simple_annotation_format)
-        print("Thread %d saved image %d.png" % (thread_id, img_count))
-    mutex.acquire()
-    if local_stats.minimum_area < stats.minimum_area:
-        stats.minimum_area_img_w = local_stats.minimum_area_img_w
-        stats.minimum_area_img_h = local_stats.minimum_area_img_h
-        stats.minimum_area = local_stats.minimum_area
-    if local_stats.minimum_height_img_h < stats.minimum_height_img_h:
-        stats.minimum_height_img_h = local_stats.minimum_height_img_h
-        stats.minimum_height_img_w = local_stats.minimum_height_img_w
-    if local_stats.minimum_width_img_w < stats.minimum_width_img_w:
-        stats.minimum_width_img_h = local_stats.minimum_width_img_h
-        stats.minimum_width_img_w = local_stats.minimum_width_img_w
-    mutex.release()
-
-
-def apply_partial_cropping(fruit_image, fruit_mask, probability=40, crop_ratio=0.3):
-    horizontal_crop_chance = random.randint(0, 99)
-    vertical_crop_chance = random.randint(0, 99)
+                if recipe is not None:
+                    # the upper left corner of the anchor is the position of the fruit image
+                    x, y = anchors[-1][0]
+                    recipe['fruits'].append({'label': fruit_label_index, 'source': fruit_source_index, 'size': fruit_img_size, 'rotation': rotate_index,
+                                             'crop': crop, 'contrast': enhancement[0], 'brightness': enhancement[1], 'x': x, 'y': y})
+            else:
+                profiler.count('placement_failures')
+                attempts -= 1
+                fruit_img_size = round_number(fruit_img_size * 0.8)
+                if fruit_img_size < config.min_fruit_size:
+                    break
+        if not successfully_added_img:
+            profiler.count('fruits_dropped')
+    return canvas, mask_canvas, anchors, instance_map
+
+
+def render_scene(recipe, backgrounds, labels_to_images, is_binary_mask=True, is_save_mask=True, sprite_bank=None, is_save_instances=False):
+    """Reproduces the scene described by a recipe recorded by compose_scene; returns the same values as compose_scene"""
+    canvas = backgrounds.get(recipe['background'], recipe['width'], recipe['height'])
+    canvas = apply_enhancement(canvas, recipe['contrast'], recipe['brightness'])
+    if recipe['blur']:
+        canvas = cv2.blur(canvas, ksize=(10, 10))
+    mask_canvas = None
+    if is_save_mask:
+        mask_canvas = np.zeros((recipe['height'], recipe['width'], config.img_shape[2]), dtype=np.uint8)
+    instance_map = None
+    if is_save_instances:
+        instance_map = np.zeros((recipe['height'], recipe['width']), dtype=np.uint16)
+    anchors = []
+    for fruit in recipe['fruits']:
+        fruit_label = config.fruit_labels[fruit['label']]
+        fruit_source = None
+        if sprite_bank is None:
+            fruit_source = cv2.imread(labels_to_images[fruit_label][fruit['source']])
+        fruit_image, fruit_mask = prepare_fruit(fruit_source, fruit_label, fruit['source'], fruit['size'], fruit['rotation'], sprite_bank)
+        fruit_image, fruit_mask = finish_fruit(fruit_image, fruit_mask, fruit['label'], fruit['crop'], (fruit['contrast'], fruit['brightness']),
+                                               sprite_bank is not None, is_binary_mask)
+        paste_fruit(canvas, fruit_image, mask_canvas, fruit_mask, anchors, fruit_label, fruit['x'], fruit['y'], instance_map=instance_map)
+    return canvas, mask_canvas, anchors, instance_map
+
+
+def prepare_fruit(fruit_source, fruit_label, fruit_source_index, fruit_img_size, rotate_index, sprite_bank=None, profiler=None):
+    """
+    Returns the fruit image resized to fruit_img_size, rotated and cropped to the fruit, and its mask
+    fruit_source is the decoded source image, or None when the fruit is taken from the sprite bank
+    """
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    rotation_angles = [cv2.ROTATE_90_CLOCKWISE, cv2.ROTATE_180, cv2.ROTATE_90_COUNTERCLOCKWISE]
+    if sprite_bank is not None:
+        # the sprite is already cropped to the fruit, so only the resize and the rotation are left to do
+        with profiler.stage('fruit_resize_rotate'):
+            fruit_image, fruit_mask = sprite_bank.get_scaled_sprite(fruit_label, fruit_source_index, fruit_img_size)
+            if rotate_index < 3:
+                fruit_image = cv2.rotate(fruit_image, rotateCode=rotation_angles[rotate_index])
+                fruit_mask = cv2.rotate(fruit_mask, rotateCode=rotation_angles[rotate_index])
+        return fruit_image, fruit_mask
+    with profiler.stage('fruit_resize_rotate'):
+        fruit_image = cv2.resize(fruit_source, (fruit_img_size, fruit_img_size))
+        if rotate_index < 3:
+            fruit_image = cv2.rotate(fruit_image, rotateCode=rotation_angles[rotate_index])
+    with profiler.stage('build_mask'):
+        fruit_mask = build_mask(fruit_image)
+        non_empty_cols = np.where(np.amax(fruit_mask, axis=0) > 0)[0]
+        non_empty_rows = np.where(np.amax(fruit_mask, axis=1) > 0)[0]
+        top_most_px = min(non_empty_rows)
+        bottom_most_px = max(non_empty_rows)
+        left_most_px = min(non_empty_cols)
+        right_most_px = max(non_empty_cols)
+        fruit_mask = fruit_mask[top_most_px:bottom_most_px + 1, left_most_px:right_most_px + 1]
+        fruit_image = fruit_image[top_most_px:bottom_most_px + 1, left_most_px:right_most_px + 1]
+    return fruit_image, fruit_mask
+
+
+def finish_fruit(fruit_image, fruit_mask, fruit_label_index, crop, enhancement, is_sprite=False, is_binary_mask=True, profiler=None):
+    """Applies the sampled crop and enhancement to the prepared fruit, keeps its size within the limits and pads it"""
+    if profiler is None:
+        profiler = StageProfiler(enabled=False)
+    with profiler.stage('partial_cropping'):
+        fruit_image, fruit_mask = apply_crop(fruit_image, fruit_mask, crop)
+    w, h = fruit_image.shape[:2]
+    if min(w, h) < config.min_fruit_size or max(w, h) > config.max_fruit_size:
+        ratio = min(min(w, h) / config.min_fruit_size, config.max_fruit_size / max(w, h))
+        with profiler.stage('fruit_resize_rotate'):
+            fruit_image = cv2.resize(fruit_image, (int(h * ratio), int(w * ratio)))
+        if is_sprite:
+            with profiler.stage('fruit_resize_rotate'):
+                fruit_mask = cv2.resize(fruit_mask, (int(h * ratio), int(w * ratio)), interpolation=cv2.INTER_NEAREST)
+        else:
+            with profiler.stage('build_mask'):
+                fruit_mask = build_mask(fruit_image)
+    with profiler.stage('enhance_image'):
+        fruit_image = apply_enhancement(fruit_image, enhancement[0], enhancement[1])
+    # pad the image by a percentage so the resulting bounding box is slightly bigger than the fruit
+    w, h = fruit_image.shape[:2]
+    with profiler.stage('padding'):
+        fruit_image = cv2.copyMakeBorder(fruit_image,
+                                         top=min(int(h * config.bounding_box_padding), config.max_padding),
+                                         bottom=min(int(h * config.bounding_box_padding), config.max_padding),
+                                         left=min(int(w * config.bounding_box_padding), config.max_padding),
+                                         right=min(int(w * config.bounding_box_padding), config.max_padding),
+                                         borderType=cv2.BORDER_CONSTANT, value=[0, 0, 0])
+        fruit_mask = cv2.copyMakeBorder(fruit_mask,
+                                        top=min(int(h * config.bounding_box_padding), config.max_padding),
+                                        bottom=min(int(h * config.bounding_box_padding), config.max_padding),
+                                        left=min(int(w * config.bounding_box_padding), config.max_padding),
+                                        right=min(int(w * config.bounding_box_padding), config.max_padding),
+                                        borderType=cv2.BORDER_CONSTANT, value=[0, 0, 0])
+    if not is_binary_mask:
+        with profiler.stage('color_mask'):
+            fruit_mask = color_mask(fruit_mask, config.color_map[fruit_label_index])
+    return fruit_image, fruit_mask
+
+
+def apply_partial_cropping(fruit_image, fruit_mask, probability=40, crop_ratio=0.3, rng=random):
+    crop = sample_partial_cropping(fruit_image.shape, probability=probability, crop_ratio=crop_ratio, rng=rng)
+    return apply_crop(fruit_image, fruit_mask, crop)
+
+
+def sample_partial_cropping(shape, probability=40, crop_ratio=0.3, rng=random):
+    """Returns the crop as (axis, from_start, crop_length), axis is 0 if the image is not cropped, 1 for the rows and 2 for the columns"""
+    horizontal_crop_chance = rng.randint(0, 99)
+    vertical_crop_chance = rng.randint(0, 99)
     # delete top/bottom/left/right part of the image with a probability; up to 30% of the image width
     # don't crop both width and height
     if horizontal_crop_chance < probability <= vertical_crop_chance:
-        crop_length = random.randint(1, math.floor(fruit_image.shape[0] * crop_ratio))
-        if horizontal_crop_chance % 2 == 0:
-            fruit_image = fruit_image[crop_length:, :]
-            fruit_mask = fruit_mask[crop_length:, :]
-        else:
-            fruit_image = fruit_image[:fruit_image.shape[0] - crop_length, :]
-            fruit_mask = fruit_mask[:fruit_mask.shape[0] - crop_length, :]
+        crop_length = rng.randint(1, math.floor(shape[0] * crop_ratio))
+        return 1, horizontal_crop_chance % 2 == 0, crop_length
     if vertical_crop_chance < probability <= horizontal_crop_chance:
-        crop_length = random.randint(1, math.floor(fruit_image.shape[1] * crop_ratio))
-        if vertical_crop_chance % 2 == 0:
-            fruit_image = fruit_image[:, crop_length:]
-            fruit_mask = fruit_mask[:, crop_length:]
-        else:
-            fruit_image = fruit_image[:, :fruit_image.shape[1] - crop_length]
-            fruit_mask = fruit_mask[:, :fruit_mask.shape[1] - crop_length]
+        crop_length = rng.randint(1, math.floor(shape[1] * crop_ratio))
+        return 2, vertical_crop_chance % 2 == 0, crop_length
+    return 0, False, 0
+
+
+def apply_crop(fruit_image, fruit_mask, crop):
+    axis, from_start, crop_length = crop
+    if axis == 1:
+        if from_start:
+            return fruit_image[crop_length:, :], fruit_mask[crop_length:, :]
+        return fruit_image[:fruit_image.shape[0] - crop_length, :], fruit_mask[:fruit_mask.shape[0] - crop_length, :]
+    if axis == 2:
+        if from_start:
+            return fruit_image[:, crop_length:], fruit_mask[:, crop_length:]
+        return fruit_image[:, :fruit_image.shape[1] - crop_length], fruit_mask[:, :fruit_mask.shape[1] - crop_length]
     return fruit_image, fruit_mask
 
 
+def merge_stats(stats_param, other_stats):
+    if other_stats.minimum_area < stats_param.minimum_area:
+        stats_param.minimum_area_img_w = other_stats.minimum_area_img_w
+        stats_param.minimum_area_img_h = other_stats.minimum_area_img_h
+        stats_param.minimum_area = other_stats.minimum_area
+    if other_stats.minimum_height_img_h < stats_param.minimum_height_img_h:
+        stats_param.minimum_height_img_h = other_stats.minimum_height_img_h
+        stats_param.minimum_height_img_w = other_stats.minimum_height_img_w
+    if other_stats.minimum_width_img_w < stats_param.minimum_width_img_w:
+        stats_param.minimum_width_img_h = other_stats.minimum_width_img_h
+        stats_param.minimum_width_img_w = other_stats.minimum_width_img_w
+
+
 def update_stats(stats_param, h, w):
     if stats_param.minimum_area > w * h:
         stats_param.minimum_area_img_h = h
@@ -182,15 +469,16 @@ def round_number(x):
         return math.floor(x)
 
 
-def write_annotation_to_file(annotation_save_path, anchors, img_count, simple_format=True):
+def format_annotation(anchors, img_count, image_name, simple_format=True):
+    """Returns the name of the annotation file and its content"""
     if simple_format:
-        with open(annotation_save_path + str(img_count), 'w') as f:
-            f.write(str(img_count) + '.png\n')
-            for anchor in anchors:
-                f.write(str(anchor[0][1]) + ',' + str(anchor[0][0]) + ',' + str(anchor[3][1]) + ',' + str(anchor[3][0]) + ',' + anchor[4] + '\n')
+        lines = [image_name + '\n']
+        for anchor in anchors:
+            lines.append(str(anchor[0][1]) + ',' + str(anchor[0][0]) + ',' + str(anchor[3][1]) + ',' + str(anchor[3][0]) + ',' + anchor[4] + '\n')
+        return str(img_count), ''.join(lines)
     else:
         root = ep.Element('annotation')
-        ep.SubElement(root, 'path').text = config.train_image_folder + str(img_count) + '.png'
+        ep.SubElement(root, 'path').text = config.train_image_folder + image_name
         for anchor in anchors:
             obj = ep.SubElement(root, 'object')
             ep.SubElement(obj, 'name').text = anchor[4]
@@ -199,61 +487,70 @@ def write_annotation_to_file(annotation_save_path, anchors, img_count, simple_fo
             ep.SubElement(bndbox, 'xmax').text = str(anchor[3][1])
             ep.SubElement(bndbox, 'ymin').text = str(anchor[0][0])
             ep.SubElement(bndbox, 'ymax').text = str(anchor[3][0])
-        tree = ep.ElementTree(root)
-        tree.write(file_or_filename=annotation_save_path + str(img_count) + '.xml')
+        return str(img_count) + '.xml', ep.tostring(root, encoding='unicode')
+
 
+def format_instances(instance_map, anchors, image_name):
+    """Returns the JSON description of the instances: id, class, box and COCO RLE mask of every fruit in the image"""
+    encodings = encode_instances(instance_map, range(1, len(anchors) + 1))
+    instances = []
+    for instance_id, anchor in enumerate(anchors, start=1):
+        rle = encodings[instance_id]
+        instances.append({'id': instance_id,
+                          'class_id': config.fruit_labels.index(anchor[4]),
+                          'label': anchor[4],
+                          'bbox': [anchor[0][1], anchor[0][0], anchor[3][1], anchor[3][0]],
+                          'area': rle_area(rle),
+                          'segmentation': rle})
+    return json.dumps({'image': image_name, 'height': instance_map.shape[0], 'width': instance_map.shape[1], 'instances': instances})
 
-def enhance_image(canvas, contrast=True, brightness=True):
+
+def enhance_image(canvas, contrast=True, brightness=True, rng=random):
+    contrast_factor, brightness_factor = sample_enhancement(contrast, brightness, rng=rng)
+    return apply_enhancement(canvas, contrast_factor, brightness_factor)
+
+
+def sample_enhancement(contrast=True, brightness=True, rng=random):
     brightness_factor = 0
     contrast_factor = 1.0
     if contrast:
-        contrast_factor = random.random() * 1.2 + 0.4
+        contrast_factor = rng.random() * 1.2 + 0.4
     if brightness:
-        brightness_factor = random.random() * 1.2 + 0.4
-    canvas = cv2.convertScaleAbs(canvas, alpha=contrast_factor, beta=brightness_factor)
-    return canvas
+        brightness_factor = rng.random() * 1.2 + 0.4
+    return contrast_factor, brightness_factor
+
+
+def apply_enhancement(canvas, contrast_factor, brightness_factor):
+    return cv2.convertScaleAbs(canvas, alpha=contrast_factor, beta=brightness_factor)
 
 
 # TODO: add partial occlusion
-def add_image_and_mask_to_canvas(canvas, fruit_image, canvas_mask, fruit_mask, anchors, fruit_label):
-    # bounds inside of which the fruit image can be added to the canvas
-    # the fruit image could be partially outside of the canvas, to emulate the case where only part of the fruit is visible in an image
-    # max_x = canvas.shape[0] - fruit_image.shape[0] // 2
-    # max_y = canvas.shape[1] - fruit_image.shape[1] // 2
-    # min_x = -fruit_image.shape[0]
-    # min_y = -fruit_image.shape[1]
-    max_x = canvas.shape[0] - fruit_image.shape[0] - 1
-    max_y = canvas.shape[1] - fruit_image.shape[1] - 1
-    min_x = 0
-    min_y = 0
-    x = 0
-    y = 0
-    done = False
-    attempts = 10
-    if min_x > max_x or min_y > max_y:
-        return done, 0, 0
-    while not done and attempts > 0:
-        # attempt to find a free area on the canvas to add the image
-        # if no free space is found, the image is not added
-        x = random.randint(min_x // 2, max_x)
-        y = random.randint(min_y // 2, max_y)
-        done = not is_overlap_between_new_image_and_old_images(((x, y),
-                                                                (x, y + fruit_image.shape[1]),
-                                                                (x + fruit_image.shape[0], y),
-                                                                (x + fruit_image.shape[0], y + fruit_image.shape[1])),
-                                                               anchors)
-        attempts -= 1
-    if done:
-        add_image_to_canvas(canvas, fruit_image, fruit_mask, x, y)
-        if canvas_mask is not None:
-            add_image_to_canvas(canvas_mask, fruit_mask, fruit_mask, x, y)
-        # if the fruit is only partially included in the image, set the anchor bounds to the edge of the canvas
-        upper_left = (max(x, 0), max(y, 0))
-        lower_left = (max(x, 0), min(y + fruit_image.shape[1], canvas.shape[1] - 1))
-        upper_right = (min(x + fruit_image.shape[0], canvas.shape[0] - 1), max(y, 0))
-        lower_right = (min(x + fruit_image.shape[0], canvas.shape[0] - 1), min(y + fruit_image.shape[1], canvas.shape[1] - 1))
-        anchors.append((upper_left, lower_left, upper_right, lower_right, fruit_label))
-    return done, fruit_image.shape[0], fruit_image.shape[1]
+def add_image_and_mask_to_canvas(canvas, fruit_image, canvas_mask, fruit_mask, anchors, fruit_label, occupancy_grid, rng=random, instance_map=None):
+    # the occupancy grid returns a random position among all the positions where the fruit image does not overlap the other images
+    # if no free space is found, the image is not added
+    position = occupancy_grid.sample_position(fruit_image.shape[0], fruit_image.shape[1], rng=rng)
+    if position is None:
+        return False, fruit_image.shape[0], fruit_image.shape[1]
+    x, y = position
+    occupancy_grid.add(x, y, fruit_image.shape[0], fruit_image.shape[1])
+    paste_fruit(canvas, fruit_image, canvas_mask, fruit_mask, anchors, fruit_label, x, y, instance_map=instance_map)
+    return True, fruit_image.shape[0], fruit_image.shape[1]
+
+
+def paste_fruit(canvas, fruit_image, canvas_mask, fruit_mask, anchors, fruit_label, x, y, instance_map=None):
+    # adds the fruit with the upper left corner in (x, y) to the canvas, the mask canvas and the instance map, and appends its anchor
+    add_image_to_canvas(canvas, fruit_image, fruit_mask, x, y)
+    if canvas_mask is not None:
+        add_image_to_canvas(canvas_mask, fruit_mask, fruit_mask, x, y)
+    if instance_map is not None:
+        # the id of the new instance is its position in anchors plus one
+        add_instance_to_map(instance_map, fruit_mask, x, y, len(anchors) + 1)
+    # if the fruit is only partially included in the image, set the anchor bounds to the edge of the canvas
+    upper_left = (max(x, 0), max(y, 0))
+    lower_left = (max(x, 0), min(y + fruit_image.shape[1], canvas.shape[1] - 1))
+    upper_right = (min(x + fruit_image.shape[0], canvas.shape[0] - 1), max(y, 0))
+    lower_right = (min(x + fruit_image.shape[0], canvas.shape[0] - 1), min(y + fruit_image.shape[1], canvas.shape[1] - 1))
+    anchors.append((upper_left, lower_left, upper_right, lower_right, fruit_label))
 
 
 def add_image_to_canvas(canvas, fruit_image, fruit_mask, x, y):
@@ -270,46 +567,13 @@ def add_image_to_canvas(canvas, fruit_image, fruit_mask, x, y):
     cv2.copyTo(fruit_image[adjust_x:, adjust_y:, :], fruit_mask[adjust_x:, adjust_y:, :], canvas[canvas_x:canvas_x + fruit_image.shape[0], canvas_y:canvas_y + fruit_image.shape[1], :])
 
 
-def is_overlap_between_new_image_and_old_images(img_coordinates, other_images):
-    for old_img_coords in other_images:
-        if is_overlap_between_images(img_coordinates, old_img_coords):
-            return True
-    return False
-
-
-def is_overlap_between_images(src_img_coordinates, dest_img_coordinates):
-    upper_left_point = src_img_coordinates[0]
-    upper_right_point = src_img_coordinates[1]
-    lower_left_point = src_img_coordinates[2]
-    lower_right_point = src_img_coordinates[3]
-
-    upper_left_point_dest = dest_img_coordinates[0]
-    upper_right_point_dest = dest_img_coordinates[1]
-    lower_left_point_dest = dest_img_coordinates[2]
-    lower_right_point_dest = dest_img_coordinates[3]
-
-    # adjust the coordinates of each image using a factor to allow some degree of overlap between them
-    # source image
-    factor = config.overlap_factor
-    lower_left_point, lower_right_point, upper_left_point, upper_right_point = adjust_bounds_for_overlap(factor, upper_left_point, upper_right_point, lower_left_point, lower_right_point)
-    # destination image
-    lower_left_point_dest, lower_right_point_dest, upper_left_point_dest, upper_right_point_dest = adjust_bounds_for_overlap(factor, upper_left_point_dest, upper_right_point_dest, lower_left_point_dest,
-                                                                                                                             lower_right_point_dest)
-
-    p1 = Polygon([upper_left_point, upper_right_point, lower_right_point, lower_left_point, upper_left_point])
-    p2 = Polygon([upper_left_point_dest, upper_right_point_dest, lower_right_point_dest, lower_left_point_dest, upper_left_point_dest])
-    return p1.intersects(p2)
-
-
-def adjust_bounds_for_overlap(factor, upper_left_point, upper_right_point, lower_left_point, lower_right_point):
-    src_img_width = abs(upper_left_point[0] - lower_left_point[0])
-    src_img_height = abs(upper_left_point[1] - upper_right_point[1])
-    # as the upper left corner of an image is (0, 0), the upper bound will be smaller than the lower bound
-    upper_left_point = (upper_left_point[0] + math.floor(src_img_width * factor), upper_left_point[1] + math.floor(src_img_height * factor))
-    upper_right_point = (upper_right_point[0] + math.floor(src_img_width * factor), upper_right_point[1] - math.floor(src_img_height * factor))
-    lower_left_point = (lower_left_point[0] - math.floor(src_img_width * factor), lower_left_point[1] + math.floor(src_img_height * factor))
-    lower_right_point = (lower_right_point[0] - math.floor(src_img_width * factor), lower_right_point[1] - math.floor(src_img_height * factor))
-    return lower_left_point, lower_right_point, upper_left_point, upper_right_point
+def add_instance_to_map(instance_map, fruit_mask, x, y, instance_id):
+    # same placement as add_image_to_canvas, clipped to the map; the new instance covers the instances that were added before it
+    adjust_x = max(-x, 0)
+    adjust_y = max(-y, 0)
+    region = instance_map[x + adjust_x:x + fruit_mask.shape[0], y + adjust_y:y + fruit_mask.shape[1]]
+    fruit_pixels = np.any(fruit_mask[adjust_x:adjust_x + region.shape[0], adjust_y:adjust_y + region.shape[1]] > 0, axis=2)
+    region[fruit_pixels] = instance_id
 
 
 def build_mask(fruit_image, threshold=config.mask_threshold):
@@ -334,45 +598,234 @@ def build_mask(fruit_image, threshold=config.mask_threshold):
 
 
 def color_mask(fruit_mask, fruit_mask_color):
-    for i in range(fruit_mask.shape[0]):
-        for j in range(fruit_mask.shape[1]):
-            if (fruit_mask[i][j] == 255).all():
-                fruit_mask[i][j] = fruit_mask_color
+    fruit_mask[np.all(fruit_mask == 255, axis=2)] = fruit_mask_color
     return fruit_mask
 
 
+def generate_dataset(executor, image_save_path, mask_save_path, annotation_save_path, limit, offset=0, seed=None, hdf5_path=None, manifest_path=None,
+                     mode='resume', instance_save_path=None, extra_shapes=(), recipe_path=None, lease_folder=None, **kwargs):
+    """
+    Submits the generation of the images of a dataset split to the executor and returns the futures and the number of submitted images.
+    The indices of the completed images are kept in the manifest, mode selects how they are used:
+        'resume' - generate the images with the indices in [offset, offset + limit) that are not completed yet
+        'append' - generate limit new images, numbered after the highest completed index
+        'overwrite' - forget the completed images and generate all the images in [offset, offset + limit)
+    If lease_folder is set (coordinator mode), the manifest and mode are not used: the workers claim ranges of indices through lease files
+    in lease_folder, so several machines that share the output folder can generate the same split (see build_leased_ranges).
+    """
+    folders = [(image_save_path, mask_save_path, annotation_save_path, instance_save_path)]
+    # the files of the extra resolutions are saved in subfolders named after the resolution
+    folders += [tuple(get_resolution_folder(folder, shape) for folder in folders[0]) for shape in extra_shapes]
+    for image_folder, mask_folder, annotation_folder, instance_folder in folders:
+        if not os.path.exists(image_folder):
+            os.makedirs(image_folder)
+        if not os.path.exists(mask_folder) and kwargs.get('is_save_mask', True):
+            os.makedirs(mask_folder)
+        if not os.path.exists(annotation_folder):
+            os.makedirs(annotation_folder)
+        if instance_folder is not None and not os.path.exists(instance_folder):
+            os.makedirs(instance_folder)
+    if lease_folder is not None:
+        futures = [executor.submit(build_leased_ranges, lease_folder, image_save_path, mask_save_path, annotation_save_path, limit, offset=offset, seed=seed,
+                                   hdf5_path=hdf5_path, recipe_path=recipe_path, instance_save_path=instance_save_path, extra_shapes=extra_shapes, **kwargs)
+                   for _ in range(config.total_workers)]
+        return futures, limit
+    manifest = None
+    completed = set()
+    if manifest_path is not None:
+        manifest = GenerationManifest(manifest_path)
+        if mode == 'overwrite':
+            manifest.clear()
+        manifest.repair()
+        completed = manifest.completed_indices()
+    indices = get_pending_indices(completed, limit, offset, mode)
+    if hdf5_path is not None:
+        prepare_shards(hdf5_path, completed, read_hdf5_image_ids, mode)
+    if recipe_path is not None:
+        prepare_shards(recipe_path, completed, read_recipe_indices, mode)
+    if len(indices) < limit:
+        print("Skipping %d images that were already generated (set generation_mode to 'overwrite' to generate them again)" % (limit - len(indices)))
+    # split the indices in several small chunks per worker, so a slow worker does not delay the whole run
+    chunk_size = max(1, int(math.ceil(len(indices) / (config.total_workers * 4))))
+    futures = []
+    for start in range(0, len(indices), chunk_size):
+        # each chunk writes its own HDF5 and recipe shards, the shards are merged once the whole dataset is generated
+        hdf5_shard_path = None
+        if hdf5_path is not None:
+            hdf5_shard_path = '%s.shard%d' % (hdf5_path, indices[start])
+        recipe_shard_path = None
+        if recipe_path is not None:
+            recipe_shard_path = '%s.shard%d' % (recipe_path, indices[start])
+        futures.append(executor.submit(build_dataset, image_save_path, mask_save_path, annotation_save_path, indices[start:start + chunk_size], seed=seed,
+                                       hdf5_shard_path=hdf5_shard_path, manifest=manifest, instance_save_path=instance_save_path,
+                                       extra_shapes=extra_shapes, recipe_shard_path=recipe_shard_path, **kwargs))
+    return futures, len(indices)
+
+
+def build_leased_ranges(lease_folder, image_save_path, mask_save_path, annotation_save_path, limit, offset=0, seed=None, hdf5_path=None, recipe_path=None,
+                        **kwargs):
+    """
+    Coordinator mode: claims the ranges of config.lease_range_size indices of [offset, offset + limit) through lease files in lease_folder and
+    generates them, until all the ranges are completed by this process or by the other processes (on this or other machines) that share the folder.
+    The ranges of a process that died are claimed again once their leases expire.
+    """
+    leases = LeaseManager(lease_folder, config.lease_seconds)
+    leases.start_renewing()
+    local_stats = DatasetStats()
+    local_profiler = StageProfiler()
+    image_count = 0
+    range_starts = list(range(offset, offset + limit, config.lease_range_size))
+    try:
+        while True:
+            pending_starts = [start for start in range_starts if not leases.is_done('range%d' % start)]
+            if len(pending_starts) == 0:
+                break
+            claimed_range = False
+            for start in pending_starts:
+                if not leases.try_claim('range%d' % start):
+                    continue
+                claimed_range = True
+                indices = list(range(start, min(start + config.lease_range_size, offset + limit)))
+                hdf5_shard_path = '%s.shard%d' % (hdf5_path, start) if hdf5_path is not None else None
+                recipe_shard_path = '%s.shard%d' % (recipe_path, start) if recipe_path is not None else None
+                chunk_stats, chunk_size, chunk_profiler = build_dataset(image_save_path, mask_save_path, annotation_save_path, indices, seed=seed,
+                                                                        hdf5_shard_path=hdf5_shard_path, recipe_shard_path=recipe_shard_path, **kwargs)
+                merge_stats(local_stats, chunk_stats)
+                local_profiler.merge(chunk_profiler)
+                image_count += chunk_size
+                leases.complete('range%d' % start)
+            if not claimed_range:
+                # the remaining ranges are leased by other processes, wait until they are completed or their leases expire
+                time.sleep(config.lease_seconds / 4)
+    finally:
+        leases.stop_renewing()
+    return local_stats, image_count, local_profiler
+
+
+def get_pending_indices(completed, limit, offset=0, mode='resume'):
+    if mode not in ('resume', 'append', 'overwrite'):
+        raise ValueError("Unknown generation mode %s, the supported modes are: resume, append, overwrite" % mode)
+    if mode == 'append':
+        start = max(offset, max(completed) + 1) if len(completed) > 0 else offset
+        return list(range(start, start + limit))
+    return [index for index in range(offset, offset + limit) if index not in completed]
+
+
+def get_shard_paths(file_path):
+    # the temporary files of shards that were being saved when a run was interrupted are not shards
+    return [shard_path for shard_path in glob.glob(glob.escape(file_path) + '.shard*') if not shard_path.endswith('.tmp')]
+
+
+def prepare_shards(file_path, completed, read_image_ids, mode='resume'):
+    # a shard left by an interrupted run is kept only if it can be read and all its images are recorded in the manifest,
+    # otherwise its images are generated again in a new shard
+    if mode == 'overwrite' and os.path.exists(file_path):
+        os.remove(file_path)
+    for shard_path in glob.glob(glob.escape(file_path) + '.shard*'):
+        image_ids = read_image_ids(shard_path) if mode != 'overwrite' and not shard_path.endswith('.tmp') else None
+        if image_ids is None or not all(str(image_id).isdigit() and int(image_id) in completed for image_id in image_ids):
+            os.remove(shard_path)
+
+
+def merge_shards(hdf5_path=None, recipe_path=None, lease_folder=None, offset=0, limit=0):
+    leases = None
+    merge_name = 'merge_%d_%d' % (offset, limit)
+    if lease_folder is not None:
+        # in coordinator mode, the shards are merged by the first process that gets here once all the ranges are completed
+        # the merge is keyed by the generated indices, so a later run that adds ranges to the same lease folder merges its new shards
+        leases = LeaseManager(lease_folder, config.lease_seconds)
+        if not leases.try_claim(merge_name):
+            return
+        leases.start_renewing()
+    try:
+        if hdf5_path is not None:
+            merge_hdf5_dataset(hdf5_path)
+        if recipe_path is not None:
+            merge_recipes(recipe_path)
+    finally:
+        if leases is not None:
+            leases.stop_renewing()
+    if leases is not None:
+        leases.complete(merge_name)
+
+
+def merge_hdf5_dataset(hdf5_path):
+    shard_paths = get_shard_paths(hdf5_path)
+    if len(shard_paths) > 0:
+        # the images generated by the previous runs are already in the HDF5 file, the new shards are added to them
+        image_count = merge_hdf5_shards(shard_paths, hdf5_path, append=True)
+        print("Saved %d images in %s" % (image_count, hdf5_path))
+
+
+def merge_recipes(recipe_path):
+    shard_paths = get_shard_paths(recipe_path)
+    if len(shard_paths) > 0:
+        recipe_count = merge_recipe_shards(shard_paths, recipe_path, append=True)
+        print("Saved %d scene recipes in %s" % (recipe_count, recipe_path))
+
+
 if __name__ == "__main__":
-    thrd_list = []
-    train_mutex = threading.Lock()
-    valid_mutex = threading.Lock()
-    image_limit = config.train_dataset_generation_limit
-    if image_limit > 0:
-        max_images_per_thread = int(math.ceil(image_limit / config.total_threads))
-        for index in range(config.total_threads):
-            thread = threading.Thread(target=build_dataset,
-                                      args=(config.train_image_folder, config.train_mask_folder, config.train_annotation_folder,
-                                            index, config.total_threads, min(max_images_per_thread, image_limit), train_mutex),
-                                      kwargs={'is_save_mask': False, 'offset': config.train_index_offset})
-            image_limit -= max_images_per_thread
-            thrd_list.append(thread)
-            thread.start()
-
-    image_limit = config.valid_dataset_generation_limit
-    if image_limit > 0:
-        max_images_per_thread = int(math.ceil(image_limit / config.total_threads))
-        for index in range(config.total_threads):
-            thread = threading.Thread(target=build_dataset,
-                                      args=(config.valid_image_folder, config.valid_mask_folder, config.valid_annotation_folder,
-                                            index, config.total_threads, min(max_images_per_thread, image_limit), valid_mutex),
-                                      kwargs={'is_save_mask': False, 'offset': config.valid_index_offset})
-            image_limit -= max_images_per_thread
-            thrd_list.append(thread)
-            thread.start()
-
-    for thrd in thrd_list:
-        thrd.join()
+    stats = DatasetStats()
+    futures = []
+    train_hdf5_path = config.train_hdf5_path if config.write_hdf5_dataset else None
+    valid_hdf5_path = config.valid_hdf5_path if config.write_hdf5_dataset else None
+    if config.mask_format not in ('none', 'image', 'rle'):
+        raise ValueError("Unknown mask format %s, the supported formats are: none, image, rle" % config.mask_format)
+    is_save_mask = config.mask_format == 'image'
+    train_instance_folder = config.train_instance_folder if config.mask_format == 'rle' else None
+    valid_instance_folder = config.valid_instance_folder if config.mask_format == 'rle' else None
+    extra_shapes = get_extra_shapes()
+    train_recipe_path = config.train_recipe_path if config.write_recipes else None
+    valid_recipe_path = config.valid_recipe_path if config.write_recipes else None
+    train_lease_folder = config.train_lease_folder if config.coordinator_mode else None
+    valid_lease_folder = config.valid_lease_folder if config.coordinator_mode else None
+    total_images = 0
+    start_time = time.time()
+    worker_profilers = {}
+    with ProcessPoolExecutor(max_workers=config.total_workers) as executor:
+        if config.train_dataset_generation_limit > 0:
+            split_futures, split_images = generate_dataset(executor, config.train_image_folder, config.train_mask_folder, config.train_annotation_folder,
+                                                           config.train_dataset_generation_limit, offset=config.train_index_offset, seed=config.train_generation_seed,
+                                                           hdf5_path=train_hdf5_path, manifest_path=config.train_manifest_path, mode=config.generation_mode,
+                                                           instance_save_path=train_instance_folder, extra_shapes=extra_shapes, recipe_path=train_recipe_path,
+                                                           lease_folder=train_lease_folder, is_save_mask=is_save_mask)
+            futures += split_futures
+            total_images += split_images
+        if config.valid_dataset_generation_limit > 0:
+            split_futures, split_images = generate_dataset(executor, config.valid_image_folder, config.valid_mask_folder, config.valid_annotation_folder,
+                                                           config.valid_dataset_generation_limit, offset=config.valid_index_offset, seed=config.valid_generation_seed,
+                                                           hdf5_path=valid_hdf5_path, manifest_path=config.valid_manifest_path, mode=config.generation_mode,
+                                                           instance_save_path=valid_instance_folder, extra_shapes=extra_shapes, recipe_path=valid_recipe_path,
+                                                           lease_folder=valid_lease_folder, is_save_mask=is_save_mask)
+            futures += split_futures
+            total_images += split_images
+        # the statistics of each worker are merged once all the images are generated
+        completed_images = 0
+        for future in as_completed(futures):
+            chunk_stats, chunk_size, chunk_profiler = future.result()
+            merge_stats(stats, chunk_stats)
+            worker_profilers.setdefault(chunk_profiler.pid, StageProfiler()).merge(chunk_profiler)
+            completed_images += chunk_size
+            print("Generated %d/%d images" % (completed_images, total_images))
+
+    elapsed = time.time() - start_time
+
+    if config.train_dataset_generation_limit > 0:
+        merge_shards(train_hdf5_path, train_recipe_path, train_lease_folder, config.train_index_offset, config.train_dataset_generation_limit)
+    if config.valid_dataset_generation_limit > 0:
+        merge_shards(valid_hdf5_path, valid_recipe_path, valid_lease_folder, config.valid_index_offset, config.valid_dataset_generation_limit)
+
+    if config.profile_generation:
+        # the stage times are summed over all the workers, so they add up to more than the elapsed time when several workers are used
+        merged_profiler = StageProfiler()
+        for worker_profiler in worker_profilers.values():
+            merged_profiler.merge(worker_profiler)
+        print(format_profile_summary(merged_profiler, elapsed, total_images))
+        if config.profile_output_path is not None:
+            save_profile(config.profile_output_path, worker_profilers, elapsed, total_images)
 
     # report the image with the smallest width, the image with the smallest height and the image with the smallest surface area
-    print("Image with the smallest height (w, h): (%d, %d)" % (stats.minimum_height_img_w, stats.minimum_height_img_h))
-    print("Image with the smallest width (w, h): (%d, %d)" % (stats.minimum_width_img_w, stats.minimum_width_img_h))
-    print("Image with the smallest area (w, h): (%d, %d)" % (stats.minimum_area_img_w, stats.minimum_area_img_h))
+    if stats.minimum_area != np.Inf:
+        print("Image with the smallest height (w, h): (%d, %d)" % (stats.minimum_height_img_w, stats.minimum_height_img_h))
+        print("Image with the smallest width (w, h): (%d, %d)" % (stats.minimum_width_img_w, stats.minimum_width_img_h))
+        print("Image with the smallest area (w, h): (%d, %d)" % (stats.minimum_area_img_w, stats.minimum_area_img_h))
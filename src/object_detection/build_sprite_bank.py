@@ -0,0 +1,24 @@
+import argparse
+import glob
+
+import detection_config as config
+from build_detection_dataset import build_mask
+from utils.sprite_bank import write_sprite_bank
+
+
+# builds the sprite bank used by build_detection_dataset.py when use_sprite_bank is enabled
+# the default arguments use the labels and the source folder from detection_config.py
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Precompute the tight crop and mask of every source fruit image')
+    parser.add_argument('--labels_file', default=config.labels_file)
+    parser.add_argument('--source_folder', default=config.source_dataset_train_folder)
+    parser.add_argument('--output', default=config.sprite_bank_path)
+    parser.add_argument('--mask_threshold', type=int, default=config.mask_threshold)
+    args = parser.parse_args()
+
+    labels_to_images = {}
+    with open(args.labels_file, mode='r') as f:
+        source_labels = [x.strip() for x in f.readlines() if x.strip()]
+    for source_label in source_labels:
+        labels_to_images[source_label.strip('*')] = sorted(glob.glob(args.source_folder + source_label + '/*'))
+    write_sprite_bank(args.output, labels_to_images, lambda image: build_mask(image, threshold=args.mask_threshold))
@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from frcnn import frcnn_config
+
+
+class AnchorGridCache:
+    """
+    LRU cache of the anchor grids, keyed by the size of the image or feature map and by the anchor settings of frcnn_config.
+    The images are resized to a handful of sizes, so the grids are built once per size instead of on every image.
+    The cached arrays are shared between calls, so they are marked as read-only; callers that modify a grid must copy it.
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key, build_function):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+        entry = build_function()
+        for array in entry:
+            array.flags.writeable = False
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+
+anchor_grid_cache = AnchorGridCache(frcnn_config.anchor_grid_cache_size)
+
+
+def get_anchor_settings():
+    return float(frcnn_config.rpn_stride), tuple(frcnn_config.anchor_box_scales), tuple(tuple(ratio) for ratio in frcnn_config.anchor_box_ratios)
+
+
+def get_image_anchors(output_width, output_height, resized_width, resized_height):
+    """
+    Returns the anchors of a resized image, used to compute the RPN targets:
+    boxes - (n, 4) array with the (x1, y1, x2, y2) image coordinates of the anchors that do not cross the image boundaries,
+            in the order (anchor size, anchor ratio, x, y) of the RPN output map
+    positions - (n, 3) array with the (y, x, anchor index) of each box in the output map, where anchor index = ratio index + number of ratios * size index
+    inside - (output_height, output_width, num_anchors) boolean mask of the anchors that do not cross the image boundaries
+    """
+    key = ('image', output_width, output_height, resized_width, resized_height) + get_anchor_settings()
+    return anchor_grid_cache.get(key, lambda: build_image_anchors(output_width, output_height, resized_width, resized_height))
+
+
+def build_image_anchors(output_width, output_height, resized_width, resized_height):
+    downscale = float(frcnn_config.rpn_stride)
+    n_anchratios = len(frcnn_config.anchor_box_ratios)
+    boxes = []
+    positions = []
+    inside = np.zeros((output_height, output_width, frcnn_config.num_anchors), dtype=bool)
+    for anchor_size_idx, anchor_size in enumerate(frcnn_config.anchor_box_scales):
+        for anchor_ratio_idx, anchor_ratio in enumerate(frcnn_config.anchor_box_ratios):
+            anchor_x = anchor_size * anchor_ratio[0]
+            anchor_y = anchor_size * anchor_ratio[1]
+            x1_anc = downscale * (np.arange(output_width) + 0.5) - anchor_x / 2
+            x2_anc = downscale * (np.arange(output_width) + 0.5) + anchor_x / 2
+            y1_anc = downscale * (np.arange(output_height) + 0.5) - anchor_y / 2
+            y2_anc = downscale * (np.arange(output_height) + 0.5) + anchor_y / 2
+            # ignore boxes that go across image boundaries
+            valid_x = np.flatnonzero(np.logical_not(np.logical_or(x1_anc < 0, x2_anc > resized_width)))
+            valid_y = np.flatnonzero(np.logical_not(np.logical_or(y1_anc < 0, y2_anc > resized_height)))
+            ix, jy = np.meshgrid(valid_x, valid_y, indexing='ij')
+            ix, jy = ix.ravel(), jy.ravel()
+            anchor_idx = anchor_ratio_idx + n_anchratios * anchor_size_idx
+            boxes.append(np.stack([x1_anc[ix], y1_anc[jy], x2_anc[ix], y2_anc[jy]], axis=1))
+            positions.append(np.stack([jy, ix, np.full(len(ix), anchor_idx)], axis=1))
+            inside[jy, ix, anchor_idx] = True
+    return np.concatenate(boxes).reshape((-1, 4)), np.concatenate(positions).reshape((-1, 3)).astype(int), inside
+
+
+def get_feature_map_anchors(rows, cols):
+    """
+    Returns the anchors of a (rows, cols) RPN output map in feature map coordinates, used to decode the proposals:
+    a (4, rows, cols, num_anchors) array with the (x, y, w, h) of each anchor, x and y being its top left corner
+    """
+    key = ('feature_map', rows, cols) + get_anchor_settings()
+    return anchor_grid_cache.get(key, lambda: (build_feature_map_anchors(rows, cols),))[0]
+
+
+def build_feature_map_anchors(rows, cols):
+    anchors = np.zeros((4, rows, cols, frcnn_config.num_anchors))
+    X, Y = np.meshgrid(np.arange(cols), np.arange(rows))
+    curr_layer = 0
+    for anchor_size in frcnn_config.anchor_box_scales:
+        for anchor_ratio in frcnn_config.anchor_box_ratios:
+            anchor_x = (anchor_size * anchor_ratio[0]) / frcnn_config.rpn_stride
+            anchor_y = (anchor_size * anchor_ratio[1]) / frcnn_config.rpn_stride
+            anchors[0, :, :, curr_layer] = X - anchor_x / 2
+            anchors[1, :, :, curr_layer] = Y - anchor_y / 2
+            anchors[2, :, :, curr_layer] = anchor_x
+            anchors[3, :, :, curr_layer] = anchor_y
+            curr_layer += 1
+    return anchors
@@ -1,74 +1,104 @@
+from collections import OrderedDict
+
 import cv2
 import numpy as np
-import copy
 from frcnn import frcnn_config
 
 
-def augment(img_data, augment=True):
+class ImageCache:
+    """
+    LRU cache of the decoded images, keyed by their file path, so the images are decoded once and not on every epoch.
+    The cache holds at most max_bytes bytes of pixel data; the least recently used images are evicted first.
+    The returned images are shared between calls, so they are marked as read-only; callers that modify an image must copy it.
+    Each process has its own cache, e.g. every prefetch worker keeps the images it has decoded.
+    """
+
+    def __init__(self, max_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.used_bytes = 0
+
+    def get(self, filepath):
+        image = self.entries.get(filepath)
+        if image is not None:
+            self.entries.move_to_end(filepath)
+            return image
+        image = cv2.imread(filepath)
+        if image is None:
+            raise IOError("Could not read the image %s" % filepath)
+        image.flags.writeable = False
+        if image.nbytes <= self.max_bytes:
+            self.entries[filepath] = image
+            self.used_bytes += image.nbytes
+            while self.used_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.used_bytes -= evicted.nbytes
+        return image
+
+
+image_cache = ImageCache(frcnn_config.image_cache_bytes)
+
+
+def get_box_arrays(img_data):
+    """
+    Returns the boxes of an image as an (n, 4) array of (x1, y1, x2, y2) coordinates and an (n,) array of class indices.
+    The img_data of simple_parser.get_data and of augment store these arrays; the older list of {'class', 'x1', 'y1', 'x2', 'y2'} dicts is converted.
+    """
+    if 'boxes' in img_data:
+        return img_data['boxes'], img_data['classes']
+    bboxes = img_data['bboxes']
+    boxes = np.array([[bbox['x1'], bbox['y1'], bbox['x2'], bbox['y2']] for bbox in bboxes], dtype=int).reshape((-1, 4))
+    classes = np.array([bbox['class'] for bbox in bboxes], dtype=int)
+    return boxes, classes
+
+
+def augment(img_data, augment=True, img=None):
+    # img can be given for images that are not read from the disk, e.g. synthetic scenes composed in memory
+    # the images read from the disk are shared with the image cache and must not be modified
     assert 'filepath' in img_data
-    assert 'bboxes' in img_data
+    assert 'boxes' in img_data or 'bboxes' in img_data
     assert 'width' in img_data
     assert 'height' in img_data
 
-    img_data_aug = copy.deepcopy(img_data)
+    boxes, classes = get_box_arrays(img_data)
+    # the other fields are not modified, so the dict is copied without copying its values
+    img_data_aug = {key: value for key, value in img_data.items() if key != 'bboxes'}
 
-    img = cv2.imread(img_data_aug['filepath'])
+    if img is None:
+        img = image_cache.get(img_data['filepath'])
 
     if augment:
         rows, cols = img.shape[:2]
+        x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
 
         if frcnn_config.use_horizontal_flips and np.random.randint(0, 2) == 0:
             img = cv2.flip(img, 1)
-            for bbox in img_data_aug['bboxes']:
-                x1 = bbox['x1']
-                x2 = bbox['x2']
-                bbox['x2'] = cols - x1
-                bbox['x1'] = cols - x2
+            x1, x2 = cols - x2, cols - x1
 
         if frcnn_config.use_vertical_flips and np.random.randint(0, 2) == 0:
             img = cv2.flip(img, 0)
-            for bbox in img_data_aug['bboxes']:
-                y1 = bbox['y1']
-                y2 = bbox['y2']
-                bbox['y2'] = rows - y1
-                bbox['y1'] = rows - y2
+            y1, y2 = rows - y2, rows - y1
 
         if frcnn_config.random_rotate:
             angle = np.random.choice([0, 90, 180, 270], 1)[0]
             if angle == 270:
                 img = np.transpose(img, (1, 0, 2))
                 img = cv2.flip(img, 0)
+                x1, y1, x2, y2 = y1, cols - x2, y2, cols - x1
             elif angle == 180:
                 img = cv2.flip(img, -1)
+                x1, y1, x2, y2 = cols - x2, rows - y2, cols - x1, rows - y1
             elif angle == 90:
                 img = np.transpose(img, (1, 0, 2))
                 img = cv2.flip(img, 1)
+                x1, y1, x2, y2 = rows - y2, x1, rows - y1, x2
             elif angle == 0:
                 pass
 
-            for bbox in img_data_aug['bboxes']:
-                x1 = bbox['x1']
-                x2 = bbox['x2']
-                y1 = bbox['y1']
-                y2 = bbox['y2']
-                if angle == 270:
-                    bbox['x1'] = y1
-                    bbox['x2'] = y2
-                    bbox['y1'] = cols - x2
-                    bbox['y2'] = cols - x1
-                elif angle == 180:
-                    bbox['x2'] = cols - x1
-                    bbox['x1'] = cols - x2
-                    bbox['y2'] = rows - y1
-                    bbox['y1'] = rows - y2
-                elif angle == 90:
-                    bbox['x1'] = rows - y2
-                    bbox['x2'] = rows - y1
-                    bbox['y1'] = x1
-                    bbox['y2'] = x2
-                elif angle == 0:
-                    pass
+        boxes = np.stack([x1, y1, x2, y2], axis=1)
 
+    img_data_aug['boxes'] = boxes
+    img_data_aug['classes'] = classes
     img_data_aug['width'] = img.shape[1]
     img_data_aug['height'] = img.shape[0]
     return img_data_aug, img
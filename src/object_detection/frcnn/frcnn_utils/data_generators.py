@@ -6,7 +6,7 @@ import math
 from tensorflow.python.keras.utils.data_utils import Sequence
 
 from frcnn import frcnn_config
-from frcnn.frcnn_utils import data_augment
+from frcnn.frcnn_utils import anchor_grids, data_augment
 
 
 def union(au, bu, area_intersection):
@@ -51,127 +51,122 @@ def get_new_img_size(width, height, img_min_side=frcnn_config.img_size):
     return resized_width, resized_height
 
 
+def iou_matrix(boxes_a, boxes_b):
+    """Returns the (len(boxes_a), len(boxes_b)) IoUs of two arrays of (x1, y1, x2, y2) boxes, computed exactly like iou"""
+    a = boxes_a[:, np.newaxis, :]
+    b = boxes_b[np.newaxis, :, :]
+    w = np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    h = np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    area_i = np.where(np.logical_or(w < 0, h < 0), 0, w * h)
+    area_u = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1]) + (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1]) - area_i
+    degenerate = np.logical_or(np.logical_or(a[..., 0] >= a[..., 2], a[..., 1] >= a[..., 3]), np.logical_or(b[..., 0] >= b[..., 2], b[..., 1] >= b[..., 3]))
+    # the IoUs of the degenerate boxes are replaced by 0, like in iou
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(degenerate, 0.0, area_i / (area_u + 1e-6))
+
+
+def calc_regression(gta, anchors):
+    """Returns the (tx, ty, tw, th) targets of GT boxes in (x1, x2, y1, y2) format relative to anchors in (x1, y1, x2, y2) format; tw and th are not logs yet"""
+    x1_anc, y1_anc, x2_anc, y2_anc = anchors[:, 0], anchors[:, 1], anchors[:, 2], anchors[:, 3]
+    cx = (gta[:, 0] + gta[:, 1]) / 2.0
+    cy = (gta[:, 2] + gta[:, 3]) / 2.0
+    cxa = (x1_anc + x2_anc) / 2.0
+    cya = (y1_anc + y2_anc) / 2.0
+    tx = (cx - cxa) / (x2_anc - x1_anc)
+    ty = (cy - cya) / (y2_anc - y1_anc)
+    tw = 1.0 * (gta[:, 1] - gta[:, 0]) / (x2_anc - x1_anc)
+    th = 1.0 * (gta[:, 3] - gta[:, 2]) / (y2_anc - y1_anc)
+    return np.stack([tx, ty, tw, th], axis=1)
+
+
+def find_best_anchor(ious):
+    """
+    Returns the position of the anchor that the original loop over the anchors kept as the best anchor of a GT box, or -1 if no anchor overlaps it.
+    The loop kept the best IoU in a float32 array and replaced the best anchor whenever an IoU was greater than the stored value,
+    so it keeps the first anchor whose IoU rounds to the maximum IoU, unless later anchors have IoUs above the rounded value; the last of those wins.
+    """
+    if len(ious) == 0 or not ious.max() > 0:
+        return -1
+    best_iou = np.float64(np.float32(ious.max()))
+    above = np.flatnonzero(ious > best_iou)
+    if len(above) > 0:
+        return above[-1]
+    return np.flatnonzero(ious.astype(np.float32) == np.float32(best_iou))[0]
+
+
 def calc_rpn(img_data, width, height, resized_width, resized_height, img_length_calc_function):
-    downscale = float(frcnn_config.rpn_stride)
-    anchor_sizes = frcnn_config.anchor_box_scales
-    anchor_ratios = frcnn_config.anchor_box_ratios
+    """
+    Computes the RPN targets of an image with array operations over all the (anchor, GT box) pairs at once.
+    The targets are bit-identical to the original loop over the anchors and boxes (kept in frcnn/benchmark_calc_rpn.py).
+    """
+    y_rpn_overlap, y_is_box_valid, y_rpn_regr = calc_rpn_targets(img_data, width, height, resized_width, resized_height, img_length_calc_function)
+    return sample_rpn_regions(y_rpn_overlap, y_is_box_valid, y_rpn_regr)
+
+
+def calc_rpn_targets(img_data, width, height, resized_width, resized_height, img_length_calc_function):
+    """
+    Returns the targets of all the anchors, before the regions are subsampled: y_rpn_overlap and y_is_box_valid with the shape
+    (1, num_anchors, output_height, output_width) and y_rpn_regr with the shape (1, 4 * num_anchors, output_height, output_width).
+    The targets only depend on the image size and boxes, so they can be cached for the images that are not augmented (see RpnTargetCache).
+    """
     num_anchors = frcnn_config.num_anchors
 
     # calculate the output map size based on the network architecture
 
     (output_width, output_height) = img_length_calc_function(resized_width, resized_height)
 
-    n_anchratios = len(anchor_ratios)
-
     # initialise empty output objectives
     y_rpn_overlap = np.zeros((output_height, output_width, num_anchors)).astype(float)
     y_is_box_valid = np.zeros((output_height, output_width, num_anchors)).astype(float)
     y_rpn_regr = np.zeros((output_height, output_width, num_anchors * 4)).astype(float)
 
-    num_bboxes = len(img_data['bboxes'])
+    boxes, classes = data_augment.get_box_arrays(img_data)
+    num_bboxes = len(boxes)
 
     num_anchors_for_bbox = np.zeros(num_bboxes).astype(int)
-    best_anchor_for_bbox = -1 * np.ones((num_bboxes, 4)).astype(int)
-    best_iou_for_bbox = np.zeros(num_bboxes).astype(np.float32)
-    best_x_for_bbox = np.zeros((num_bboxes, 4))
+    best_anchor_for_bbox = -1 * np.ones((num_bboxes, 3)).astype(int)
     best_dx_for_bbox = np.zeros((num_bboxes, 4))
 
     # get the GT box coordinates, and resize to account for image resizing
-    gta = np.zeros((num_bboxes, 4))
-    for bbox_num, bbox in enumerate(img_data['bboxes']):
-        # get the GT box coordinates, and resize to account for image resizing
-        gta[bbox_num, 0] = bbox['x1'] * (resized_width / float(width))
-        gta[bbox_num, 1] = bbox['x2'] * (resized_width / float(width))
-        gta[bbox_num, 2] = bbox['y1'] * (resized_height / float(height))
-        gta[bbox_num, 3] = bbox['y2'] * (resized_height / float(height))
+    # gta columns are (x1, x2, y1, y2)
+    gta = boxes[:, (0, 2, 1, 3)] * np.array([resized_width / float(width), resized_width / float(width),
+                                             resized_height / float(height), resized_height / float(height)])
 
     # rpn ground truth
 
-    for anchor_size_idx in range(len(anchor_sizes)):
-        for anchor_ratio_idx in range(n_anchratios):
-            anchor_x = anchor_sizes[anchor_size_idx] * anchor_ratios[anchor_ratio_idx][0]
-            anchor_y = anchor_sizes[anchor_size_idx] * anchor_ratios[anchor_ratio_idx][1]
-
-            for ix in range(output_width):
-                # x-coordinates of the current anchor box
-                x1_anc = downscale * (ix + 0.5) - anchor_x / 2
-                x2_anc = downscale * (ix + 0.5) + anchor_x / 2
-
-                # ignore boxes that go across image boundaries
-                if x1_anc < 0 or x2_anc > resized_width:
-                    continue
-
-                for jy in range(output_height):
-
-                    # y-coordinates of the current anchor box
-                    y1_anc = downscale * (jy + 0.5) - anchor_y / 2
-                    y2_anc = downscale * (jy + 0.5) + anchor_y / 2
-
-                    # ignore boxes that go across image boundaries
-                    if y1_anc < 0 or y2_anc > resized_height:
-                        continue
-
-                    # bbox_type indicates whether an anchor should be a target
-                    bbox_type = 'neg'
-
-                    # this is the best IOU for the (x,y) coord and the current anchor
-                    # note that this is different from the best IOU for a GT bbox
-                    best_iou_for_loc = 0.0
-                    best_regr = [0, 0, 0, 0]
-
-                    for bbox_num in range(num_bboxes):
-
-                        # get IOU of the current GT box and the current anchor box
-                        curr_iou = iou([gta[bbox_num, 0], gta[bbox_num, 2], gta[bbox_num, 1], gta[bbox_num, 3]], [x1_anc, y1_anc, x2_anc, y2_anc])
-                        # calculate the regression targets if they will be needed
-                        if curr_iou > best_iou_for_bbox[bbox_num] or curr_iou > frcnn_config.rpn_max_overlap:
-                            cx = (gta[bbox_num, 0] + gta[bbox_num, 1]) / 2.0
-                            cy = (gta[bbox_num, 2] + gta[bbox_num, 3]) / 2.0
-                            cxa = (x1_anc + x2_anc) / 2.0
-                            cya = (y1_anc + y2_anc) / 2.0
-
-                            tx = (cx - cxa) / (x2_anc - x1_anc)
-                            ty = (cy - cya) / (y2_anc - y1_anc)
-                            # calculate log of tw and th later
-                            tw = 1.0 * (gta[bbox_num, 1] - gta[bbox_num, 0]) / (x2_anc - x1_anc)
-                            th = 1.0 * (gta[bbox_num, 3] - gta[bbox_num, 2]) / (y2_anc - y1_anc)
-
-                        if frcnn_config.fruit_labels[img_data['bboxes'][bbox_num]['class']] != frcnn_config.bg:
-                            # all GT boxes should be mapped to an anchor box, so we keep track of which anchor box was best
-                            if curr_iou > best_iou_for_bbox[bbox_num]:
-                                best_anchor_for_bbox[bbox_num] = [jy, ix, anchor_ratio_idx, anchor_size_idx]
-                                best_iou_for_bbox[bbox_num] = curr_iou
-                                best_x_for_bbox[bbox_num, :] = [x1_anc, x2_anc, y1_anc, y2_anc]
-                                best_dx_for_bbox[bbox_num, :] = [tx, ty, tw, th]
-
-                            # we set the anchor to positive if the IOU is >0.7 (it does not matter if there was another better box, it just indicates overlap)
-                            if curr_iou > frcnn_config.rpn_max_overlap:
-                                bbox_type = 'pos'
-                                num_anchors_for_bbox[bbox_num] += 1
-                                # we update the regression layer target if this IOU is the best for the current (x,y) and anchor position
-                                if curr_iou > best_iou_for_loc:
-                                    best_iou_for_loc = curr_iou
-                                    best_regr = (tx, ty, tw, th)
-
-                            # if the IOU is >0.3 and <0.7, it is ambiguous and no included in the objective
-                            if frcnn_config.rpn_min_overlap < curr_iou < frcnn_config.rpn_max_overlap:
-                                # gray zone between neg and pos
-                                if bbox_type != 'pos':
-                                    bbox_type = 'neutral'
-
-                    # turn on or off outputs depending on IOUs
-                    if bbox_type == 'neg':
-                        y_is_box_valid[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 1
-                        y_rpn_overlap[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 0
-                    elif bbox_type == 'neutral':
-                        y_is_box_valid[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 0
-                        y_rpn_overlap[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 0
-                    elif bbox_type == 'pos':
-                        y_is_box_valid[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 1
-                        y_rpn_overlap[jy, ix, anchor_ratio_idx + n_anchratios * anchor_size_idx] = 1
-                        start = 4 * (anchor_ratio_idx + n_anchratios * anchor_size_idx)
-                        y_rpn_regr[jy, ix, start:start + 2] = best_regr[0:2]
-                        y_rpn_regr[jy, ix, start + 2:start + 4] = np.log(best_regr[2:])
+    anchors, anchor_positions, _ = anchor_grids.get_image_anchors(output_width, output_height, resized_width, resized_height)
+    # the background boxes are not targets
+    gt_indices = np.flatnonzero(np.array([frcnn_config.fruit_labels[class_index] != frcnn_config.bg for class_index in classes], dtype=bool))
+    gt_boxes = gta[gt_indices][:, (0, 2, 1, 3)].reshape((-1, 4))
+    ious = iou_matrix(anchors, gt_boxes)
+
+    # we set the anchor to positive if the IOU is >0.7 with any GT box (it does not matter if there was another better box, it just indicates overlap)
+    is_pos_pair = ious > frcnn_config.rpn_max_overlap
+    is_pos = np.any(is_pos_pair, axis=1)
+    # if the IOU is >0.3 and <0.7, it is ambiguous and no included in the objective
+    is_neutral = np.logical_and(np.logical_not(is_pos), np.any(np.logical_and(frcnn_config.rpn_min_overlap < ious, ious < frcnn_config.rpn_max_overlap), axis=1))
+    is_neg = np.logical_not(np.logical_or(is_pos, is_neutral))
+    num_anchors_for_bbox[gt_indices] = np.sum(is_pos_pair, axis=0)
+
+    # turn on or off outputs depending on IOUs
+    valid_positions = anchor_positions[np.logical_or(is_pos, is_neg)]
+    y_is_box_valid[valid_positions[:, 0], valid_positions[:, 1], valid_positions[:, 2]] = 1
+    pos_positions = anchor_positions[is_pos]
+    y_rpn_overlap[pos_positions[:, 0], pos_positions[:, 1], pos_positions[:, 2]] = 1
+    if len(pos_positions) > 0:
+        # the regression target of a positive anchor is the GT box with the best IOU for it
+        best_gt = np.argmax(np.where(is_pos_pair[is_pos], ious[is_pos], -1), axis=1)
+        best_regr = calc_regression(gta[gt_indices[best_gt]], anchors[is_pos])
+        best_regr[:, 2:] = np.log(best_regr[:, 2:])
+        for k in range(4):
+            y_rpn_regr[pos_positions[:, 0], pos_positions[:, 1], 4 * pos_positions[:, 2] + k] = best_regr[:, k]
+
+    # all GT boxes should be mapped to an anchor box, so we keep track of which anchor box was best
+    for column, bbox_num in enumerate(gt_indices):
+        best_anchor = find_best_anchor(ious[:, column])
+        if best_anchor != -1:
+            best_anchor_for_bbox[bbox_num] = anchor_positions[best_anchor]
+            best_dx_for_bbox[bbox_num, :] = calc_regression(gta[bbox_num:bbox_num + 1], anchors[best_anchor:best_anchor + 1])[0]
 
     # we ensure that every bbox has at least one positive RPN region
 
@@ -180,11 +175,11 @@ def calc_rpn(img_data, width, height, resized_width, resized_height, img_length_
             # no box with an IOU greater than zero ...
             if best_anchor_for_bbox[idx, 0] == -1:
                 continue
-            y_is_box_valid[best_anchor_for_bbox[idx, 0], best_anchor_for_bbox[idx, 1], best_anchor_for_bbox[idx, 2] + n_anchratios * best_anchor_for_bbox[idx, 3]] = 1
-            y_rpn_overlap[best_anchor_for_bbox[idx, 0], best_anchor_for_bbox[idx, 1], best_anchor_for_bbox[idx, 2] + n_anchratios * best_anchor_for_bbox[idx, 3]] = 1
-            start = 4 * (best_anchor_for_bbox[idx, 2] + n_anchratios * best_anchor_for_bbox[idx, 3])
-            y_rpn_regr[best_anchor_for_bbox[idx, 0], best_anchor_for_bbox[idx, 1], start:start + 2] = best_dx_for_bbox[idx, 0:2]
-            y_rpn_regr[best_anchor_for_bbox[idx, 0], best_anchor_for_bbox[idx, 1], start + 2:start + 4] = np.log(best_dx_for_bbox[idx, 2:4])
+            jy, ix, anchor_idx = best_anchor_for_bbox[idx]
+            y_is_box_valid[jy, ix, anchor_idx] = 1
+            y_rpn_overlap[jy, ix, anchor_idx] = 1
+            y_rpn_regr[jy, ix, 4 * anchor_idx:4 * anchor_idx + 2] = best_dx_for_bbox[idx, 0:2]
+            y_rpn_regr[jy, ix, 4 * anchor_idx + 2:4 * anchor_idx + 4] = np.log(best_dx_for_bbox[idx, 2:4])
 
     y_rpn_overlap = np.transpose(y_rpn_overlap, (2, 0, 1))
     y_rpn_overlap = np.expand_dims(y_rpn_overlap, axis=0)
@@ -195,6 +190,11 @@ def calc_rpn(img_data, width, height, resized_width, resized_height, img_length_
     y_rpn_regr = np.transpose(y_rpn_regr, (2, 0, 1))
     y_rpn_regr = np.expand_dims(y_rpn_regr, axis=0)
 
+    return y_rpn_overlap, y_is_box_valid, y_rpn_regr
+
+
+def sample_rpn_regions(y_rpn_overlap, y_is_box_valid, y_rpn_regr):
+    # keeps at most 256 random regions, half of them positive if possible; y_is_box_valid is modified in place
     pos_locs = np.where(np.logical_and(y_rpn_overlap[0, :, :, :] == 1, y_is_box_valid[0, :, :, :] == 1))
     neg_locs = np.where(np.logical_and(y_rpn_overlap[0, :, :, :] == 0, y_is_box_valid[0, :, :, :] == 1))
 
@@ -220,7 +220,7 @@ def calc_rpn(img_data, width, height, resized_width, resized_height, img_length_
     return np.copy(y_rpn_cls), np.copy(y_rpn_regr)
 
 
-def get_anchor_gt(all_img_data, img_length_calc_function, augment=True, shuffle=True):
+def get_anchor_gt(all_img_data, img_length_calc_function, augment=True, shuffle=True, target_cache=None):
     # The following line is not useful with Python 3.5, it is kept for the legacy
     # all_img_data = sorted(all_img_data)
 
@@ -230,26 +230,67 @@ def get_anchor_gt(all_img_data, img_length_calc_function, augment=True, shuffle=
 
         for img_data in all_img_data:
             try:
-                # read in image, and optionally add augmentation
-                height, width, resized_height, resized_width, img_data_aug, x_img = augment_and_resize_image(img_data, augment=augment)
-
-                try:
-                    y_rpn_cls, y_rpn_regr = calc_rpn(img_data_aug, width, height, resized_width, resized_height, img_length_calc_function)
-                except:
+                sample = build_anchor_gt_sample(img_data, img_length_calc_function, augment=augment, target_cache=target_cache)
+                if sample is None:
                     continue
 
-                x_img, y_rpn_cls, y_rpn_regr = arrange_dims(x_img, y_rpn_cls, y_rpn_regr)
-
-                yield np.copy(x_img), [np.copy(y_rpn_cls), np.copy(y_rpn_regr)], img_data_aug
+                yield sample
 
             except Exception as e:
                 print(e)
                 continue
 
 
+def build_anchor_gt_sample(img_data, img_length_calc_function, augment=True, target_cache=None):
+    # returns the (X, [Y_cls, Y_regr], img_data) sample of an image, or None if its RPN targets cannot be computed
+    # target_cache (an RpnTargetCache) is only used for the images that are not augmented, the targets of the augmented images change on every call
+    # read in image, and optionally add augmentation
+    height, width, resized_height, resized_width, img_data_aug, x_img = augment_and_resize_image(img_data, augment=augment)
+
+    try:
+        if target_cache is not None and not augment:
+            y_rpn_cls, y_rpn_regr = target_cache.calc_rpn(img_data_aug, width, height, resized_width, resized_height, img_length_calc_function)
+        else:
+            y_rpn_cls, y_rpn_regr = calc_rpn(img_data_aug, width, height, resized_width, resized_height, img_length_calc_function)
+    except:
+        return None
+
+    x_img, y_rpn_cls, y_rpn_regr = arrange_dims(x_img, y_rpn_cls, y_rpn_regr)
+
+    return np.copy(x_img), [np.copy(y_rpn_cls), np.copy(y_rpn_regr)], img_data_aug
+
+
+def scene_to_img_data(image, labels):
+    # converts a sample of a SyntheticSceneSource to the img_data format returned by simple_parser.get_data
+    labels = np.array(labels, dtype=int).reshape((-1, 5))
+    return {'filepath': None, 'width': image.shape[1], 'height': image.shape[0], 'boxes': labels[:, 1:], 'classes': labels[:, 0], 'imageset': 'train'}
+
+
+def get_synthetic_anchor_gt(scene_source, img_length_calc_function, augment=True):
+    # same as get_anchor_gt, but the images are synthetic scenes composed in memory by a SyntheticSceneSource (with rgb=False)
+    for image, labels in scene_source:
+        if len(labels) == 0:
+            continue
+        try:
+            height, width, resized_height, resized_width, img_data_aug, x_img = augment_and_resize_image(scene_to_img_data(image, labels), augment=augment, img=image)
+            y_rpn_cls, y_rpn_regr = calc_rpn(img_data_aug, width, height, resized_width, resized_height, img_length_calc_function)
+            x_img, y_rpn_cls, y_rpn_regr = arrange_dims(x_img, y_rpn_cls, y_rpn_regr)
+            yield np.copy(x_img), [np.copy(y_rpn_cls), np.copy(y_rpn_regr)], img_data_aug
+        except Exception as e:
+            print(e)
+            continue
+
+
 class CustomDataGenerator(Sequence):
-    def __init__(self, all_imgs, img_length_calc_function, batch_size=5, augment=True, shuffle=True):
+    # if scene_source is given (a SyntheticSceneSource with rgb=False), each batch is made of new synthetic scenes instead of the images in all_imgs
+    # all_imgs is then only used to determine the number of batches in an epoch
+    # if prefetcher is given (a prefetch.ParallelAnchorGenerator), the samples of each batch are taken from it, in the order it returns them
+    # target_cache (an RpnTargetCache) is used for the images in all_imgs if augment is False
+    def __init__(self, all_imgs, img_length_calc_function, batch_size=5, augment=True, shuffle=True, scene_source=None, prefetcher=None, target_cache=None):
         self.all_imgs = all_imgs
+        self.scene_source = scene_source
+        self.prefetcher = prefetcher
+        self.target_cache = target_cache
         self.indexes = np.arange(len(self.all_imgs))
         self.img_length_calc_function = img_length_calc_function
         self.batch_size = batch_size  # batch size
@@ -277,9 +318,23 @@ class CustomDataGenerator(Sequence):
         y_rpn_regr_targets = []
         class_weights = []
         for index in indexes:
-            height, width, resized_height, resized_width, img_data_aug, x_img = augment_and_resize_image(self.all_imgs[index], augment=self.augment)
+            if self.prefetcher is not None:
+                x_img, (y_rpn_cls, y_rpn_regr), _ = next(self.prefetcher)
+                x_imgs.append(x_img)
+                y_rpn_cls_targets.append(y_rpn_cls)
+                y_rpn_regr_targets.append(y_rpn_regr)
+                class_weights.append([None, None])
+                continue
+            if self.scene_source is not None:
+                image, labels = next(self.scene_source)
+                height, width, resized_height, resized_width, img_data_aug, x_img = augment_and_resize_image(scene_to_img_data(image, labels), augment=self.augment, img=image)
+            else:
+                height, width, resized_height, resized_width, img_data_aug, x_img = augment_and_resize_image(self.all_imgs[index], augment=self.augment)
             try:
-                y_rpn_cls, y_rpn_regr = calc_rpn(img_data_aug, width, height, resized_width, resized_height, self.img_length_calc_function)
+                if self.target_cache is not None and not self.augment and self.scene_source is None:
+                    y_rpn_cls, y_rpn_regr = self.target_cache.calc_rpn(img_data_aug, width, height, resized_width, resized_height, self.img_length_calc_function)
+                else:
+                    y_rpn_cls, y_rpn_regr = calc_rpn(img_data_aug, width, height, resized_width, resized_height, self.img_length_calc_function)
             except Exception as e:
                 print("Error in generator: " + str(e))
                 continue
@@ -302,8 +357,8 @@ class CustomDataGenerator(Sequence):
         return x_imgs, [y_rpn_cls_targets, y_rpn_regr_targets]
 
 
-def augment_and_resize_image(img_data, augment=True):
-    img_data_aug, x_img = data_augment.augment(img_data, augment=augment)
+def augment_and_resize_image(img_data, augment=True, img=None):
+    img_data_aug, x_img = data_augment.augment(img_data, augment=augment, img=img)
     (width, height) = (img_data_aug['width'], img_data_aug['height'])
     (rows, cols, _) = x_img.shape
     assert cols == width
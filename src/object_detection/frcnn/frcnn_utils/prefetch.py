@@ -0,0 +1,162 @@
+import multiprocessing
+import queue
+import random
+import time
+
+import numpy as np
+
+from frcnn.frcnn_utils import data_generators
+
+
+def prefetch_worker(worker_seed, img_length_calc_function, augment, target_cache, task_queue, result_queue, stop_event):
+    # the workers start with the random state of the parent process, they are reseeded so they do not apply the same augmentations and region sampling
+    random.seed(worker_seed)
+    np.random.seed(random.getrandbits(32))
+    while True:
+        task = task_queue.get()
+        if task is None or stop_event.is_set():
+            break
+        sequence_number, img_data = task
+        try:
+            sample = data_generators.build_anchor_gt_sample(img_data, img_length_calc_function, augment=augment, target_cache=target_cache)
+        except Exception as e:
+            print(e)
+            sample = None
+        result_queue.put((sequence_number, sample))
+
+
+class ParallelAnchorGenerator:
+    """
+    Infinite iterator over the same (X, [Y_cls, Y_regr], img_data) samples as data_generators.get_anchor_gt, computed by worker processes:
+    each worker reads an image, augments and resizes it and computes its RPN targets, while the training loop uses the previous samples.
+    At most prefetch_size images are in flight (queued, being processed or waiting to be returned).
+    If ordered is True, the samples are returned in the order of the images, like get_anchor_gt; otherwise they are returned as soon as they are ready.
+    The samples whose targets cannot be computed are skipped. A worker that dies is replaced, and the images it was processing are processed again.
+    close() stops the workers; the generator can also be used as a context manager.
+    """
+
+    def __init__(self, all_img_data, img_length_calc_function, augment=True, shuffle=True, workers=4, prefetch_size=16, ordered=True, seed=None,
+                 start_method=None, target_cache=None):
+        if len(all_img_data) == 0:
+            raise ValueError("There are no images to generate samples from")
+        self.all_img_data = all_img_data
+        self.img_length_calc_function = img_length_calc_function
+        self.augment = augment
+        self.target_cache = target_cache
+        self.shuffle = shuffle
+        self.workers = workers
+        self.ordered = ordered
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        self.context = multiprocessing.get_context(start_method)
+        self.images = self.image_order()
+        self.outstanding = {}  # sequence number -> img_data of the images that were submitted and not returned yet
+        self.ready = {}  # sequence number -> sample, for the samples that arrived before their turn in ordered mode
+        self.next_task = 0
+        self.next_result = 0
+        self.restarts = 0
+        self.processes = []
+        self.closed = False
+        self.start_workers()
+        for _ in range(prefetch_size):
+            self.submit()
+
+    def image_order(self):
+        while True:
+            if self.shuffle:
+                np.random.shuffle(self.all_img_data)
+            for img_data in self.all_img_data:
+                yield img_data
+
+    def start_workers(self):
+        self.task_queue = self.context.Queue()
+        self.result_queue = self.context.Queue()
+        self.stop_event = self.context.Event()
+        self.processes = [self.context.Process(target=prefetch_worker, daemon=True,
+                                               args=('%s:%d:%d' % (self.seed, self.restarts, worker_index), self.img_length_calc_function, self.augment,
+                                                     self.target_cache, self.task_queue, self.result_queue, self.stop_event))
+                          for worker_index in range(self.workers)]
+        for process in self.processes:
+            process.start()
+
+    def submit(self):
+        img_data = next(self.images)
+        self.outstanding[self.next_task] = img_data
+        self.task_queue.put((self.next_task, img_data))
+        self.next_task += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            if self.closed:
+                raise StopIteration
+            sample = self.get_result()
+            # a new image is submitted for each returned one, so the number of images in flight stays the same
+            self.submit()
+            if sample is not None:
+                return sample
+
+    def get_result(self):
+        if not self.ordered:
+            sequence_number, sample = self.receive()
+            return sample
+        while self.next_result not in self.ready:
+            sequence_number, sample = self.receive()
+            self.ready[sequence_number] = sample
+        sample = self.ready.pop(self.next_result)
+        self.next_result += 1
+        return sample
+
+    def receive(self):
+        while True:
+            try:
+                sequence_number, sample = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    self.restart_workers()
+                continue
+            if sequence_number in self.outstanding:
+                del self.outstanding[sequence_number]
+                return sequence_number, sample
+
+    def restart_workers(self):
+        """Replaces all the workers and submits again the images whose samples were not received, e.g. because a worker was killed"""
+        print("A prefetch worker died, restarting the workers")
+        self.stop_workers()
+        self.restarts += 1
+        self.start_workers()
+        for sequence_number in sorted(self.outstanding):
+            self.task_queue.put((sequence_number, self.outstanding[sequence_number]))
+
+    def stop_workers(self, timeout=10.0):
+        self.stop_event.set()
+        for _ in self.processes:
+            self.task_queue.put(None)
+        # the pending results are read and discarded, otherwise a worker that still has results to send could not exit
+        deadline = time.time() + timeout
+        while any(process.is_alive() for process in self.processes) and time.time() < deadline:
+            try:
+                self.result_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        for worker_queue in (self.task_queue, self.result_queue):
+            worker_queue.cancel_join_thread()
+            worker_queue.close()
+        self.processes = []
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.stop_workers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
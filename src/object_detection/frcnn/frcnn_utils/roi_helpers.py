@@ -1,24 +1,19 @@
 import numpy as np
 import math
-from frcnn.frcnn_utils import data_generators
+from frcnn.frcnn_utils import anchor_grids, data_augment, data_generators
 import copy
 from frcnn import frcnn_config
 
 
 def calc_iou(R, img_data):
-    bboxes = img_data['bboxes']
+    boxes, classes = data_augment.get_box_arrays(img_data)
     (width, height) = (img_data['width'], img_data['height'])
     # get image dimensions for resizing
     (resized_width, resized_height) = data_generators.get_new_img_size(width, height, frcnn_config.img_size)
 
-    gta = np.zeros((len(bboxes), 4))
-
-    for bbox_num, bbox in enumerate(bboxes):
-        # get the GT box coordinates, and resize to account for image resizing
-        gta[bbox_num, 0] = int(round(bbox['x1'] * (resized_width / float(width)) / frcnn_config.rpn_stride))
-        gta[bbox_num, 1] = int(round(bbox['x2'] * (resized_width / float(width)) / frcnn_config.rpn_stride))
-        gta[bbox_num, 2] = int(round(bbox['y1'] * (resized_height / float(height)) / frcnn_config.rpn_stride))
-        gta[bbox_num, 3] = int(round(bbox['y2'] * (resized_height / float(height)) / frcnn_config.rpn_stride))
+    # get the GT box coordinates, and resize to account for image resizing; gta columns are (x1, x2, y1, y2)
+    gta = np.round(boxes[:, (0, 2, 1, 3)] * np.array([resized_width / float(width), resized_width / float(width),
+                                                      resized_height / float(height), resized_height / float(height)]) / frcnn_config.rpn_stride)
 
     x_roi = []
     y_class_num = []
@@ -35,7 +30,7 @@ def calc_iou(R, img_data):
 
         best_iou = 0.0
         best_bbox = -1
-        for bbox_num in range(len(bboxes)):
+        for bbox_num in range(len(boxes)):
             curr_iou = data_generators.iou([gta[bbox_num, 0], gta[bbox_num, 2], gta[bbox_num, 1], gta[bbox_num, 3]], [x1, y1, x2, y2])
             if curr_iou > best_iou:
                 best_iou = curr_iou
@@ -53,7 +48,7 @@ def calc_iou(R, img_data):
                 # hard negative example
                 cls_index = frcnn_config.fruit_labels.index(frcnn_config.bg)
             elif frcnn_config.classifier_max_overlap <= best_iou:
-                cls_index = bboxes[best_bbox]['class']
+                cls_index = int(classes[best_bbox])
                 cxg = (gta[best_bbox, 0] + gta[best_bbox, 1]) / 2.0
                 cyg = (gta[best_bbox, 2] + gta[best_bbox, 3]) / 2.0
 
@@ -224,46 +219,29 @@ def non_max_suppression_fast(boxes, probs, overlap_thresh=0.9, max_boxes=300):
 def rpn_to_roi(rpn_layer, regr_layer, use_regr=True, max_boxes=300, overlap_thresh=0.9):
     regr_layer = regr_layer / frcnn_config.std_scaling
 
-    anchor_sizes = frcnn_config.anchor_box_scales
-    anchor_ratios = frcnn_config.anchor_box_ratios
-
     assert rpn_layer.shape[0] == 1
 
     (rows, cols) = rpn_layer.shape[1:3]
 
-    curr_layer = 0
-    A = np.zeros((4, rpn_layer.shape[1], rpn_layer.shape[2], rpn_layer.shape[3]))
+    # the anchors of each output map size are built once, the copy is modified in place
+    A = anchor_grids.get_feature_map_anchors(rows, cols).copy()
     # TODO: check correctness
-    for anchor_size in anchor_sizes:
-        for anchor_ratio in anchor_ratios:
-
-            anchor_x = (anchor_size * anchor_ratio[0]) / frcnn_config.rpn_stride
-            anchor_y = (anchor_size * anchor_ratio[1]) / frcnn_config.rpn_stride
-
-            regr = regr_layer[0, :, :, 4 * curr_layer:4 * (curr_layer + 1)]
-            regr = np.transpose(regr, (2, 0, 1))
-
-            X, Y = np.meshgrid(np.arange(cols), np.arange(rows))
-
-            A[0, :, :, curr_layer] = X - anchor_x / 2
-            A[1, :, :, curr_layer] = Y - anchor_y / 2
-            A[2, :, :, curr_layer] = anchor_x
-            A[3, :, :, curr_layer] = anchor_y
-
-            if use_regr:
-                A[:, :, :, curr_layer] = apply_regr_np(A[:, :, :, curr_layer], regr)
-
-            A[2, :, :, curr_layer] = np.maximum(1, A[2, :, :, curr_layer])
-            A[3, :, :, curr_layer] = np.maximum(1, A[3, :, :, curr_layer])
-            A[2, :, :, curr_layer] += A[0, :, :, curr_layer]
-            A[3, :, :, curr_layer] += A[1, :, :, curr_layer]
-
-            A[0, :, :, curr_layer] = np.maximum(0, A[0, :, :, curr_layer])
-            A[1, :, :, curr_layer] = np.maximum(0, A[1, :, :, curr_layer])
-            A[2, :, :, curr_layer] = np.minimum(cols - 1, A[2, :, :, curr_layer])
-            A[3, :, :, curr_layer] = np.minimum(rows - 1, A[3, :, :, curr_layer])
-
-            curr_layer += 1
+    for curr_layer in range(A.shape[3]):
+        regr = regr_layer[0, :, :, 4 * curr_layer:4 * (curr_layer + 1)]
+        regr = np.transpose(regr, (2, 0, 1))
+
+        if use_regr:
+            A[:, :, :, curr_layer] = apply_regr_np(A[:, :, :, curr_layer], regr)
+
+        A[2, :, :, curr_layer] = np.maximum(1, A[2, :, :, curr_layer])
+        A[3, :, :, curr_layer] = np.maximum(1, A[3, :, :, curr_layer])
+        A[2, :, :, curr_layer] += A[0, :, :, curr_layer]
+        A[3, :, :, curr_layer] += A[1, :, :, curr_layer]
+
+        A[0, :, :, curr_layer] = np.maximum(0, A[0, :, :, curr_layer])
+        A[1, :, :, curr_layer] = np.maximum(0, A[1, :, :, curr_layer])
+        A[2, :, :, curr_layer] = np.minimum(cols - 1, A[2, :, :, curr_layer])
+        A[3, :, :, curr_layer] = np.minimum(rows - 1, A[3, :, :, curr_layer])
 
     all_boxes = np.reshape(A.transpose((0, 3, 1, 2)), (4, -1)).transpose((1, 0))
     all_probs = rpn_layer.transpose((0, 3, 1, 2)).reshape((-1))
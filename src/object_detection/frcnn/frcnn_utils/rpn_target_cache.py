@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from frcnn import frcnn_config
+from frcnn.frcnn_utils import data_augment, data_generators
+
+
+class RpnTargetCache:
+    """
+    Disk cache of the RPN targets of the images that are not augmented (e.g. the validation and test images), which are the same on every epoch.
+    The targets of all the anchors are computed once and saved in the cache folder; on the next epochs they are memory-mapped from the files,
+    and only the random subsampling of the 256 regions is applied again, so the targets are still different on each epoch.
+    The files are keyed by the image path, the image and resized sizes, the boxes and the anchor and overlap settings,
+    so changing any of them makes the targets be computed again.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    def get_key(self, img_data, width, height, resized_width, resized_height, output_size):
+        boxes, classes = data_augment.get_box_arrays(img_data)
+        description = {'filepath': img_data['filepath'], 'size': [width, height, resized_width, resized_height], 'output_size': list(output_size),
+                       'bboxes': np.column_stack([classes, boxes]).astype(int).tolist(),
+                       'labels': list(frcnn_config.fruit_labels), 'bg': frcnn_config.bg, 'rpn_stride': frcnn_config.rpn_stride,
+                       'anchor_box_scales': list(frcnn_config.anchor_box_scales), 'anchor_box_ratios': [list(ratio) for ratio in frcnn_config.anchor_box_ratios],
+                       'rpn_min_overlap': frcnn_config.rpn_min_overlap, 'rpn_max_overlap': frcnn_config.rpn_max_overlap}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def calc_rpn(self, img_data, width, height, resized_width, resized_height, img_length_calc_function):
+        """Same as data_generators.calc_rpn, the targets of all the anchors are read from the cache if they were computed before"""
+        key = self.get_key(img_data, width, height, resized_width, resized_height, img_length_calc_function(resized_width, resized_height))
+        labels_path = os.path.join(self.folder, key + '_labels.npy')
+        regr_path = os.path.join(self.folder, key + '_regr.npy')
+        try:
+            labels = np.load(labels_path, mmap_mode='r')
+            y_rpn_regr = np.load(regr_path, mmap_mode='r')
+            # y_is_box_valid is modified by the subsampling, so the arrays are copied from the files
+            y_rpn_overlap, y_is_box_valid = labels[0:1].astype(float), labels[1:2].astype(float)
+            y_rpn_regr = np.array(y_rpn_regr)
+        except (OSError, ValueError):
+            y_rpn_overlap, y_is_box_valid, y_rpn_regr = data_generators.calc_rpn_targets(img_data, width, height, resized_width, resized_height,
+                                                                                         img_length_calc_function)
+            # the overlap and validity flags are 0 or 1, they are stored as bytes; the regression targets are stored exactly
+            self.save(labels_path, np.concatenate([y_rpn_overlap, y_is_box_valid]).astype(np.uint8))
+            self.save(regr_path, y_rpn_regr)
+        return data_generators.sample_rpn_regions(y_rpn_overlap, y_is_box_valid, y_rpn_regr)
+
+    def save(self, file_path, array):
+        # written to a temporary file first, so a file that is being written is never read by another process
+        tmp_path = '%s.%d.tmp' % (file_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, file_path)
+
+
+def get_rpn_target_cache():
+    """Returns the cache of the folder set in frcnn_config, or None if the cache is disabled"""
+    if frcnn_config.rpn_target_cache_folder is None:
+        return None
+    return RpnTargetCache(frcnn_config.rpn_target_cache_folder)
@@ -5,7 +5,7 @@ from tensorflow.python.keras.layers import Input
 from tensorflow.python.keras.models import Model
 
 from utils import simple_parser
-from frcnn.frcnn_utils import roi_helpers, data_generators
+from frcnn.frcnn_utils import roi_helpers, data_augment, data_generators, rpn_target_cache
 import frcnn_config
 from frcnn.networks import resnet, vgg
 from custom_callbacks.CustomModelSaverUtil import CustomModelSaverUtil
@@ -83,11 +83,15 @@ def test(model_name='vgg'):
     helper.load_model_weights(model_rpn, frcnn_config.model_path)
 
     bbox_threshold = 0.8
-    all_img_data = simple_parser.get_data(frcnn_config.test_annotations, frcnn_config.test_images)
+    all_img_data = simple_parser.get_data(frcnn_config.test_annotations, frcnn_config.test_images, frcnn_config.test_annotation_index_path)
+    target_cache = rpn_target_cache.get_rpn_target_cache()
 
     for img_data in all_img_data:
         height, width, resized_height, resized_width, img_data_aug, x_img = data_generators.augment_and_resize_image(img_data, augment=False)
-        y_rpn_cls, y_rpn_regr = data_generators.calc_rpn(img_data_aug, width, height, resized_width, resized_height, nn.get_img_output_length)
+        if target_cache is not None:
+            y_rpn_cls, y_rpn_regr = target_cache.calc_rpn(img_data_aug, width, height, resized_width, resized_height, nn.get_img_output_length)
+        else:
+            y_rpn_cls, y_rpn_regr = data_generators.calc_rpn(img_data_aug, width, height, resized_width, resized_height, nn.get_img_output_length)
         x_img, y_rpn_cls, y_rpn_regr = data_generators.arrange_dims(x_img, y_rpn_cls, y_rpn_regr)
 
         # img = cv2.imread(img_data['filepath'])
@@ -99,8 +103,9 @@ def test(model_name='vgg'):
         [Y1, Y2, F] = model_rpn.predict(x_img)
         print("Image name: %s" % img_data['filepath'])
         print("Expected: ")
-        for l in img_data['bboxes']:
-            print(l)
+        boxes, classes = data_augment.get_box_arrays(img_data)
+        for class_index, box in zip(classes, boxes):
+            print({'class': int(class_index), 'x1': int(box[0]), 'x2': int(box[2]), 'y1': int(box[1]), 'y2': int(box[3])})
         print("Predicted: ")
         R = roi_helpers.rpn_to_roi(Y1, Y2, overlap_thresh=bbox_threshold)
         for i in range(R.shape[0]):
@@ -10,7 +10,7 @@ from tensorflow.python.keras.utils.generic_utils import Progbar
 
 import frcnn_config
 from utils import simple_parser
-from frcnn.frcnn_utils import roi_helpers, data_generators, loss_functions
+from frcnn.frcnn_utils import roi_helpers, data_generators, loss_functions, prefetch, rpn_target_cache
 from frcnn.networks import resnet, vgg
 from custom_callbacks.CustomLearningRateMonitor import CustomLearningRateMonitor
 from custom_callbacks.CustomModelSaverUtil import CustomModelSaverUtil
@@ -19,7 +19,7 @@ from custom_callbacks.CustomModelSaverUtil import CustomModelSaverUtil
 
 
 def train(use_saved_rpn=False, use_saved_cls=False, model_name='vgg'):
-    all_imgs = simple_parser.get_data(frcnn_config.train_annotation_folder, frcnn_config.train_image_folder)
+    all_imgs = simple_parser.get_data(frcnn_config.train_annotation_folder, frcnn_config.train_image_folder, frcnn_config.train_annotation_index_path)
 
     train_imgs = [s for s in all_imgs if s['imageset'] == 'train']
     val_imgs = [s for s in all_imgs if s['imageset'] == 'val']
@@ -37,8 +37,13 @@ def train(use_saved_rpn=False, use_saved_cls=False, model_name='vgg'):
         return
     helper = CustomModelSaverUtil()
 
-    data_gen_train = data_generators.get_anchor_gt(train_imgs, nn.get_img_output_length, augment=True, shuffle=True)
-    data_gen_val = data_generators.get_anchor_gt(val_imgs, nn.get_img_output_length, augment=False, shuffle=False)
+    if frcnn_config.data_workers > 0:
+        data_gen_train = prefetch.ParallelAnchorGenerator(train_imgs, nn.get_img_output_length, augment=True, shuffle=True, workers=frcnn_config.data_workers,
+                                                          prefetch_size=frcnn_config.prefetch_size, ordered=frcnn_config.ordered_prefetch)
+    else:
+        data_gen_train = data_generators.get_anchor_gt(train_imgs, nn.get_img_output_length, augment=True, shuffle=True)
+    data_gen_val = data_generators.get_anchor_gt(val_imgs, nn.get_img_output_length, augment=False, shuffle=False,
+                                                 target_cache=rpn_target_cache.get_rpn_target_cache())
 
     img_input = Input(shape=frcnn_config.input_shape_img)
     roi_input = Input(shape=(None, 4))
@@ -208,6 +213,8 @@ def train(use_saved_rpn=False, use_saved_cls=False, model_name='vgg'):
                 print('Exception: {}'.format(e))
                 continue
 
+    if frcnn_config.data_workers > 0:
+        data_gen_train.close()
     print('Training complete, exiting.')
 
 
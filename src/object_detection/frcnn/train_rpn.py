@@ -7,7 +7,7 @@ from tensorflow.python.keras.models import Model
 
 import frcnn_config
 from utils import simple_parser
-from frcnn.frcnn_utils import data_generators, loss_functions
+from frcnn.frcnn_utils import data_generators, loss_functions, prefetch, rpn_target_cache
 from frcnn.networks import resnet, vgg
 from custom_callbacks.CustomModelSaver import CustomModelSaver
 from custom_callbacks.CustomModelSaverUtil import CustomModelSaverUtil
@@ -16,7 +16,7 @@ from custom_callbacks.CustomModelSaverUtil import CustomModelSaverUtil
 
 
 def train(use_saved_rpn=False, model_name='vgg'):
-    all_imgs = simple_parser.get_data(frcnn_config.train_annotation_folder, frcnn_config.train_image_folder)
+    all_imgs = simple_parser.get_data(frcnn_config.train_annotation_folder, frcnn_config.train_image_folder, frcnn_config.train_annotation_index_path)
 
     train_imgs = [s for s in all_imgs if s['imageset'] == 'train']
     val_imgs = [s for s in all_imgs if s['imageset'] == 'val']
@@ -36,8 +36,14 @@ def train(use_saved_rpn=False, model_name='vgg'):
     helper = CustomModelSaverUtil()
     best_loss = np.Inf
 
-    data_gen_train = data_generators.CustomDataGenerator(train_imgs, nn.get_img_output_length, batch_size=frcnn_config.batch_size, augment=True, shuffle=True)
-    data_gen_val = data_generators.CustomDataGenerator(val_imgs, nn.get_img_output_length, batch_size=frcnn_config.batch_size, augment=False, shuffle=False)
+    prefetcher = None
+    if frcnn_config.data_workers > 0:
+        prefetcher = prefetch.ParallelAnchorGenerator(train_imgs, nn.get_img_output_length, augment=True, shuffle=True, workers=frcnn_config.data_workers,
+                                                      prefetch_size=frcnn_config.prefetch_size, ordered=frcnn_config.ordered_prefetch)
+    data_gen_train = data_generators.CustomDataGenerator(train_imgs, nn.get_img_output_length, batch_size=frcnn_config.batch_size, augment=True, shuffle=True,
+                                                         prefetcher=prefetcher)
+    data_gen_val = data_generators.CustomDataGenerator(val_imgs, nn.get_img_output_length, batch_size=frcnn_config.batch_size, augment=False, shuffle=False,
+                                                       target_cache=rpn_target_cache.get_rpn_target_cache())
 
     img_input = Input(shape=frcnn_config.input_shape_img, dtype='float32')
 
@@ -65,6 +71,8 @@ def train(use_saved_rpn=False, model_name='vgg'):
     model_ckpt = CustomModelSaver(model_path=frcnn_config.model_path, loss_path=frcnn_config.rpn_loss_path, best_loss=best_loss)
     model_lr_monitor = ReduceLROnPlateau(monitor='loss', factor=0.5, min_lr=frcnn_config.min_rpn_lr, patience=10, verbose=1)
     model_rpn.fit(data_gen_train, steps_per_epoch=epoch_length, epochs=frcnn_config.epochs, callbacks=[model_ckpt, model_lr_monitor], verbose=1)
+    if prefetcher is not None:
+        prefetcher.close()
 
 
 # models currently supported:
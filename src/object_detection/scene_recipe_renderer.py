@@ -0,0 +1,66 @@
+import random
+
+import cv2
+import numpy as np
+
+import detection_config as config
+from build_detection_dataset import get_background_cache, get_fruit_sources, render_scene
+from utils.scene_recipes import load_recipes
+
+
+class SceneRecipeRenderer:
+    """
+    Renders on demand the scenes stored in a recipe file by build_detection_dataset.py (write_recipes = True).
+    The rendered images are exactly the images generated from the same recipes, as long as the backgrounds, the source images
+    (or the sprite bank) and the generation settings in detection_config.py have not changed since the recipes were recorded.
+    renderer[i] returns the sample of the i-th recipe of the file and render(index) the sample of the image with the given index,
+    e.g. to look at a single sample that was never stored. A sample is an (image, labels) tuple like in SyntheticSceneSource:
+    the image has the img_shape of the recipes and labels is an int32 array with one (class_id, xmin, ymin, xmax, ymax) row per box.
+    The renderer is also an infinite iterator over the recipes (reshuffled on each pass if shuffle is True), so it can be used
+    as the scene_source of the SSD DataGenerator (with rgb=True) or of the FRCNN CustomDataGenerator.
+    """
+
+    def __init__(self, recipe_path, rgb=False, shuffle=True, seed=None):
+        self.recipes = load_recipes(recipe_path)
+        if self.recipes.use_sprite_bank != config.use_sprite_bank:
+            raise ValueError("The recipes in %s were recorded with use_sprite_bank = %s, set it to the same value in detection_config.py"
+                             % (recipe_path, self.recipes.use_sprite_bank))
+        self.rgb = rgb
+        self.shuffle = shuffle
+        self.rng = random.Random(seed)
+        self.epoch_size = len(self.recipes)
+        self.order = []
+        self.backgrounds = None
+        self.labels_to_images = None
+        self.sprite_bank = None
+
+    def __len__(self):
+        return len(self.recipes)
+
+    def __getitem__(self, position):
+        return self.render_recipe(self.recipes[position])
+
+    def render(self, index):
+        return self.render_recipe(self.recipes.find(index))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if len(self.order) == 0:
+            self.order = list(range(len(self.recipes)))
+            if self.shuffle:
+                self.rng.shuffle(self.order)
+        return self[self.order.pop()]
+
+    def render_recipe(self, recipe):
+        if self.backgrounds is None:
+            # loaded on first use, so the renderer can be created before the processes of a data loader are started
+            self.backgrounds = get_background_cache()
+            self.labels_to_images, self.sprite_bank = get_fruit_sources()
+        canvas, _, _, _ = render_scene(recipe, self.backgrounds, self.labels_to_images, is_save_mask=False, sprite_bank=self.sprite_bank)
+        canvas = cv2.resize(canvas, (self.recipes.img_shape[1], self.recipes.img_shape[0]))
+        if self.rgb:
+            canvas = cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB)
+        labels = np.array([(fruit['label'],) + tuple(fruit['box']) for fruit in recipe['fruits']], dtype=np.int32).reshape((-1, 5))
+        return canvas, labels
@@ -85,6 +85,7 @@ class DataGenerator:
                  image_ids=None,
                  eval_neutral=None,
                  labels_output_format=('class_id', 'xmin', 'ymin', 'xmax', 'ymax'),
+                 scene_source=None,
                  verbose=True):
         """
         Initializes the data generator. You can either load a dataset directly here in the constructor,
@@ -128,6 +129,11 @@ class DataGenerator:
             labels_output_format (list, optional): A list of five strings representing the desired order of the five
                 items class ID, xmin, ymin, xmax, ymax in the generated ground truth data (if any). The expected
                 strings are 'xmin', 'ymin', 'xmax', 'ymax', 'class_id'.
+            scene_source (iterator, optional): `None` or an infinite iterator of `(image, labels)` tuples, e.g. a
+                `SyntheticSceneSource` (see `synthetic_scene_source.py`) created with `rgb=True`. The labels are arrays
+                with one `(class_id, xmin, ymin, xmax, ymax)` row per box. If a scene source is given, `generate()`
+                takes the samples from it instead of a dataset, so every batch contains new images. The dataset size
+                is then the `epoch_size` of the source (or 1000 if it has none) and there is nothing to shuffle.
             verbose (bool, optional): If `True`, prints out the progress for some constructor operations that may
                 take a bit longer.
         """
@@ -213,6 +219,12 @@ class DataGenerator:
         else:
             self.hdf5_dataset = None
 
+        self.scene_source = scene_source
+        if not scene_source is None:
+            self.dataset_size = getattr(scene_source, 'epoch_size', 1000)
+            self.dataset_indices = np.arange(self.dataset_size, dtype=np.int32)
+            self.labels = []  # The labels are composed together with the images.
+
     def load_hdf5_dataset(self, verbose=True):
         """
         Loads an HDF5 dataset that is in the format that the `create_hdf5_dataset()` method
@@ -927,7 +939,7 @@ class DataGenerator:
         # Do a few preparatory things like maybe shuffling the dataset initially.
         #############################################################################################
 
-        if shuffle:
+        if shuffle and self.scene_source is None:
             objects_to_shuffle = [self.dataset_indices]
             if not (self.filenames is None):
                 objects_to_shuffle.append(self.filenames)
@@ -969,7 +981,7 @@ class DataGenerator:
                 # Maybe shuffle the dataset if a full pass over the dataset has finished.
                 #########################################################################################
 
-                if shuffle:
+                if shuffle and self.scene_source is None:
                     objects_to_shuffle = [self.dataset_indices]
                     if not (self.filenames is None):
                         objects_to_shuffle.append(self.filenames)
@@ -988,12 +1000,22 @@ class DataGenerator:
             #########################################################################################
 
             # We prioritize our options in the following order:
+            # 0) If we have a scene source, take new synthetic images and their labels from it.
             # 1) If we have the images already loaded in memory, get them from there.
             # 2) Else, if we have an HDF5 dataset, get the images from there.
             # 3) Else, if we have neither of the above, we'll have to load the individual image
             #    files from disk.
             batch_indices = self.dataset_indices[current:current + batch_size]
-            if not (self.images is None):
+            if not (self.scene_source is None):
+                source_format = ('class_id', 'xmin', 'ymin', 'xmax', 'ymax')
+                columns = [source_format.index(element) for element in self.labels_output_format]
+                batch_y = []
+                for _ in range(len(batch_indices)):
+                    image, labels = next(self.scene_source)
+                    batch_X.append(image)
+                    batch_y.append(labels[:, columns])
+                batch_filenames = [None] * len(batch_X)
+            elif not (self.images is None):
                 for i in batch_indices:
                     batch_X.append(self.images[i])
                 if not (self.filenames is None):
@@ -1014,7 +1036,9 @@ class DataGenerator:
                         batch_X.append(np.array(image, dtype=np.uint8))
 
             # Get the labels for this batch (if there are any).
-            if not (self.labels is None):
+            if not (self.scene_source is None):
+                pass  # The labels were taken from the scene source together with the images.
+            elif not (self.labels is None):
                 batch_y = deepcopy(self.labels[current:current + batch_size])
             else:
                 batch_y = None
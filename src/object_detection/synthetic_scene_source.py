@@ -0,0 +1,101 @@
+import multiprocessing
+import queue
+import traceback
+
+import cv2
+import numpy as np
+
+import detection_config as config
+from build_detection_dataset import get_background_cache, get_fruit_sources, get_image_rng, compose_scene, resize_bounding_boxes, anchors_to_labels
+
+
+class SyntheticSceneSource:
+    """
+    Infinite source of training samples composed in memory with the same logic as build_detection_dataset.py.
+    The scenes are composed by background worker processes and kept in a bounded prefetch queue, so no image is written to or read from the disk.
+    Each sample is an (image, labels) tuple, where image has the shape config.img_shape and labels is an int32 array
+    with one (class_id, xmin, ymin, xmax, ymax) row per box; class_id is the index of the label in config.fruit_labels.
+    The images are BGR (like cv2.imread) unless rgb is True (like PIL, which is what the SSD DataGenerator expects).
+    When seed is set, the scene with index i is the same as the image i generated by build_detection_dataset.py with that seed,
+    but the order in which the scenes are returned depends on the workers.
+    The source should be closed when it is no longer used, otherwise the workers are stopped only when the training process exits.
+    If a worker fails (e.g. the background or source folders are missing), its error is raised by the next call to next(),
+    and a RuntimeError is raised if all the workers died (e.g. were killed) without reporting an error.
+    """
+
+    def __init__(self, num_workers=2, prefetch=32, seed=None, rgb=False, epoch_size=1000):
+        self.rgb = rgb
+        self.epoch_size = epoch_size  # number of samples that are considered an epoch, e.g. for steps_per_epoch
+        self.queue = multiprocessing.Queue(maxsize=prefetch)
+        self.stop_event = multiprocessing.Event()
+        self.workers = []
+        for worker_id in range(num_workers):
+            worker = multiprocessing.Process(target=produce_scenes, args=(self.queue, self.stop_event, seed, worker_id, num_workers), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                image, labels = self.queue.get(timeout=1.0)
+                break
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("All the scene workers died, no more scenes can be produced")
+        if image is None:
+            # labels holds the traceback of a worker that failed
+            raise RuntimeError("A scene worker failed:\n%s" % labels)
+        if self.rgb:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        return image, labels
+
+    def close(self):
+        self.stop_event.set()
+        # empty the queue so the workers that are blocked on put can see the stop event
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+
+def produce_scenes(scene_queue, stop_event, seed, worker_id, num_workers):
+    try:
+        compose_scenes(scene_queue, stop_event, seed, worker_id, num_workers)
+    except Exception:
+        # the error is sent to the training process, which would otherwise wait for scenes forever
+        put_until_stopped(scene_queue, stop_event, (None, traceback.format_exc()))
+    # the data that is still in the buffer of the queue does not need to be flushed when the source is closed
+    scene_queue.cancel_join_thread()
+
+
+def compose_scenes(scene_queue, stop_event, seed, worker_id, num_workers):
+    backgrounds = get_background_cache()
+    labels_to_images, sprite_bank = get_fruit_sources()
+    img_count = worker_id
+    while not stop_event.is_set():
+        rng = get_image_rng(seed, img_count)
+        canvas, _, anchors, _ = compose_scene(rng, backgrounds, labels_to_images, is_save_mask=False, sprite_bank=sprite_bank)
+        skewed_height, skewed_width = canvas.shape[:2]
+        canvas = cv2.resize(canvas, (config.img_shape[1], config.img_shape[0]))
+        anchors = resize_bounding_boxes(anchors, skewed_width, skewed_height, config.img_shape[1], config.img_shape[0])
+        labels = anchors_to_labels(anchors) if len(anchors) > 0 else np.zeros((0, 5), dtype=np.int32)
+        img_count += num_workers
+        put_until_stopped(scene_queue, stop_event, (canvas, labels))
+
+
+def put_until_stopped(scene_queue, stop_event, item):
+    while not stop_event.is_set():
+        try:
+            scene_queue.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+
+import cv2
+
+
+class BackgroundCache:
+    """
+    LRU cache of the decoded background images, and optionally of their resized versions.
+    The cache holds at most max_bytes bytes of pixel data; the least recently used images are evicted first.
+    The returned images are shared between calls, so they are marked as read-only; callers that modify a background must copy it.
+    """
+
+    def __init__(self, image_paths, max_bytes=512 * 1024 * 1024, cache_resized=False):
+        self.image_paths = image_paths
+        self.max_bytes = max_bytes
+        self.cache_resized = cache_resized
+        self.entries = OrderedDict()
+        self.used_bytes = 0
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def get(self, index, width=None, height=None):
+        """Returns the background with the given index, resized to (width, height) if they are given"""
+        image = self._lookup((index, None, None))
+        if image is None:
+            image = cv2.imread(self.image_paths[index])
+            image.flags.writeable = False
+            self._store((index, None, None), image)
+        if width is None or (image.shape[1] == width and image.shape[0] == height):
+            return image
+        resized = self._lookup((index, width, height))
+        if resized is None:
+            resized = cv2.resize(image, (width, height))
+            resized.flags.writeable = False
+            # resized versions are only worth keeping when the same sizes are requested again, i.e. when the skew factors are bucketed
+            if self.cache_resized:
+                self._store((index, width, height), resized)
+        return resized
+
+    def _lookup(self, key):
+        image = self.entries.get(key)
+        if image is not None:
+            self.entries.move_to_end(key)
+        return image
+
+    def _store(self, key, image):
+        if image.nbytes > self.max_bytes:
+            return
+        self.entries[key] = image
+        self.used_bytes += image.nbytes
+        while self.used_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.used_bytes -= evicted.nbytes
@@ -0,0 +1,135 @@
+import io
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = {'png': '.png', 'jpg': '.jpg', 'webp': '.webp', 'npy': '.npy'}
+
+
+class DatasetWriter:
+    """
+    Write-behind output stage for the generated datasets.
+    Samples are put in a bounded queue and encoded/written by a pool of threads (cv2.imencode and the file writes release the GIL),
+    so the scene generation does not wait for the disk. When the queue is full, add_sample blocks until a writer thread is free.
+    A sample is a list of (path, kind, payload) entries, where kind is:
+        'image' - a BGR image encoded with the selected image_format
+        'mask' - a mask; always lossless, i.e. PNG, or .npy when image_format is 'npy'
+        'text' - a string written as is
+    Each file is written to a temporary file that is renamed once it is complete, so an interrupted run never leaves a truncated file behind.
+    The optional on_written callback of a sample is called by the writer thread after all the files of the sample are written.
+    If a StageProfiler is given, the time spent encoding and writing the files is recorded in it.
+    """
+
+    def __init__(self, image_format='png', png_compression=3, quality=95, num_threads=2, queue_size=16, report_interval=30.0, profiler=None):
+        if image_format not in IMAGE_EXTENSIONS:
+            raise ValueError("Unsupported image format %s, the supported formats are: %s" % (image_format, ', '.join(IMAGE_EXTENSIONS)))
+        self.image_format = image_format
+        self.png_compression = png_compression
+        self.quality = quality
+        self.report_interval = report_interval
+        self.profiler = profiler
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.error = None
+        self.written_samples = 0
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+        self.threads = []
+        for _ in range(num_threads):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    @property
+    def extension(self):
+        return IMAGE_EXTENSIONS[self.image_format]
+
+    @property
+    def mask_extension(self):
+        return '.npy' if self.image_format == 'npy' else '.png'
+
+    def add_sample(self, entries, on_written=None):
+        self._raise_error()
+        self.queue.put((entries, on_written))
+
+    def flush(self):
+        """Waits until all the queued samples are written"""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.flush()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def encode(self, kind, payload):
+        if kind == 'text':
+            return payload.encode('utf-8')
+        if self.image_format == 'npy':
+            buffer = io.BytesIO()
+            np.save(buffer, payload)
+            return buffer.getvalue()
+        if kind == 'mask' or self.image_format == 'png':
+            _, encoded = cv2.imencode('.png', payload, [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression])
+        elif self.image_format == 'jpg':
+            _, encoded = cv2.imencode('.jpg', payload, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        else:
+            _, encoded = cv2.imencode('.webp', payload, [cv2.IMWRITE_WEBP_QUALITY, self.quality])
+        return encoded.tobytes()
+
+    def _run(self):
+        while True:
+            sample = self.queue.get()
+            if sample is None:
+                self.queue.task_done()
+                return
+            entries, on_written = sample
+            try:
+                for path, kind, payload in entries:
+                    encode_start = time.perf_counter()
+                    data = self.encode(kind, payload)
+                    write_start = time.perf_counter()
+                    write_file_atomically(path, data)
+                    if self.profiler is not None and self.profiler.enabled:
+                        self.profiler.add_time('encode_' + kind, write_start - encode_start)
+                        self.profiler.add_time('file_write', time.perf_counter() - write_start)
+                if on_written is not None:
+                    on_written()
+                self._sample_written()
+            except Exception as e:
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _sample_written(self):
+        with self.lock:
+            self.written_samples += 1
+            now = time.time()
+            if now - self.last_report_time < self.report_interval:
+                return
+            self.last_report_time = now
+            elapsed = now - self.start_time
+            print("Process %d wrote %d images (%.2f images/s, %d queued)" % (os.getpid(), self.written_samples, self.written_samples / elapsed, self.queue.qsize()))
+
+    def _raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+
+def write_file_atomically(path, data):
+    # the data is written to a hidden temporary file in the same folder, which is then renamed over the destination file
+    folder, name = os.path.split(path)
+    tmp_path = os.path.join(folder, '.' + name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
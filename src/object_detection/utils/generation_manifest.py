@@ -0,0 +1,43 @@
+import os
+
+
+class GenerationManifest:
+    """
+    Append-only list of the indices of the generated images whose files were all written, one index per line.
+    Each record is a single write to a file opened with O_APPEND, so the worker processes can share the same manifest;
+    a line that was cut short by an interruption is ignored when the manifest is read, and removed by repair.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def completed_indices(self):
+        completed = set()
+        if not os.path.exists(self.path):
+            return completed
+        with open(self.path, mode='r') as f:
+            for line in f:
+                if line.endswith('\n') and line.strip().isdigit():
+                    completed.add(int(line))
+        return completed
+
+    def repair(self):
+        """Removes the last line if it was cut short, so the next record does not get appended to it"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, mode='rb+') as f:
+            data = f.read()
+            if len(data) > 0 and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def record(self, *indices):
+        data = ''.join('%d\n' % index for index in indices).encode('ascii')
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,94 @@
+import os
+import warnings
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    warnings.warn("'h5py' module is missing. The HDF5 output of the dataset generation will be unavailable.")
+
+
+class Hdf5ShardWriter:
+    """
+    Appends generated samples to an HDF5 file that has the same layout as the files produced by
+    DataGenerator.create_hdf5_dataset (ssd/data_generator/object_detection_2d_data_generator.py):
+        images - flattened RGB images, image_shapes - (height, width, channels) of each image,
+        labels - flattened (class_id, xmin, ymin, xmax, ymax) boxes, label_shapes - (boxes, 5) of each label array,
+        image_ids - the image name without the extension.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.hdf5_dataset = h5py.File(file_path, 'w')
+        self.hdf5_dataset.attrs.create(name='has_labels', data=True, shape=None, dtype=bool)
+        self.hdf5_dataset.attrs.create(name='has_image_ids', data=True, shape=None, dtype=bool)
+        self.hdf5_dataset.attrs.create(name='has_eval_neutral', data=False, shape=None, dtype=bool)
+        self.hdf5_dataset.attrs.create(name='variable_image_size', data=True, shape=None, dtype=bool)
+        self.images = self.hdf5_dataset.create_dataset(name='images', shape=(0,), maxshape=(None,), dtype=h5py.vlen_dtype(np.uint8))
+        self.image_shapes = self.hdf5_dataset.create_dataset(name='image_shapes', shape=(0, 3), maxshape=(None, 3), dtype=np.int32)
+        self.labels = self.hdf5_dataset.create_dataset(name='labels', shape=(0,), maxshape=(None,), dtype=h5py.vlen_dtype(np.int32))
+        self.label_shapes = self.hdf5_dataset.create_dataset(name='label_shapes', shape=(0, 2), maxshape=(None, 2), dtype=np.int32)
+        self.image_ids = self.hdf5_dataset.create_dataset(name='image_ids', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+        self.size = 0
+
+    def add(self, image_id, image, labels):
+        """image is an RGB image, labels is an int array with one (class_id, xmin, ymin, xmax, ymax) row per box"""
+        labels = np.asarray(labels, dtype=np.int32).reshape((-1, 5))
+        index = self.size
+        self.size += 1
+        for dataset in (self.images, self.image_shapes, self.labels, self.label_shapes, self.image_ids):
+            dataset.resize(self.size, axis=0)
+        self.images[index] = image.reshape(-1)
+        self.image_shapes[index] = image.shape
+        self.labels[index] = labels.reshape(-1)
+        self.label_shapes[index] = labels.shape
+        self.image_ids[index] = image_id
+
+    def close(self):
+        self.hdf5_dataset.close()
+
+
+def read_hdf5_image_ids(file_path):
+    """Returns the image ids stored in the HDF5 file, or None if the file cannot be read (e.g. a shard that was not closed)"""
+    try:
+        with h5py.File(file_path, 'r') as hdf5_dataset:
+            return list(hdf5_dataset['image_ids'].asstr()[:])
+    except (OSError, KeyError):
+        return None
+
+
+def merge_hdf5_shards(shard_paths, file_path, delete_shards=True, append=False):
+    """
+    Merges the shards into a single HDF5 file that can be loaded with DataGenerator(hdf5_dataset_path=file_path).
+    The samples are ordered by their numeric image id, so the result does not depend on how the images were split into shards.
+    If append is True, the samples already stored in file_path are kept; a sample from a shard replaces a stored sample with the same id.
+    The merged file is written next to file_path and renamed over it once it is complete.
+    """
+    input_paths = list(shard_paths)
+    if append and os.path.exists(file_path):
+        input_paths.insert(0, file_path)
+    samples = {}
+    inputs = [h5py.File(input_path, 'r') for input_path in input_paths]
+    tmp_path = file_path + '.tmp'
+    try:
+        for hdf5_input in inputs:
+            for row, image_id in enumerate(hdf5_input['image_ids'].asstr()[:]):
+                samples[image_id] = (int(image_id) if image_id.isdigit() else image_id, image_id, hdf5_input, row)
+        sorted_samples = sorted(samples.values(), key=lambda sample: (isinstance(sample[0], str), sample[0]))
+        writer = Hdf5ShardWriter(tmp_path)
+        try:
+            for _, image_id, hdf5_input, row in sorted_samples:
+                image = hdf5_input['images'][row].reshape(hdf5_input['image_shapes'][row])
+                labels = hdf5_input['labels'][row].reshape(hdf5_input['label_shapes'][row])
+                writer.add(image_id, image, labels)
+        finally:
+            writer.close()
+    finally:
+        for hdf5_input in inputs:
+            hdf5_input.close()
+    os.replace(tmp_path, file_path)
+    if delete_shards:
+        for shard_path in shard_paths:
+            os.remove(shard_path)
+    return len(sorted_samples)
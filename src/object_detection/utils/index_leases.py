@@ -0,0 +1,141 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+class LeaseManager:
+    """
+    Hands out named work items (e.g. ranges of image indices) to the processes of one or several machines that share a folder.
+    A process owns an item while the lease file of the item contains its token; the lease is created with O_EXCL, so only one process can claim it.
+    The owner renews its leases (updates their modification time) from a background thread; a lease that was not renewed for lease_seconds,
+    e.g. because its owner died, has expired and the item can be claimed by another process.
+    When the work of an item is done, a completion marker is written and the item is never handed out again.
+    The clocks of the machines are assumed to be synchronized to well under lease_seconds.
+    """
+
+    def __init__(self, folder, lease_seconds=120.0):
+        self.folder = folder
+        self.lease_seconds = lease_seconds
+        self.owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self.tokens = {}  # name of each held item -> token written in its lease file
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.renew_thread = None
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    def lease_path(self, name):
+        return os.path.join(self.folder, name + '.lease')
+
+    def done_path(self, name):
+        return os.path.join(self.folder, name + '.done')
+
+    def is_done(self, name):
+        return os.path.exists(self.done_path(name))
+
+    def is_held(self, name):
+        with self.lock:
+            return name in self.tokens
+
+    def try_claim(self, name):
+        """Returns True if the item was claimed by this process, False if it is done or leased by a live process"""
+        if self.is_done(name):
+            return False
+        path = self.lease_path(name)
+        if self._create_lease(name, path):
+            return True
+        token, modification_time = self._read_lease(path)
+        if token is None or time.time() - modification_time < self.lease_seconds:
+            return False
+        # the lease expired; it is moved aside first, because only one of the processes that try to reclaim it can rename it
+        expired_path = '%s.expired.%s' % (path, uuid.uuid4().hex)
+        try:
+            os.rename(path, expired_path)
+        except FileNotFoundError:
+            return False
+        expired_token, _ = self._read_lease(expired_path)
+        if expired_token != token:
+            # the lease was reclaimed by another process between the check and the rename, give it back
+            try:
+                os.link(expired_path, path)
+            except FileExistsError:
+                pass
+            os.remove(expired_path)
+            return False
+        os.remove(expired_path)
+        return self._create_lease(name, path)
+
+    def renew(self):
+        """Updates the modification time of the held leases; a lease that was reclaimed by another process is dropped"""
+        with self.lock:
+            held = list(self.tokens.items())
+        for name, token in held:
+            path = self.lease_path(name)
+            if self._read_lease(path)[0] == token:
+                try:
+                    os.utime(path)
+                    continue
+                except FileNotFoundError:
+                    # the lease expired and was moved aside by another process after it was read
+                    pass
+            with self.lock:
+                self.tokens.pop(name, None)
+
+    def complete(self, name):
+        """Writes the completion marker of the item and releases its lease"""
+        tmp_path = '%s.%s.tmp' % (self.done_path(name), uuid.uuid4().hex)
+        with open(tmp_path, mode='w') as f:
+            f.write(self.owner)
+        os.replace(tmp_path, self.done_path(name))
+        self.release(name)
+
+    def release(self, name):
+        with self.lock:
+            token = self.tokens.pop(name, None)
+        path = self.lease_path(name)
+        if token is not None and self._read_lease(path)[0] == token:
+            os.remove(path)
+
+    def start_renewing(self):
+        self.stop_event.clear()
+        self.renew_thread = threading.Thread(target=self._renew_periodically, daemon=True)
+        self.renew_thread.start()
+
+    def stop_renewing(self):
+        self.stop_event.set()
+        if self.renew_thread is not None:
+            self.renew_thread.join()
+            self.renew_thread = None
+
+    def _renew_periodically(self):
+        while not self.stop_event.wait(self.lease_seconds / 4):
+            # an error must not stop the renewals, otherwise all the held leases would expire and their items would be generated twice
+            try:
+                self.renew()
+            except OSError as e:
+                print("Could not renew the leases in %s: %s" % (self.folder, e))
+
+    def _create_lease(self, name, path):
+        token = '%s:%s' % (self.owner, uuid.uuid4().hex)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return False
+        try:
+            os.write(fd, token.encode('utf-8'))
+        finally:
+            os.close(fd)
+        with self.lock:
+            self.tokens[name] = token
+        return True
+
+    def _read_lease(self, path):
+        """Returns the token and the modification time of the lease, or (None, None) if there is no lease"""
+        try:
+            modification_time = os.path.getmtime(path)
+            with open(path, mode='r') as f:
+                return f.read(), modification_time
+        except FileNotFoundError:
+            return None, None
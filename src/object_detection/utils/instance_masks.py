@@ -0,0 +1,44 @@
+import numpy as np
+
+
+def encode_instances(instance_map, instance_ids):
+    """
+    Encodes the instances of an instance map (0 - background, k - the pixels of the instance k) as uncompressed COCO RLE.
+    The pixels are read in column-major order and the counts alternate between runs of 0 and runs of 1, starting with a run of 0,
+    so the result can be read with pycocotools (mask.frPyObjects) or decode_rle.
+    Returns a dictionary from the instance id to its {'size': [height, width], 'counts': [...]} encoding.
+    """
+    height, width = instance_map.shape[:2]
+    flat = instance_map.ravel(order='F')
+    # the runs of the whole map are found in a single pass, then split by instance
+    boundaries = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [flat.size]))
+    values = flat[starts]
+    encodings = {}
+    for instance_id in instance_ids:
+        run_starts = starts[values == instance_id]
+        run_ends = ends[values == instance_id]
+        counts = np.empty(2 * len(run_starts) + 1, dtype=np.int64)
+        counts[0:-1:2] = run_starts - np.concatenate(([0], run_ends[:-1]))
+        counts[1::2] = run_ends - run_starts
+        counts[-1] = flat.size - (run_ends[-1] if len(run_ends) > 0 else 0)
+        # like COCO, a trailing run of 0 is not stored
+        if counts[-1] == 0 and len(counts) > 1:
+            counts = counts[:-1]
+        encodings[instance_id] = {'size': [height, width], 'counts': counts.tolist()}
+    return encodings
+
+
+def decode_rle(rle):
+    """Returns the binary (height, width) uint8 mask encoded by encode_instances"""
+    height, width = rle['size']
+    values = np.zeros(len(rle['counts']), dtype=np.uint8)
+    values[1::2] = 1
+    flat = np.repeat(values, rle['counts'])
+    flat = np.concatenate((flat, np.zeros(height * width - flat.size, dtype=np.uint8)))
+    return flat.reshape((height, width), order='F')
+
+
+def rle_area(rle):
+    return int(sum(rle['counts'][1::2]))
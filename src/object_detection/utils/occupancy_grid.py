@@ -0,0 +1,69 @@
+import math
+import random
+
+import cv2
+import numpy as np
+
+
+class OccupancyGrid:
+    """
+    Keeps track of the canvas pixels covered by the images that were already added, so the free positions for a new image
+    can be found with a single pass over the integral image of the grid instead of testing random positions one by one.
+    Each image is shrunk by overlap_factor on every side before it is marked or tested, which allows some degree of
+    overlap between neighbouring images.
+    Rectangles are inclusive on both ends, so images that only touch are considered to overlap.
+    """
+
+    def __init__(self, height, width, overlap_factor=0.0):
+        self.height = height
+        self.width = width
+        self.overlap_factor = overlap_factor
+        self.occupied = np.zeros((height, width), dtype=np.uint8)
+        self.integral = None
+
+    def shrink(self, img_h, img_w):
+        return math.floor(img_h * self.overlap_factor), math.floor(img_w * self.overlap_factor)
+
+    def add(self, x, y, img_h, img_w):
+        """Marks the image with the upper left corner in (x, y) (row, column) as occupied"""
+        dx, dy = self.shrink(img_h, img_w)
+        x1, x2 = max(x + dx, 0), min(x + img_h - dx, self.height - 1)
+        y1, y2 = max(y + dy, 0), min(y + img_w - dy, self.width - 1)
+        if x1 <= x2 and y1 <= y2:
+            self.occupied[x1:x2 + 1, y1:y2 + 1] = 1
+            self.integral = None
+
+    def free_positions(self, img_h, img_w):
+        """
+        Returns a boolean map in which the element (x, y) is True if an image of size (img_h, img_w) can be added with its
+        upper left corner in (x, y), or None if the image does not fit in the canvas
+        """
+        max_x = self.height - img_h - 1
+        max_y = self.width - img_w - 1
+        if max_x < 0 or max_y < 0:
+            return None
+        if self.integral is None:
+            self.integral = cv2.integral(self.occupied)
+        dx, dy = self.shrink(img_h, img_w)
+        # inclusive bounds of the shrunk image relative to its upper left corner
+        top, bottom = dx, max(img_h - dx, dx)
+        left, right = dy, max(img_w - dy, dy)
+        rows, cols = max_x + 1, max_y + 1
+        s = self.integral
+        covered = (s[bottom + 1:bottom + 1 + rows, right + 1:right + 1 + cols]
+                   - s[top:top + rows, right + 1:right + 1 + cols]
+                   - s[bottom + 1:bottom + 1 + rows, left:left + cols]
+                   + s[top:top + rows, left:left + cols])
+        return covered == 0
+
+    def sample_position(self, img_h, img_w, rng=random):
+        """Returns a random free (x, y) position for an image of size (img_h, img_w), or None if there is no free position"""
+        free = self.free_positions(img_h, img_w)
+        if free is None:
+            return None
+        free_indices = np.flatnonzero(free)
+        if len(free_indices) == 0:
+            return None
+        index = free_indices[rng.randint(0, len(free_indices) - 1)]
+        x, y = divmod(int(index), free.shape[1])
+        return x, y
@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+
+# columns of the recipe files; the scene_ columns have one row per scene, the fruit_ columns one row per fruit added to a scene
+SCENE_COLUMNS = {'scene_index': np.int64, 'scene_background': np.int32, 'scene_width': np.int32, 'scene_height': np.int32,
+                 'scene_contrast': np.float64, 'scene_brightness': np.float64, 'scene_blur': np.bool_}
+FRUIT_COLUMNS = {'fruit_label': np.int16, 'fruit_source': np.int32, 'fruit_size': np.int32, 'fruit_rotation': np.int8,
+                 'fruit_crop_axis': np.int8, 'fruit_crop_from_start': np.bool_, 'fruit_crop_length': np.int32,
+                 'fruit_contrast': np.float64, 'fruit_brightness': np.float64, 'fruit_x': np.int32, 'fruit_y': np.int32}
+
+
+class SceneRecipes:
+    """
+    Compact description of generated scenes, from which render_scene (build_detection_dataset.py) reproduces the exact images.
+    A recipe is a dictionary with the keys:
+        index, background (index of the background file), width, height (skewed size of the scene), contrast, brightness, blur (of the background),
+        fruits - list of dictionaries with the keys label (index in config.fruit_labels), source (index of the source image or sprite),
+                 size, rotation, crop ((axis, from_start, length), axis 0 - no crop, 1 - rows, 2 - columns), contrast, brightness, x, y,
+                 box ((xmin, ymin, xmax, ymax) in the image of size img_shape)
+    The recipes are stored in a columnar .npz file (a few hundred bytes per scene), together with the img_shape of the boxes
+    and whether the fruits come from the sprite bank or from the source images.
+    """
+
+    def __init__(self, recipes=(), img_shape=None, use_sprite_bank=False):
+        self.recipes = sorted(recipes, key=lambda recipe: recipe['index'])
+        self.img_shape = img_shape
+        self.use_sprite_bank = use_sprite_bank
+        self.positions = {recipe['index']: position for position, recipe in enumerate(self.recipes)}
+
+    def __len__(self):
+        return len(self.recipes)
+
+    def __getitem__(self, position):
+        return self.recipes[position]
+
+    @property
+    def indices(self):
+        return [recipe['index'] for recipe in self.recipes]
+
+    def find(self, index):
+        """Returns the recipe of the image with the given index"""
+        return self.recipes[self.positions[index]]
+
+    def save(self, file_path):
+        columns = {name: [] for name in list(SCENE_COLUMNS) + list(FRUIT_COLUMNS)}
+        fruit_boxes = []
+        fruit_offsets = [0]
+        for recipe in self.recipes:
+            for name in SCENE_COLUMNS:
+                columns[name].append(recipe[name[len('scene_'):]])
+            for fruit in recipe['fruits']:
+                for name in FRUIT_COLUMNS:
+                    if name.startswith('fruit_crop_'):
+                        continue
+                    columns[name].append(fruit[name[len('fruit_'):]])
+                axis, from_start, length = fruit['crop']
+                columns['fruit_crop_axis'].append(axis)
+                columns['fruit_crop_from_start'].append(from_start)
+                columns['fruit_crop_length'].append(length)
+                fruit_boxes.append(fruit['box'])
+            fruit_offsets.append(fruit_offsets[-1] + len(recipe['fruits']))
+        column_types = {**SCENE_COLUMNS, **FRUIT_COLUMNS}
+        arrays = {name: np.array(values, dtype=column_types[name]) for name, values in columns.items()}
+        arrays['fruit_box'] = np.array(fruit_boxes, dtype=np.int32).reshape((-1, 4))
+        arrays['scene_fruit_offsets'] = np.array(fruit_offsets, dtype=np.int64)
+        arrays['img_shape'] = np.array(self.img_shape, dtype=np.int32)
+        arrays['use_sprite_bank'] = np.array(self.use_sprite_bank)
+        # written with a file object so np.savez does not add the .npz extension, then renamed so the file is never left incomplete
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, file_path)
+
+
+def load_recipes(file_path):
+    with np.load(file_path) as data:
+        arrays = {name: data[name] for name in data.files}
+    offsets = arrays['scene_fruit_offsets']
+    recipes = []
+    for row in range(len(arrays['scene_index'])):
+        recipe = {name[len('scene_'):]: arrays[name][row].item() for name in SCENE_COLUMNS}
+        fruits = []
+        for fruit_row in range(offsets[row], offsets[row + 1]):
+            fruit = {name[len('fruit_'):]: arrays[name][fruit_row].item() for name in FRUIT_COLUMNS if not name.startswith('fruit_crop_')}
+            fruit['crop'] = (arrays['fruit_crop_axis'][fruit_row].item(), arrays['fruit_crop_from_start'][fruit_row].item(),
+                             arrays['fruit_crop_length'][fruit_row].item())
+            fruit['box'] = tuple(arrays['fruit_box'][fruit_row].tolist())
+            fruits.append(fruit)
+        recipe['fruits'] = fruits
+        recipes.append(recipe)
+    return SceneRecipes(recipes, tuple(arrays['img_shape'].tolist()), bool(arrays['use_sprite_bank']))
+
+
+def read_recipe_indices(file_path):
+    """Returns the image indices stored in the recipe file, or None if the file cannot be read"""
+    try:
+        with np.load(file_path) as data:
+            return data['scene_index'].tolist()
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def merge_recipe_shards(shard_paths, file_path, delete_shards=True, append=False):
+    """
+    Merges the recipe shards into a single recipe file, ordered by image index.
+    If append is True, the recipes already stored in file_path are kept; a recipe from a shard replaces a stored recipe with the same index.
+    """
+    input_paths = list(shard_paths)
+    if append and os.path.exists(file_path):
+        input_paths.insert(0, file_path)
+    recipes = {}
+    img_shape = None
+    use_sprite_bank = False
+    for input_path in input_paths:
+        scene_recipes = load_recipes(input_path)
+        img_shape, use_sprite_bank = scene_recipes.img_shape, scene_recipes.use_sprite_bank
+        for recipe in scene_recipes:
+            recipes[recipe['index']] = recipe
+    SceneRecipes(recipes.values(), img_shape, use_sprite_bank).save(file_path)
+    if delete_shards:
+        for shard_path in shard_paths:
+            os.remove(shard_path)
+    return len(recipes)
@@ -1,44 +1,149 @@
-import cv2
+import json
 import os
+import struct
+
+import cv2
+import numpy as np
 from frcnn import frcnn_config
 
+# JPEG markers of the frames that contain the image size (SOF0-SOF15, without DHT, JPG and DAC)
+JPEG_FRAME_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
 
-def get_data(annotations_path, images_path):
+
+def get_data(annotations_path, images_path, cache_path=None):
+    """
+    Returns the list of the annotated images, with their size and bounding boxes.
+    The image sizes are read from the file headers. If cache_path is given, the parsed annotations and image sizes are saved to it,
+    and the next calls only parse again the annotation files and read again the images that changed (modification time or size).
+    """
+    cache = load_cache(cache_path) if cache_path is not None else {'annotations': {}, 'images': {}}
+    new_cache = {'annotations': {}, 'images': {}}
     all_imgs = {}
 
     print('Parsing annotation files')
     for annotation_file in os.listdir(annotations_path):
+        annotation_path = annotations_path + annotation_file
+        annotation = get_cached_entry(cache['annotations'], annotation_path)
+        if annotation is None:
+            annotation = parse_annotation_file(annotation_path)
+        new_cache['annotations'][annotation_path] = annotation
+        filename = images_path + annotation['filename']
+
+        for (x1, y1, x2, y2, class_name) in annotation['boxes']:
+            class_index = frcnn_config.fruit_labels.index(class_name)
+
+            if filename not in all_imgs:
+                all_imgs[filename] = {}
+
+                image = new_cache['images'].get(filename) or get_cached_entry(cache['images'], filename)
+                if image is None:
+                    image = read_image_entry(filename)
+                new_cache['images'][filename] = image
+                all_imgs[filename]['filepath'] = filename
+                all_imgs[filename]['width'] = image['width']
+                all_imgs[filename]['height'] = image['height']
+                all_imgs[filename]['bboxes'] = []
+                # uncomment this to split the training dataset into training and validation
+                # the percentage of images that are reserved for validation can be controlled by changing the limits of randint
+                # if np.random.randint(0, 6) > 0:
+                all_imgs[filename]['imageset'] = 'train'
+                # else:
+                #     all_imgs[filename]['imageset'] = 'val'
+
+            all_imgs[filename]['bboxes'].append((int(x1), int(y1), int(x2), int(y2), class_index))
+
+    # the boxes are stored as an (n, 4) array of (x1, y1, x2, y2) coordinates and an (n,) array of class indices
+    for img_data in all_imgs.values():
+        bboxes = np.array(img_data.pop('bboxes'), dtype=int).reshape((-1, 5))
+        img_data['boxes'] = bboxes[:, :4]
+        img_data['classes'] = bboxes[:, 4]
+
+    if cache_path is not None:
+        save_cache(cache_path, new_cache)
+    return list(all_imgs.values())
+
+
+def parse_annotation_file(annotation_path):
+    with open(annotation_path, 'r') as f:
+        lines = [k.strip() for k in f.readlines()]
+    boxes = [tuple(line.strip().split(',')) for line in lines[1:]]
+    for box in boxes:
+        if len(box) != 5:
+            raise ValueError("Expected x1,y1,x2,y2,class_name in %s, found %s" % (annotation_path, ','.join(box)))
+    stat = os.stat(annotation_path)
+    return {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'filename': lines[0], 'boxes': boxes}
+
+
+def read_image_entry(filename):
+    size = read_image_size(filename)
+    if size is None:
+        # unknown format, or a JPEG with EXIF data, which cv2.imread may rotate; the image is decoded to get the same size as before
+        img = cv2.imread(filename)
+        size = (img.shape[1], img.shape[0])
+    stat = os.stat(filename)
+    return {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'width': size[0], 'height': size[1]}
+
+
+def read_image_size(filename):
+    """Returns the (width, height) of a PNG or JPEG image from its header, without decoding the pixels, or None for other images"""
+    with open(filename, 'rb') as f:
+        header = f.read(24)
+        if header.startswith(b'\x89PNG\r\n\x1a\n') and header[12:16] == b'IHDR':
+            return struct.unpack('>II', header[16:24])
+        if not header.startswith(b'\xff\xd8'):
+            return None
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                return None
+            if marker[1] == 0xFF:
+                # fill byte before a marker
+                f.seek(-1, os.SEEK_CUR)
+                continue
+            if marker[1] == 0xD8 or 0xD0 <= marker[1] <= 0xD7 or marker[1] == 0x01:
+                # markers without a length
+                continue
+            segment_length = struct.unpack('>H', f.read(2))[0]
+            segment = f.read(segment_length - 2)
+            if marker[1] == 0xE1 and segment.startswith(b'Exif'):
+                return None
+            if marker[1] in JPEG_FRAME_MARKERS:
+                height, width = struct.unpack('>HH', segment[1:5])
+                return width, height
+            if marker[1] == 0xDA:
+                # start of the compressed data, there was no frame header
+                return None
+
+
+def get_cached_entry(entries, path):
+    """Returns the cached entry of a file if the file did not change since it was cached, None otherwise"""
+    entry = entries.get(path)
+    if entry is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if stat.st_mtime_ns != entry['mtime'] or stat.st_size != entry['size']:
+        return None
+    return entry
+
+
+def load_cache(cache_path):
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+        for annotation in cache['annotations'].values():
+            annotation['boxes'] = [tuple(box) for box in annotation['boxes']]
+        return cache
+    except (OSError, ValueError, KeyError):
+        return {'annotations': {}, 'images': {}}
+
 
-        with open(annotations_path + annotation_file, 'r') as f:
-
-            lines = [k.strip() for k in f.readlines()]
-            filename = images_path + lines[0]
-            lines = lines[1:]
-            for line in lines:
-                line_split = line.strip().split(',')
-                (x1, y1, x2, y2, class_name) = line_split
-                class_index = frcnn_config.fruit_labels.index(class_name)
-
-                if filename not in all_imgs:
-                    all_imgs[filename] = {}
-
-                    img = cv2.imread(filename)
-                    (rows, cols) = img.shape[:2]
-                    all_imgs[filename]['filepath'] = filename
-                    all_imgs[filename]['width'] = cols
-                    all_imgs[filename]['height'] = rows
-                    all_imgs[filename]['bboxes'] = []
-                    # uncomment this to split the training dataset into training and validation
-                    # the percentage of images that are reserved for validation can be controlled by changing the limits of randint
-                    # if np.random.randint(0, 6) > 0:
-                    all_imgs[filename]['imageset'] = 'train'
-                    # else:
-                    #     all_imgs[filename]['imageset'] = 'val'
-
-                all_imgs[filename]['bboxes'].append({'class': class_index, 'x1': int(x1), 'x2': int(x2), 'y1': int(y1), 'y2': int(y2)})
-
-            all_data = []
-            for key in all_imgs:
-                all_data.append(all_imgs[key])
-
-    return all_data
+def save_cache(cache_path, cache):
+    # written to a temporary file first, so an interrupted run never leaves a truncated cache
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
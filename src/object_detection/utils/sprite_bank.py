@@ -0,0 +1,106 @@
+import os
+
+import cv2
+import numpy as np
+
+
+class SpriteBank:
+    """
+    Read-only view over a sprite bank built by write_sprite_bank.
+    The bank stores, for every source image, the tight crop around the fruit and its binary mask, so the dataset builders
+    do not have to decode the source image and rebuild the mask for every fruit that is placed in a generated image.
+    The pixel data is memory mapped, only the sprites that are actually used are read from the disk.
+    """
+
+    def __init__(self, bank_path):
+        with np.load(bank_path + '.npz') as index:
+            self.labels = [str(x) for x in index['labels']]
+            self.label_ranges = index['label_ranges']
+            self.shapes = index['shapes']
+            self.image_offsets = index['image_offsets']
+            self.mask_offsets = index['mask_offsets']
+        self.images = np.load(bank_path + '_images.npy', mmap_mode='r')
+        self.masks = np.load(bank_path + '_masks.npy', mmap_mode='r')
+        self.label_to_range = {label: self.label_ranges[i] for i, label in enumerate(self.labels)}
+
+    def count(self, label):
+        start, end = self.label_to_range[label]
+        return end - start
+
+    def get_sprite(self, label, index):
+        """Returns the BGR crop, the single channel mask (0/255) and the (height, width) of the source image"""
+        start, end = self.label_to_range[label]
+        sprite_id = start + index
+        crop_h, crop_w, source_h, source_w = self.shapes[sprite_id]
+        offset = self.image_offsets[sprite_id]
+        image = np.array(self.images[offset:offset + crop_h * crop_w * 3]).reshape((crop_h, crop_w, 3))
+        offset = self.mask_offsets[sprite_id]
+        packed_mask = self.masks[offset:offset + (crop_h * crop_w + 7) // 8]
+        mask = np.unpackbits(packed_mask, count=crop_h * crop_w).reshape((crop_h, crop_w)) * np.uint8(255)
+        return image, mask, (source_h, source_w)
+
+    def get_scaled_sprite(self, label, index, size):
+        """
+        Returns the crop and the 3 channel mask of a sprite scaled as if the source image was resized to (size, size) before cropping
+        """
+        image, mask, (source_h, source_w) = self.get_sprite(label, index)
+        new_w = max(1, int(round(image.shape[1] * size / source_w)))
+        new_h = max(1, int(round(image.shape[0] * size / source_h)))
+        image = cv2.resize(image, (new_w, new_h))
+        mask = cv2.resize(mask, (new_w, new_h), interpolation=cv2.INTER_NEAREST)
+        return image, cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+
+
+def write_sprite_bank(bank_path, labels_to_images, mask_fn):
+    """
+    Builds the sprite bank for the given {label: [image paths]} dictionary.
+    mask_fn receives a BGR image and returns its mask; only the first channel of the mask is kept.
+    """
+    folder = os.path.dirname(bank_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    labels = []
+    label_ranges = []
+    shapes = []
+    image_chunks = []
+    mask_chunks = []
+    image_offsets = []
+    mask_offsets = []
+    image_offset = 0
+    mask_offset = 0
+    for label, image_paths in labels_to_images.items():
+        start = len(shapes)
+        for image_path in image_paths:
+            image = cv2.imread(image_path)
+            if image is None:
+                print("Skipping unreadable image %s" % image_path)
+                continue
+            mask = mask_fn(image)[:, :, 0]
+            non_empty_cols = np.where(np.amax(mask, axis=0) > 0)[0]
+            non_empty_rows = np.where(np.amax(mask, axis=1) > 0)[0]
+            if len(non_empty_rows) == 0:
+                print("Skipping image with an empty mask %s" % image_path)
+                continue
+            top, bottom = non_empty_rows[0], non_empty_rows[-1]
+            left, right = non_empty_cols[0], non_empty_cols[-1]
+            crop = np.ascontiguousarray(image[top:bottom + 1, left:right + 1])
+            packed_mask = np.packbits(mask[top:bottom + 1, left:right + 1] > 0)
+            shapes.append((crop.shape[0], crop.shape[1], image.shape[0], image.shape[1]))
+            image_offsets.append(image_offset)
+            mask_offsets.append(mask_offset)
+            image_chunks.append(crop.reshape(-1))
+            mask_chunks.append(packed_mask)
+            image_offset += crop.size
+            mask_offset += packed_mask.size
+        labels.append(label)
+        label_ranges.append((start, len(shapes)))
+        print("Added %d sprites for label %s" % (len(shapes) - start, label))
+
+    np.save(bank_path + '_images.npy', np.concatenate(image_chunks) if image_chunks else np.zeros(0, dtype=np.uint8))
+    np.save(bank_path + '_masks.npy', np.concatenate(mask_chunks) if mask_chunks else np.zeros(0, dtype=np.uint8))
+    np.savez(bank_path + '.npz',
+             labels=np.array(labels),
+             label_ranges=np.array(label_ranges, dtype=np.int64).reshape((-1, 2)),
+             shapes=np.array(shapes, dtype=np.int64).reshape((-1, 4)),
+             image_offsets=np.array(image_offsets, dtype=np.int64),
+             mask_offsets=np.array(mask_offsets, dtype=np.int64))
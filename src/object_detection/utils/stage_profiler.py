@@ -0,0 +1,98 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StageProfiler:
+    """
+    Records the wall time and the number of calls of the stages of the dataset generation, and the value of event counters.
+    The profiler can be used by several threads (e.g. the writer threads). When it is not enabled, stage and count do nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.pid = os.getpid()
+        self.stages = {}  # stage name -> [calls, total seconds]
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            record = self.stages.setdefault(name, [0, 0.0])
+            record[0] += calls
+            record[1] += seconds
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        for name, (calls, seconds) in other.stages.items():
+            self.add_time(name, seconds, calls)
+        with self.lock:
+            for name, value in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def pop(self):
+        """Returns a copy of the recorded data and clears it, so the profiler can be reused for the next chunk of work"""
+        snapshot = StageProfiler(self.enabled)
+        snapshot.pid = self.pid
+        with self.lock:
+            snapshot.stages, self.stages = self.stages, {}
+            snapshot.counters, self.counters = self.counters, {}
+        return snapshot
+
+    def to_dict(self):
+        return {'stages': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in self.stages.items()},
+                'counters': dict(self.counters)}
+
+    def __getstate__(self):
+        # the lock cannot be pickled, the profilers are sent from the worker processes to the main process
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def format_profile_summary(profiler, elapsed, images):
+    """Returns a table with the time spent in each stage, followed by the counters and the throughput"""
+    total_seconds = sum(seconds for _, seconds in profiler.stages.values())
+    lines = ['%-24s %10s %12s %12s %8s' % ('Stage', 'Calls', 'Total (s)', 'Mean (ms)', 'Share')]
+    for name, (calls, seconds) in sorted(profiler.stages.items(), key=lambda item: -item[1][1]):
+        lines.append('%-24s %10d %12.2f %12.3f %7.1f%%' % (name, calls, seconds, 1000 * seconds / max(calls, 1), 100 * seconds / max(total_seconds, 1e-9)))
+    for name, value in sorted(profiler.counters.items()):
+        lines.append('%-24s %10d' % (name, value))
+    lines.append('%d images in %.2f s (%.2f images/s)' % (images, elapsed, images / max(elapsed, 1e-9)))
+    return '\n'.join(lines)
+
+
+def save_profile(file_path, worker_profilers, elapsed, images):
+    """Saves the merged profile and the profile of each worker process as JSON"""
+    merged = StageProfiler()
+    for profiler in worker_profilers.values():
+        merged.merge(profiler)
+    data = merged.to_dict()
+    data['elapsed'] = elapsed
+    data['images'] = images
+    data['images_per_second'] = images / max(elapsed, 1e-9)
+    data['workers'] = {str(pid): profiler.to_dict() for pid, profiler in worker_profilers.items()}
+    with open(file_path, mode='w') as f:
+        json.dump(data, f, indent=2)
@@ -1,84 +1,99 @@
 import math
 import os
-import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import cv2
 import numpy as np
 import config
 import random
-from PIL import Image, ImageEnhance, ImageDraw, ImageMath, ImageFilter
+from sprite_bank import SpriteBank
+from PIL import Image, ImageEnhance
 
 
-def build_dataset(thread_id, total_threads, limit, mutex, is_binary_mask=True):
-    bkg_image_paths = [config.background_folder + x for x in os.listdir(config.background_folder)]
+def build_dataset(indices, seed=None, is_binary_mask=True):
+    # sorted so that a background index means the same file in every worker
+    bkg_image_paths = sorted(config.background_folder + x for x in os.listdir(config.background_folder))
     labels_to_images = {}
 
-    mutex.acquire()
-    try:
-        if not os.path.exists(config.image_folder):
-            os.makedirs(config.image_folder)
-        if not os.path.exists(config.mask_folder):
-            os.makedirs(config.mask_folder)
-    finally:
-        mutex.release()
-
-    for i in range(1, len(config.fruit_labels)):
-        label = config.fruit_labels[i]
-        img_paths = [config.dataset_train_folder + label + '/' + x for x in os.listdir(config.dataset_train_folder + label)]
-        labels_to_images[label] = img_paths
-
-    for index in range(limit):
-        img_count = index * total_threads + thread_id
-        canvas = Image.open(bkg_image_paths[random.randint(0, len(bkg_image_paths) - 1)]).resize(config.img_size[:-1]).convert('RGB')
-        canvas = enhance_image(canvas)
+    sprite_bank = None
+    if config.use_sprite_bank:
+        sprite_bank = SpriteBank(config.sprite_bank_path)
+    else:
+        for i in range(1, len(config.fruit_labels)):
+            label = config.fruit_labels[i]
+            img_paths = sorted(config.dataset_train_folder + label + '/' + x for x in os.listdir(config.dataset_train_folder + label))
+            labels_to_images[label] = img_paths
+
+    for img_count in indices:
+        rng = get_image_rng(seed, img_count)
+        canvas = Image.open(bkg_image_paths[rng.randint(0, len(bkg_image_paths) - 1)]).resize(config.img_size[:-1]).convert('RGB')
+        canvas = enhance_image(canvas, rng=rng)
         canvas = np.array(canvas)
-        mask_canvas = np.array(Image.new(mode='RGB', size=config.img_size[:-1], color=(0, 0, 0)))
+        mask_canvas = np.zeros((config.img_size[1], config.img_size[0], 3), dtype=np.uint8)
         other_images = []
-        fruits_in_image = random.randint(3, 6)
+        fruits_in_image = rng.randint(3, 6)
         for i in range(fruits_in_image):
-            fruit_label_index = random.randint(1, len(config.fruit_labels) - 1)
+            fruit_label_index = rng.randint(1, len(config.fruit_labels) - 1)
             fruit_label = config.fruit_labels[fruit_label_index]
-            fruit_image_path = labels_to_images[fruit_label][random.randint(0, len(labels_to_images[fruit_label]) - 1)]
-            fruit_img_size = random.randint(config.min_fruit_size, config.max_fruit_size)
-            rotate_angle = random.randint(0, 3) * 90
-            fruit_image = Image.open(fruit_image_path).resize((fruit_img_size, fruit_img_size)).rotate(rotate_angle)
-            fruit_mask = build_mask(fruit_image)
+            if sprite_bank is not None:
+                fruit_source_index = rng.randint(0, sprite_bank.count(fruit_label) - 1)
+            else:
+                fruit_image_path = labels_to_images[fruit_label][rng.randint(0, len(labels_to_images[fruit_label]) - 1)]
+            fruit_img_size = rng.randint(config.min_fruit_size, config.max_fruit_size)
+            rotate_angle = rng.randint(0, 3) * 90
+            if sprite_bank is not None:
+                # the crops are not square, expand keeps the whole crop when it is rotated by 90 or 270 degrees
+                fruit_image = sprite_bank.get_scaled_sprite(fruit_label, fruit_source_index, fruit_img_size).rotate(rotate_angle, expand=True)
+                fruit_mask = build_sprite_mask(fruit_image)
+            else:
+                fruit_image = Image.open(fruit_image_path).resize((fruit_img_size, fruit_img_size)).rotate(rotate_angle)
+                fruit_mask = build_mask(fruit_image)
             if not is_binary_mask:
                 fruit_mask = color_mask(fruit_mask, config.color_map[fruit_label_index])
-            fruit_image = enhance_image(fruit_image)
+            fruit_image = enhance_image(fruit_image, rng=rng)
             fruit_image = np.array(fruit_image)
-            add_image_and_mask_to_canvas(canvas, fruit_image, mask_canvas, fruit_mask, other_images)
+            add_image_and_mask_to_canvas(canvas, fruit_image, mask_canvas, fruit_mask, other_images, rng=rng)
         canvas = Image.fromarray(canvas)
         mask_canvas = Image.fromarray(mask_canvas)
         canvas.save(config.image_folder + str(img_count) + '.png')
         mask_canvas.save(config.mask_folder + str(img_count) + '.png')
-        print("Thread %d saved image %d.png" % (thread_id, img_count))
+        print("Process %d saved image %d.png" % (os.getpid(), img_count))
+    return len(indices)
 
 
-def enhance_image(canvas, sharpness=True, contrast=True, color=True, brightness=True):
+def get_image_rng(seed, img_count):
+    # every image gets its own generator derived from its index, so the generated dataset
+    # does not depend on the number of workers or on the order in which the indices are processed
+    if seed is None:
+        return random.Random()
+    return random.Random('%s:%d' % (seed, img_count))
+
+
+def enhance_image(canvas, sharpness=True, contrast=True, color=True, brightness=True, rng=random):
     if sharpness:
         sharpness_enhancer = ImageEnhance.Sharpness(canvas)
-        factor = random.random() * 0.6 + 0.7
+        factor = rng.random() * 0.6 + 0.7
         canvas = sharpness_enhancer.enhance(factor=factor)
 
     if contrast:
         contrast_enhancer = ImageEnhance.Contrast(canvas)
-        factor = random.random() * 0.9 + 0.5
+        factor = rng.random() * 0.9 + 0.5
         canvas = contrast_enhancer.enhance(factor=factor)
 
     if color:
         color_enhancer = ImageEnhance.Color(canvas)
-        factor = random.random() * 0.6 + 0.7
+        factor = rng.random() * 0.6 + 0.7
         canvas = color_enhancer.enhance(factor=factor)
 
     if brightness:
         brightness_enhancer = ImageEnhance.Brightness(canvas)
-        factor = random.random() * 0.6 + 0.7
+        factor = rng.random() * 0.6 + 0.7
         canvas = brightness_enhancer.enhance(factor=factor)
     return canvas
 
 
 # TODO: add partial occlusion
-def add_image_and_mask_to_canvas(canvas, fruit_image, canvas_mask, fruit_mask, other_images):
+def add_image_and_mask_to_canvas(canvas, fruit_image, canvas_mask, fruit_mask, other_images, rng=random):
     # bounds inside of which the fruit image can be added to the canvas
     # the fruit image could be partially outside of the canvas, to emulate the case where only part of the fruit is visible in an image
     max_x = canvas.shape[0] - fruit_image.shape[0] // 2
@@ -90,22 +105,31 @@ def add_image_and_mask_to_canvas(canvas, fruit_image, canvas_mask, fruit_mask, o
     while not done and attempts > 0:
         # attempt to find a free area on the canvas to add the image
         # if no free space is found, the image is not added
-        x = random.randint(-fruit_image.shape[0] // 2, max_x)
-        y = random.randint(-fruit_image.shape[1] // 2, max_y)
+        x = rng.randint(-fruit_image.shape[0] // 2, max_x)
+        y = rng.randint(-fruit_image.shape[1] // 2, max_y)
         done = not is_overlap_between_new_image_and_old_images(((x, y), (x, y + fruit_image.shape[1]), (x + fruit_image.shape[0], y), (x + fruit_image.shape[0], y + fruit_image.shape[1])),
                                                                other_images)
         attempts -= 1
     if done:
-        for i in range(fruit_image.shape[0]):
-            for j in range(fruit_image.shape[1]):
-                if 0 <= x + i < canvas.shape[0] and 0 <= y + j < canvas.shape[1]:
-                    if (fruit_mask[i][j] == 255).all():
-                        canvas[x + i][y + j] = fruit_image[i][j]
-                        canvas_mask[x + i][y + j] = fruit_mask[i][j]
+        add_image_to_canvas(canvas, fruit_image, canvas_mask, fruit_mask, x, y)
         other_images.append(((x, y), (x, y + fruit_image.shape[1]), (x + fruit_image.shape[0], y), (x + fruit_image.shape[0], y + fruit_image.shape[1])))
     return done
 
 
+def add_image_to_canvas(canvas, fruit_image, canvas_mask, fruit_mask, x, y):
+    # only the part of the fruit image that is inside the canvas is copied
+    top, left = max(x, 0), max(y, 0)
+    bottom = min(x + fruit_image.shape[0], canvas.shape[0])
+    right = min(y + fruit_image.shape[1], canvas.shape[1])
+    if top >= bottom or left >= right:
+        return
+    fruit_region = (slice(top - x, bottom - x), slice(left - y, right - y))
+    # the fruit pixels are the non-black pixels of the mask, whether the mask is binary or colored
+    fruit_pixels = np.any(fruit_mask[fruit_region] > 0, axis=2)
+    canvas[top:bottom, left:right][fruit_pixels] = fruit_image[fruit_region][fruit_pixels]
+    canvas_mask[top:bottom, left:right][fruit_pixels] = fruit_mask[fruit_region][fruit_pixels]
+
+
 def is_overlap_between_new_image_and_old_images(img_coordinates, other_images):
     for old_img_coords in other_images:
         if is_src_img_inside_dest_img(img_coordinates, old_img_coords) or is_src_img_inside_dest_img(old_img_coords, img_coordinates):
@@ -148,40 +172,44 @@ def is_src_img_inside_dest_img(src_img_coordinates, dest_img_coordinates):
 
 
 def build_mask(fruit_image, threshold=config.mask_threshold):
-    fn = lambda x: 0 if x > threshold else 255
-    inv_fn = lambda x: 0 if x == 255 else 255
-    img = fruit_image.convert('L').point(fn, mode='1')
-    img_copy = img.copy()
-    x, y = fruit_image.size
-    ImageDraw.floodfill(img_copy, xy=(0, 0), value=255)
-    ImageDraw.floodfill(img_copy, xy=(x - 1, 0), value=255)
-    ImageDraw.floodfill(img_copy, xy=(0, y - 1), value=255)
-    ImageDraw.floodfill(img_copy, xy=(x - 1, y - 1), value=255)
-    img_copy = img_copy.point(inv_fn, mode='1')
-    img = ImageMath.eval("a | b", a=img, b=img_copy)
-    img = img.convert('RGB')
-    img = img.filter(ImageFilter.MinFilter(3))
-    return np.array(img)
+    # the fruit is darker than the white background of the source images
+    img = np.where(np.array(fruit_image.convert('L')) > threshold, 0, 255).astype(np.uint8)
+    # flood the background from the corners, what is left unflooded are the holes inside the fruit
+    img_flood_fill = img.copy()
+    h, w = img.shape
+    for corner in ((0, 0), (w - 1, 0), (0, h - 1), (w - 1, h - 1)):
+        if img_flood_fill[corner[1], corner[0]] == 0:
+            cv2.floodFill(img_flood_fill, None, corner, 255)
+    img = img | cv2.bitwise_not(img_flood_fill)
+    img = cv2.erode(img, np.ones((3, 3), np.uint8))
+    return np.repeat(img[:, :, np.newaxis], 3, axis=2)
+
+
+def build_sprite_mask(fruit_image):
+    # the mask is built after the resize, like for the source images; the tight crop is surrounded by a white border first,
+    # so the background is flooded from the corners and the edges of the fruit are eroded as in the uncropped image
+    padded_image = Image.new('RGB', (fruit_image.width + 2, fruit_image.height + 2), (255, 255, 255))
+    padded_image.paste(fruit_image, (1, 1))
+    return np.ascontiguousarray(build_mask(padded_image)[1:-1, 1:-1])
 
 
 def color_mask(fruit_mask, fruit_mask_color):
-    for i in range(fruit_mask.shape[0]):
-        for j in range(fruit_mask.shape[1]):
-            if (fruit_mask[i][j] == 255).all():
-                fruit_mask[i][j] = fruit_mask_color
+    fruit_mask[np.all(fruit_mask == 255, axis=2)] = fruit_mask_color
     return fruit_mask
 
 
 if __name__ == "__main__":
-    thrd_list = []
-    mutex = threading.Lock()
+    if not os.path.exists(config.image_folder):
+        os.makedirs(config.image_folder)
+    if not os.path.exists(config.mask_folder):
+        os.makedirs(config.mask_folder)
     image_limit = config.dataset_generation_limit
-    max_images_per_thread = int(math.ceil(image_limit / config.total_threads))
-    for index in range(config.total_threads):
-        thread = threading.Thread(target=build_dataset, args=(index, config.total_threads, min(max_images_per_thread, image_limit), mutex))
-        image_limit -= max_images_per_thread
-        thrd_list.append(thread)
-        thread.start()
-
-    for thrd in thrd_list:
-        thrd.join()
+    # split the indices in several small chunks per worker, so a slow worker does not delay the whole run
+    chunk_size = max(1, int(math.ceil(image_limit / (config.total_workers * 4))))
+    with ProcessPoolExecutor(max_workers=config.total_workers) as executor:
+        futures = [executor.submit(build_dataset, range(start, min(start + chunk_size, image_limit)), seed=config.generation_seed)
+                   for start in range(0, image_limit, chunk_size)]
+        completed_images = 0
+        for future in as_completed(futures):
+            completed_images += future.result()
+            print("Generated %d/%d images" % (completed_images, image_limit))
@@ -0,0 +1,21 @@
+import argparse
+import os
+
+import config
+from build_dataset import build_mask
+from sprite_bank import write_sprite_bank
+
+
+# builds the sprite bank used by build_dataset.py when use_sprite_bank is enabled
+# the default arguments use the labels, the source folder and the mask threshold from config.py
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Precompute the tight crop of every source fruit image')
+    parser.add_argument('--source_folder', default=config.dataset_train_folder)
+    parser.add_argument('--output', default=config.sprite_bank_path)
+    parser.add_argument('--mask_threshold', type=int, default=config.mask_threshold)
+    args = parser.parse_args()
+
+    labels_to_images = {}
+    for label in config.fruit_labels[1:]:
+        labels_to_images[label] = sorted(args.source_folder + label + '/' + x for x in os.listdir(args.source_folder + label))
+    write_sprite_bank(args.output, labels_to_images, lambda image: build_mask(image, threshold=args.mask_threshold))
@@ -8,9 +8,17 @@ train_folder = '../../Dataset/Train/'
 image_folder = train_folder + 'images/'
 mask_folder = train_folder + 'masks/'
 test_folder = '../../Dataset/Test/'
+# images and masks used to compute the IoU of the model, e.g. generated by build_dataset.py in a separate folder
+evaluation_folder = '../../Dataset/Evaluation/'
+evaluation_image_folder = evaluation_folder + 'images/'
+evaluation_mask_folder = evaluation_folder + 'masks/'
 output_folder = '../../Dataset/Output/'
 models_folder = 'models/'
 unet_weights = models_folder + 'unet.h5'
+# folder where the training generator stores the resized images and masks in memory-mapped files, so they are decoded only once
+# e.g. '../../Dataset/Cache/'; the first training run writes a uint8 copy of the dataset there, None - read the images on every batch
+# the cache is rebuilt when the images or img_size change, and the copies of the previous versions of the dataset are deleted
+generator_cache_folder = None
 
 labels_file = 'labels.txt'
 with open(labels_file, mode='r') as f:
@@ -20,6 +28,25 @@ fruit_labels = ['Background'] + fruit_labels
 
 batch_size = 5
 epochs = 20
+# train with the class index of each pixel as target instead of one-hot targets, the losses expand it on the device
+# the target batches are num_classes * 4 times smaller than the float32 one-hot targets
+sparse_targets = False
+# input pipeline of the UNet trainer:
+# 'sequence' - CustomDataGenerator, the batches are read in the training loop
+# 'tf.data' - the images are read and resized by parallel calls and the next batches are prefetched while the model trains; the batches are the same
+input_pipeline = 'sequence'
+shuffle_train_images = False
+# print how long the training loop waited for the input pipeline in each epoch (logged as input_stall);
+# the batches go through a Python generator to be timed, set it to False to give the generator or the tf.data dataset directly to Keras
+measure_input_stall = True
+# cache of the tf.data pipeline: None - read the images on every epoch, '' - keep the decoded images in memory, or the path of a cache file
+pipeline_cache = None
+# with a pipeline cache, the decoded images are shuffled in a buffer of this size
+pipeline_shuffle_buffer_size = 64
+# large images are segmented in img_size tiles that overlap by tile_overlap pixels, the predictions are blended in the overlaps
+# the tiles are predicted in batches of inference_batch_size
+tile_overlap = 32
+inference_batch_size = 8
 img_size = (256, 256, 3)  # height, width, channels
 
 ####################################################################
@@ -46,12 +73,19 @@ min_fruit_size = 20
 max_fruit_size = 150
 
 mask_threshold = 246  # threshold used for generating masks
+# use the precomputed fruit crops from a sprite bank instead of decoding the source images; the masks are still built by build_mask after the resize
+# build the bank first with "python build_sprite_bank.py" (from src/segmentation), it reads the images of dataset_train_folder
+use_sprite_bank = False
+sprite_bank_path = '../../Dataset/SpriteBank/segmentation'
 # number of images to generate in the segmentation dataset
 # for each generated image, the corresponding mask is also generated
 # so the total number of generated images is 2 * dataset_generation_limit
 dataset_generation_limit = 5
-# number of threads that build the dataset
-# the load is balanced among the threads
-total_threads = 1
+# number of processes that build the dataset
+# the load is balanced among the processes
+total_workers = 4
+# seed used to derive the random generator of each image from its index
+# the same seed and index always produce the same image, regardless of the number of workers; set it to None to generate a different dataset on each run
+generation_seed = 0
 
 ####################################################################
@@ -5,12 +5,13 @@ import os
 from PIL import Image
 from tensorflow.python.keras.utils import Sequence
 
+import dataset_cache
 import util
 
 
 class CustomDataGenerator(Sequence):
 
-    def __init__(self, images_path, masks_path, batch_size=5, image_dimensions=(128, 128, 3), shuffle=False, augment=False):
+    def __init__(self, images_path, masks_path, batch_size=5, image_dimensions=(128, 128, 3), shuffle=False, augment=False, cache_folder=None, sparse_targets=False):
         self.masks_paths = self.build_image_paths(masks_path)  # array of mask paths
         self.images_paths = self.build_image_paths(images_path)  # array of mask paths
         self.indexes = np.arange(len(self.images_paths))
@@ -18,6 +19,14 @@ class CustomDataGenerator(Sequence):
         self.batch_size = batch_size  # batch size
         self.shuffle = shuffle  # shuffle bool
         self.augment = augment  # augment data bool
+        # return the class index of each pixel (uint8) instead of one-hot float32 targets, as (batch, height, width, 1) arrays,
+        # because Keras expects the targets to have the rank of the softmax output
+        self.sparse_targets = sparse_targets
+        # resized images and class maps of the masks, memory-mapped from the cache folder; None if the images are read on every batch
+        self.cached_images = None
+        self.cached_masks = None
+        if cache_folder is not None:
+            self.cached_images, self.cached_masks = dataset_cache.load_dataset_cache(self.images_paths, self.masks_paths, self.dim, cache_folder)
         self.on_epoch_end()
 
     def __len__(self):
@@ -34,8 +43,14 @@ class CustomDataGenerator(Sequence):
         """Generate one batch of data"""
         # selects indices of data for next batch
         indexes = self.indexes[index * self.batch_size: (index + 1) * self.batch_size]
+        if self.cached_images is not None:
+            masks = self.cached_masks[indexes]
+            return self.cached_images[indexes], masks[..., np.newaxis] if self.sparse_targets else util.expand_class_map(masks), [None]
         # select data and load images
-        masks = np.array([util.create_target_from_mask(np.array(Image.open(self.masks_paths[k]).resize(self.dim[:-1]))) for k in indexes], dtype='float32')
+        if self.sparse_targets:
+            masks = np.array([util.create_class_map_from_mask(np.array(Image.open(self.masks_paths[k]).resize(self.dim[:-1]))) for k in indexes])[..., np.newaxis]
+        else:
+            masks = np.array([util.create_target_from_mask(np.array(Image.open(self.masks_paths[k]).resize(self.dim[:-1]))) for k in indexes], dtype='float32')
         images = np.array([np.array(Image.open(self.images_paths[k]).resize(self.dim[:-1])) for k in indexes])
         # input image data / target mask / class weights
         # class weights is currently an array of None to prevent TensorFlow 2.1 to provide the following error message:
@@ -0,0 +1,62 @@
+import hashlib
+import os
+
+import numpy as np
+from PIL import Image
+
+import config
+import util
+
+
+def get_cache_key(image_paths, mask_paths, image_dimensions):
+    """The cache is rebuilt when the image dimensions, the color map or any of the source files (path, size or modification time) change"""
+    key = hashlib.sha1()
+    key.update(repr((tuple(image_dimensions), config.num_classes, sorted(config.color_map.items()))).encode('utf-8'))
+    for path in list(image_paths) + list(mask_paths):
+        stat = os.stat(path)
+        key.update(('%s:%d:%d\n' % (path, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+    return key.hexdigest()[:16]
+
+
+def load_dataset_cache(image_paths, mask_paths, image_dimensions, cache_folder):
+    """
+    Returns the resized images as a read-only (n, height, width, channels) uint8 array and the class maps of the resized masks as a
+    (n, height, width) uint8 array (see util.create_class_map_from_mask), both memory-mapped from .npy files in cache_folder.
+    The files are built on the first call and reused as long as the source images and the image dimensions do not change.
+    cache_folder holds the cache of a single dataset: when a new cache is built, the files of the previous versions are deleted.
+    """
+    key = get_cache_key(image_paths, mask_paths, image_dimensions)
+    images_file = os.path.join(cache_folder, key + '_images.npy')
+    masks_file = os.path.join(cache_folder, key + '_masks.npy')
+    if not (os.path.exists(images_file) and os.path.exists(masks_file)):
+        build_dataset_cache(image_paths, mask_paths, image_dimensions, images_file, masks_file)
+        remove_stale_caches(cache_folder, key)
+    return np.load(images_file, mmap_mode='r'), np.load(masks_file, mmap_mode='r')
+
+
+def remove_stale_caches(cache_folder, key):
+    # every version of the dataset is a full copy of the images, only the current one is kept
+    for file_name in os.listdir(cache_folder):
+        if file_name.endswith(('_images.npy', '_masks.npy')) and not file_name.startswith(key + '_'):
+            os.remove(os.path.join(cache_folder, file_name))
+
+
+def build_dataset_cache(image_paths, mask_paths, image_dimensions, images_file, masks_file):
+    if not os.path.exists(os.path.dirname(images_file)):
+        os.makedirs(os.path.dirname(images_file), exist_ok=True)
+    # the images are resized exactly like in CustomDataGenerator, PIL takes the size as (width, height)
+    size = tuple(image_dimensions[:-1])
+    shape = (len(image_paths), size[1], size[0])
+    print("Building the dataset cache for %d images in %s" % (len(image_paths), os.path.dirname(images_file)))
+    # written to temporary files first, so an interrupted build is never mistaken for a complete cache
+    images_tmp, masks_tmp = images_file + '.tmp', masks_file + '.tmp'
+    images = np.lib.format.open_memmap(images_tmp, mode='w+', dtype=np.uint8, shape=shape + (image_dimensions[-1],))
+    masks = np.lib.format.open_memmap(masks_tmp, mode='w+', dtype=np.uint8, shape=shape)
+    for k in range(len(image_paths)):
+        images[k] = np.array(Image.open(image_paths[k]).resize(size))
+        masks[k] = util.create_class_map_from_mask(np.array(Image.open(mask_paths[k]).resize(size)))
+    images.flush()
+    masks.flush()
+    del images, masks
+    os.replace(images_tmp, images_file)
+    os.replace(masks_tmp, masks_file)
@@ -0,0 +1,59 @@
+import numpy as np
+
+import config
+
+
+class ConfusionMatrix:
+    """
+    Accumulates the confusion matrix of a segmentation model over any number of batches, so a test set of any size is evaluated in constant memory.
+    matrix[i, j] is the number of pixels of class i that were predicted as class j; the pixels whose true class is not in [0, num_classes)
+    (e.g. util.UNKNOWN_CLASS, for colors that are not in the color map) are ignored.
+    """
+
+    def __init__(self, num_classes=config.num_classes):
+        self.num_classes = num_classes
+        self.matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+
+    def update(self, true_classes, predicted_classes):
+        """Adds a batch of class index maps of any shape; true_classes and predicted_classes must have the same shape"""
+        true_classes = np.asarray(true_classes).ravel()
+        predicted_classes = np.asarray(predicted_classes).ravel()
+        valid = true_classes < self.num_classes
+        # each (true, predicted) pair is mapped to a single bin, so the whole batch is counted by one bincount
+        bins = true_classes[valid].astype(np.int64) * self.num_classes + predicted_classes[valid].astype(np.int64)
+        self.matrix += np.bincount(bins, minlength=self.num_classes ** 2).reshape((self.num_classes, self.num_classes))
+
+    def class_iou(self):
+        """Returns the IoU of each class, nan for the classes that are neither in the ground truth nor in the predictions"""
+        true_positives = np.diag(self.matrix).astype(np.float64)
+        union = self.matrix.sum(axis=0) + self.matrix.sum(axis=1) - true_positives
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(union > 0, true_positives / union, np.nan)
+
+    def mean_iou(self):
+        iou = self.class_iou()
+        return float(np.nanmean(iou)) if not np.all(np.isnan(iou)) else float('nan')
+
+    def pixel_accuracy(self):
+        return float(np.trace(self.matrix) / max(self.matrix.sum(), 1))
+
+    def summary(self, labels):
+        lines = ['%-24s %8s %14s' % ('Class', 'IoU', 'Pixels')]
+        for label, iou, pixels in zip(labels, self.class_iou(), self.matrix.sum(axis=1)):
+            lines.append('%-24s %8.4f %14d' % (label, iou, pixels))
+        lines.append('Mean IoU: %.4f' % self.mean_iou())
+        lines.append('Pixel accuracy: %.4f' % self.pixel_accuracy())
+        return '\n'.join(lines)
+
+
+def evaluate(model, generator):
+    """
+    Evaluates a model that returns class index maps (network.inference_unet with output='classes') on the batches of a
+    CustomDataGenerator with sparse_targets=True; only one batch of images and predictions is in memory at a time
+    """
+    confusion_matrix = ConfusionMatrix()
+    for index in range(len(generator)):
+        images, true_classes, _ = generator[index]
+        # the sparse targets have a trailing axis of size 1
+        confusion_matrix.update(true_classes[..., 0], model.predict_on_batch(images))
+    return confusion_matrix
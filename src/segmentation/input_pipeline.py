@@ -0,0 +1,114 @@
+import math
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+from tensorflow.python.keras.callbacks import Callback
+from tensorflow.python.keras.utils.data_utils import OrderedEnqueuer
+
+import config
+import util
+
+
+def build_input_pipeline(images_path, masks_path, batch_size=5, image_dimensions=(128, 128, 3), shuffle=False, cache=None, shuffle_buffer_size=64,
+                         sparse_targets=False, seed=None):
+    """
+    Builds a tf.data pipeline that produces the same batches as CustomDataGenerator: the images and masks are read and resized with PIL
+    exactly like in the generator, but by parallel calls, and the next batches are prefetched while the model trains on the current one.
+    cache - None to read the images on every epoch, '' to keep the decoded images in memory, or the path of a cache file
+    shuffle_buffer_size - number of decoded images to shuffle from when cache is set; without a cache, the file paths are shuffled
+    Returns the dataset and the number of batches per epoch.
+    """
+    masks_paths = build_image_paths(masks_path)
+    images_paths = build_image_paths(images_path)
+    size = tuple(image_dimensions[:-1])
+    image_shape = (size[1], size[0], image_dimensions[-1])
+
+    def load_sample(image_path, mask_path):
+        image = np.array(Image.open(image_path.decode('utf-8')).resize(size))
+        class_map = util.create_class_map_from_mask(np.array(Image.open(mask_path.decode('utf-8')).resize(size)))
+        return image, class_map
+
+    def load_sample_op(image_path, mask_path):
+        image, class_map = tf.numpy_function(load_sample, [image_path, mask_path], [tf.uint8, tf.uint8])
+        image.set_shape(image_shape)
+        class_map.set_shape(image_shape[:-1])
+        return image, class_map
+
+    def build_target(images, class_maps):
+        if sparse_targets:
+            # with a trailing axis, like the targets of CustomDataGenerator
+            return images, tf.expand_dims(class_maps, -1)
+        # the pixels of UNKNOWN_CLASS are out of range for one_hot, so they are all zeros like in util.expand_class_map
+        return images, tf.one_hot(tf.cast(class_maps, tf.int32), config.num_classes, dtype=tf.float32)
+
+    dataset = tf.data.Dataset.from_tensor_slices((images_paths, masks_paths))
+    if shuffle and cache is None:
+        dataset = dataset.shuffle(len(images_paths), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.map(load_sample_op, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if cache is not None:
+        dataset = dataset.cache(cache)
+        if shuffle:
+            dataset = dataset.shuffle(shuffle_buffer_size, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    # the one-hot targets are built per batch, after the class maps went through the cache and the shuffle buffer
+    dataset = dataset.map(build_target, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+    return dataset, int(math.ceil(len(images_paths) / batch_size))
+
+
+def build_image_paths(starting_path):
+    # same order as CustomDataGenerator.build_image_paths, so the images are paired with the same masks
+    return [starting_path + x for x in os.listdir(starting_path)]
+
+
+class InputStallTimer(Callback):
+    """
+    Measures how long the training loop waits for its batches and reports it at the end of each epoch; the stall time is also added to the logs
+    as input_stall. Keras fetches the next batch inside the training step, so the wait cannot be seen from the batch callbacks:
+    the batches are instead given to fit through timed_sequence or timed_dataset, which time the fetch itself, with workers=0,
+    so Keras calls them from the training loop without adding its own prefetching.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.epoch_start = 0.0
+        self.stall = 0.0
+        self.enqueuer = None
+
+    def timed_sequence(self, sequence, max_queue_size=10):
+        """
+        Endless generator over the batches of a Sequence, loaded in a background thread like Keras does for a Sequence;
+        the time spent waiting for the next loaded batch is the stall
+        """
+        self.enqueuer = OrderedEnqueuer(sequence, use_multiprocessing=False, shuffle=False)
+        self.enqueuer.start(workers=1, max_queue_size=max_queue_size)
+        return self.timed_batches(self.enqueuer.get())
+
+    def timed_dataset(self, dataset):
+        """Endless generator over the batches of a tf.data dataset; the time spent waiting for its prefetched batches is the stall"""
+        return self.timed_batches(iter(dataset.repeat()))
+
+    def timed_batches(self, batches):
+        while True:
+            fetch_start = time.perf_counter()
+            batch = next(batches)
+            self.stall += time.perf_counter() - fetch_start
+            yield batch
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+        self.stall = 0.0
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = time.perf_counter() - self.epoch_start
+        print("\nEpoch %d: input stall %.2f s (%.1f%% of %.2f s)" % (epoch + 1, self.stall, 100 * self.stall / max(elapsed, 1e-9), elapsed))
+        if logs is not None:
+            logs['input_stall'] = self.stall
+
+    def on_train_end(self, logs=None):
+        if self.enqueuer is not None:
+            self.enqueuer.stop()
+            self.enqueuer = None
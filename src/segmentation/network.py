@@ -1,7 +1,9 @@
+import tensorflow as tf
 from keras.applications.resnet import ResNet50
 from tensorflow.python.keras import Input, Model, regularizers
 from tensorflow.python.keras.layers import Conv2D, MaxPooling2D, Dropout, Conv2DTranspose, Softmax, BatchNormalization, Lambda, Concatenate, Activation, UpSampling2D
 import config
+import util
 
 
 def unet(input_size=config.img_size, num_classes=config.num_classes):
@@ -63,3 +65,20 @@ def unet(input_size=config.img_size, num_classes=config.num_classes):
 
     return model
 
+
+
+def inference_unet(model, output='colors'):
+    """
+    Appends the post-processing of the predictions to a UNet, so it runs on the device and only the result is copied back:
+    output = 'classes' - the model returns the (height, width) uint8 class index of each pixel
+    output = 'colors' - the model returns (height, width, 3) uint8 images with the color of the class of each pixel (config.color_map),
+                        the same images as util.create_output_from_prediction
+    """
+    if output not in ('classes', 'colors'):
+        raise ValueError("Unknown output %s, use 'classes' or 'colors'" % output)
+    classes = Lambda(lambda x: tf.cast(tf.argmax(x, axis=-1), tf.uint8), name='classes')(model.output)
+    if output == 'classes':
+        return Model(inputs=model.input, outputs=classes)
+    palette = util.get_palette()
+    colors = Lambda(lambda x: tf.gather(tf.constant(palette), tf.cast(x, tf.int32)), name='colors')(classes)
+    return Model(inputs=model.input, outputs=colors)
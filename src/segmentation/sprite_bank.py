@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+
+class SpriteBank:
+    """
+    Read-only view over a sprite bank built by write_sprite_bank (see build_sprite_bank.py).
+    The bank stores, for every source image, the tight RGB crop around the fruit, so build_dataset.py does not have to decode
+    the whole source image for every fruit that is placed in a generated image.
+    The pixel data is memory mapped, only the sprites that are actually used are read from the disk.
+    """
+
+    def __init__(self, bank_path):
+        with np.load(bank_path + '.npz') as index:
+            self.labels = [str(x) for x in index['labels']]
+            self.label_ranges = index['label_ranges']
+            self.shapes = index['shapes']
+            self.image_offsets = index['image_offsets']
+        self.images = np.load(bank_path + '_images.npy', mmap_mode='r')
+        self.label_to_range = {label: self.label_ranges[i] for i, label in enumerate(self.labels)}
+
+    def count(self, label):
+        start, end = self.label_to_range[label]
+        return end - start
+
+    def get_scaled_sprite(self, label, index, size):
+        """Returns the crop of a sprite as a PIL image, scaled as if the source image was resized to (size, size) before cropping"""
+        start, end = self.label_to_range[label]
+        sprite_id = start + index
+        crop_h, crop_w, source_h, source_w = self.shapes[sprite_id]
+        offset = self.image_offsets[sprite_id]
+        image = Image.fromarray(np.array(self.images[offset:offset + crop_h * crop_w * 3]).reshape((crop_h, crop_w, 3)))
+        new_w = max(1, int(round(crop_w * size / source_w)))
+        new_h = max(1, int(round(crop_h * size / source_h)))
+        return image.resize((new_w, new_h))
+
+
+def write_sprite_bank(bank_path, labels_to_images, mask_fn):
+    """
+    Builds the sprite bank for the given {label: [image paths]} dictionary.
+    mask_fn receives a PIL image and returns its mask, the sprite is the tight crop around the mask.
+    """
+    folder = os.path.dirname(bank_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    labels = []
+    label_ranges = []
+    shapes = []
+    image_chunks = []
+    image_offsets = []
+    image_offset = 0
+    for label, image_paths in labels_to_images.items():
+        start = len(shapes)
+        for image_path in image_paths:
+            image = Image.open(image_path).convert('RGB')
+            mask = mask_fn(image)[:, :, 0]
+            non_empty_cols = np.where(np.amax(mask, axis=0) > 0)[0]
+            non_empty_rows = np.where(np.amax(mask, axis=1) > 0)[0]
+            if len(non_empty_rows) == 0:
+                print("Skipping image with an empty mask %s" % image_path)
+                continue
+            top, bottom = non_empty_rows[0], non_empty_rows[-1]
+            left, right = non_empty_cols[0], non_empty_cols[-1]
+            crop = np.ascontiguousarray(np.array(image)[top:bottom + 1, left:right + 1])
+            shapes.append((crop.shape[0], crop.shape[1], image.height, image.width))
+            image_offsets.append(image_offset)
+            image_chunks.append(crop.reshape(-1))
+            image_offset += crop.size
+        labels.append(label)
+        label_ranges.append((start, len(shapes)))
+        print("Added %d sprites for label %s" % (len(shapes) - start, label))
+
+    np.save(bank_path + '_images.npy', np.concatenate(image_chunks) if image_chunks else np.zeros(0, dtype=np.uint8))
+    np.savez(bank_path + '.npz',
+             labels=np.array(labels),
+             label_ranges=np.array(label_ranges, dtype=np.int64).reshape((-1, 2)),
+             shapes=np.array(shapes, dtype=np.int64).reshape((-1, 4)),
+             image_offsets=np.array(image_offsets, dtype=np.int64))
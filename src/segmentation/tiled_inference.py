@@ -0,0 +1,70 @@
+import numpy as np
+
+import config
+
+
+class TiledSegmenter:
+    """
+    Segments images of any size with a model that takes fixed size tiles, e.g. the UNet trained on config.img_size images.
+    The image is covered with tiles that overlap by overlap pixels; the tiles are predicted in batches of batch_size, streamed so that
+    only one batch of tiles is in memory at a time, and the predictions are blended with weights that fall off linearly towards
+    the edges of each tile in the overlapping region, so the seams between the tiles are not visible.
+    """
+
+    def __init__(self, model, tile_shape=config.img_size[:2], overlap=32, batch_size=8, num_classes=config.num_classes):
+        self.model = model
+        self.tile_height, self.tile_width = tile_shape
+        if overlap >= min(self.tile_height, self.tile_width):
+            raise ValueError("The overlap (%d) must be smaller than the tile size %s" % (overlap, tuple(tile_shape)))
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.num_classes = num_classes
+        self.weights = np.outer(self.ramp(self.tile_height), self.ramp(self.tile_width)).astype(np.float32)
+
+    def ramp(self, length):
+        """Weights of the pixels of a tile along one axis: 1 in the middle, decreasing linearly over the overlap near the edges"""
+        distance_to_edge = np.minimum(np.arange(length), np.arange(length)[::-1]) + 1
+        return np.minimum(distance_to_edge, self.overlap + 1) / (self.overlap + 1)
+
+    def tile_starts(self, length, tile_length):
+        """Start positions of the tiles along one axis; the last tile is aligned to the end of the image"""
+        if length <= tile_length:
+            return [0]
+        stride = tile_length - self.overlap
+        starts = list(range(0, length - tile_length, stride))
+        starts.append(length - tile_length)
+        return starts
+
+    def tile_positions(self, height, width):
+        for y in self.tile_starts(height, self.tile_height):
+            for x in self.tile_starts(width, self.tile_width):
+                yield y, x
+
+    def predict(self, image):
+        """Returns the (height, width, num_classes) float32 class probabilities of the pixels of an (height, width, channels) image"""
+        height, width = image.shape[:2]
+        # images smaller than a tile are padded with zeros, the padding is cropped from the result
+        padded_height, padded_width = max(height, self.tile_height), max(width, self.tile_width)
+        if (padded_height, padded_width) != (height, width):
+            padded = np.zeros((padded_height, padded_width) + image.shape[2:], dtype=image.dtype)
+            padded[:height, :width] = image
+            image = padded
+        probabilities = np.zeros((padded_height, padded_width, self.num_classes), dtype=np.float32)
+        weight_sum = np.zeros((padded_height, padded_width, 1), dtype=np.float32)
+        batch_positions = []
+        for position in self.tile_positions(padded_height, padded_width):
+            batch_positions.append(position)
+            if len(batch_positions) == self.batch_size:
+                self.predict_batch(image, batch_positions, probabilities, weight_sum)
+                batch_positions = []
+        if len(batch_positions) > 0:
+            self.predict_batch(image, batch_positions, probabilities, weight_sum)
+        probabilities /= weight_sum
+        return probabilities[:height, :width]
+
+    def predict_batch(self, image, positions, probabilities, weight_sum):
+        tiles = np.stack([image[y:y + self.tile_height, x:x + self.tile_width] for y, x in positions])
+        predictions = np.asarray(self.model.predict_on_batch(tiles), dtype=np.float32)
+        for (y, x), prediction in zip(positions, predictions):
+            probabilities[y:y + self.tile_height, x:x + self.tile_width] += prediction * self.weights[:, :, np.newaxis]
+            weight_sum[y:y + self.tile_height, x:x + self.tile_width, 0] += self.weights
@@ -7,14 +7,24 @@ from tensorflow.python.keras.optimizers import Adadelta, SGD
 from keras_preprocessing.image import ImageDataGenerator
 
 import network
+import tiled_inference
 import config
 import custom_generator
+import evaluation
+import input_pipeline
 import util
 import numpy as np
 
 
 def train(load_weights=False):
-    gen = custom_generator.CustomDataGenerator(images_path=config.image_folder, masks_path=config.mask_folder, batch_size=config.batch_size, image_dimensions=config.img_size)
+    if config.input_pipeline == 'tf.data':
+        gen, steps = input_pipeline.build_input_pipeline(images_path=config.image_folder, masks_path=config.mask_folder, batch_size=config.batch_size,
+                                                         image_dimensions=config.img_size, shuffle=config.shuffle_train_images, cache=config.pipeline_cache,
+                                                         shuffle_buffer_size=config.pipeline_shuffle_buffer_size, sparse_targets=config.sparse_targets)
+    else:
+        gen = custom_generator.CustomDataGenerator(images_path=config.image_folder, masks_path=config.mask_folder, batch_size=config.batch_size, image_dimensions=config.img_size,
+                                                 shuffle=config.shuffle_train_images, cache_folder=config.generator_cache_folder, sparse_targets=config.sparse_targets)
+        steps = len(gen)
     model = network.unet(input_size=config.img_size)
     if load_weights:
         if os.path.exists(config.unet_weights):
@@ -26,10 +36,23 @@ def train(load_weights=False):
     optimizer = Adadelta(lr=0.1)
     # model.compile(optimizer=optimizer, loss='categorical_crossentropy', metrics=['accuracy'])
     # experimental_run_tf_function set to false to avoid an error caused by the way tversky_loss is defined
-    model.compile(optimizer=optimizer, loss=util.dice_coef_multilabel, metrics=[util.tversky_loss, 'accuracy'], experimental_run_tf_function=False)
+    # with custom losses, 'accuracy' is resolved to categorical_accuracy, which does not work with the class index targets
+    if config.sparse_targets:
+        loss, tversky_loss, accuracy = util.sparse_dice_coef_multilabel, util.sparse_tversky_loss, 'sparse_categorical_accuracy'
+    else:
+        loss, tversky_loss, accuracy = util.dice_coef_multilabel, util.tversky_loss, 'accuracy'
+    model.compile(optimizer=optimizer, loss=loss, metrics=[tversky_loss, accuracy], experimental_run_tf_function=False)
     model_checkpoint = ModelCheckpoint(config.unet_weights, monitor='loss', mode='min', save_best_only=True, verbose=1)
     learning_rate_reduction = ReduceLROnPlateau(monitor='loss', factor=0.5, patience=3, mode='min', verbose=1)
-    model.fit(gen, steps_per_epoch=len(gen), epochs=config.epochs, callbacks=[model_checkpoint, learning_rate_reduction], verbose=1)
+    callbacks = [model_checkpoint, learning_rate_reduction]
+    if config.measure_input_stall:
+        stall_timer = input_pipeline.InputStallTimer()
+        callbacks.append(stall_timer)
+        # the timer loads the batches itself, so Keras must call it from the training loop (workers=0)
+        batches = stall_timer.timed_dataset(gen) if config.input_pipeline == 'tf.data' else stall_timer.timed_sequence(gen)
+        model.fit(batches, steps_per_epoch=steps, epochs=config.epochs, callbacks=callbacks, verbose=1, workers=0)
+    else:
+        model.fit(gen, steps_per_epoch=steps, epochs=config.epochs, callbacks=callbacks, verbose=1)
 
 
 def test():
@@ -44,41 +67,42 @@ def test():
     test_gen = testGen.flow_from_directory(config.test_folder, target_size=config.img_size[:-1], class_mode='sparse',
                                            batch_size=config.batch_size, shuffle=False, subset=None)
 
-    y = model.predict_generator(test_gen, steps=int(math.ceil(test_gen.n / config.batch_size)), verbose=1)
+    # the model returns the colored uint8 masks, the argmax and the color lookup run on the device
+    color_model = network.inference_unet(model, output='colors')
+    y = color_model.predict_generator(test_gen, steps=int(math.ceil(test_gen.n / config.batch_size)), verbose=1)
     i = 0
     for item in y:
-        img = util.create_output_from_prediction(item)
-        img = Image.fromarray(img)
+        img = Image.fromarray(item)
         img.save(config.output_folder + str(i) + '.png')
         i += 1
 
 
-def test2():
-    img = Image.open(config.test_folder + "6.png")
-    w, h = img.size
-    target_w = round(w / config.img_size[0]) * config.img_size[0]
-    target_h = round(h / config.img_size[1]) * config.img_size[1]
-    img = np.array(img.resize(size=(target_w, target_h)))
-    patches = []
-    for i in range(target_h // config.img_size[0]):
-        for j in range(target_w // config.img_size[1]):
-            patches.append(img[(i * 256):((i + 1) * 256), (j * 256):((j + 1) * 256), :])
+def evaluate():
+    model = network.unet(input_size=config.img_size)
+    if os.path.exists(config.unet_weights):
+        model.load_weights(config.unet_weights)
+    else:
+        print("Warning! Weights file not present.")
+    gen = custom_generator.CustomDataGenerator(images_path=config.evaluation_image_folder, masks_path=config.evaluation_mask_folder, batch_size=config.batch_size,
+                                             image_dimensions=config.img_size, sparse_targets=True)
+    confusion_matrix = evaluation.evaluate(network.inference_unet(model, output='classes'), gen)
+    labels = ['Background', 'Fruit'] if config.is_binary_classification_task else config.fruit_labels
+    print(confusion_matrix.summary(labels))
 
+
+def test2():
+    img = np.array(Image.open(config.test_folder + "6.png").convert('RGB'))
     model = network.unet(input_size=config.img_size)
     if os.path.exists(config.unet_weights):
         model.load_weights(config.unet_weights)
     else:
         print("Warning! Weights file not present.")
-    preds = model.predict(np.array(patches), verbose=1)
-    for i in range(target_h // config.img_size[0]):
-        for j in range(target_w // config.img_size[1]):
-            pred = preds[i*(target_w // config.img_size[1]) + j]
-            item = util.create_output_from_prediction(pred)
-            for x in range(config.img_size[0]):
-                for y in range(config.img_size[1]):
-                    if (item[x][y] != 0).all():
-                        img[i*config.img_size[0] + x][j*config.img_size[1] + y] = item[x][y]
-    img = Image.fromarray(img).resize(size=(w, h))
+    segmenter = tiled_inference.TiledSegmenter(model, overlap=config.tile_overlap, batch_size=config.inference_batch_size)
+    item = util.create_output_from_prediction(segmenter.predict(img))
+    # the pixels classified as fruit are painted over the image
+    fruit_pixels = np.all(item != 0, axis=-1)
+    img[fruit_pixels] = item[fruit_pixels]
+    img = Image.fromarray(img)
     img.save(config.output_folder + 'rez.png')
 
 
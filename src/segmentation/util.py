@@ -2,21 +2,47 @@ import numpy as np
 from tensorflow.python.keras import backend as K
 import config
 
+# value of the class maps for the pixels whose color is not in the color map
+UNKNOWN_CLASS = 255
+
 
 def create_target_from_mask(mask_img):
-    target_shape = mask_img.shape[:-1] + (config.num_classes,)
-    encoded_image = np.zeros(target_shape, dtype=np.int8)
-    for i in range(config.num_classes):
-        encoded_image[:, :, i] = np.all(mask_img.reshape((-1, 3)) == config.color_map[i], axis=1).reshape(target_shape[:-1])
-    return encoded_image
+    return expand_class_map(create_class_map_from_mask(mask_img), dtype=np.int8)
+
+
+def build_color_lookup():
+    """Returns the colors of the color map packed as 0xRRGGBB integers in increasing order, and the class index of each of them"""
+    packed_colors = np.array([(r << 16) | (g << 8) | b for r, g, b in (config.color_map[i] for i in range(config.num_classes))], dtype=np.uint32)
+    order = np.argsort(packed_colors)
+    return packed_colors[order], order.astype(np.uint8)
+
+
+def create_class_map_from_mask(mask_img):
+    """Returns the class index of each pixel of the mask, or UNKNOWN_CLASS for the pixels whose color is not in the color map"""
+    packed_colors, color_classes = COLOR_LOOKUP
+    mask_img = mask_img[..., :3].astype(np.uint32)
+    packed = (mask_img[..., 0] << 16) | (mask_img[..., 1] << 8) | mask_img[..., 2]
+    # all the pixels are looked up in the sorted packed colors in a single pass, instead of comparing the mask with each color
+    positions = np.minimum(np.searchsorted(packed_colors, packed), len(packed_colors) - 1)
+    return np.where(packed_colors[positions] == packed, color_classes[positions], np.uint8(UNKNOWN_CLASS))
+
+
+def expand_class_map(class_map, dtype='float32'):
+    """One-hot encodes class maps on the last axis, the pixels of UNKNOWN_CLASS are all zeros"""
+    return (class_map[..., np.newaxis] == np.arange(config.num_classes, dtype=np.uint8)).astype(dtype)
+
+
+# sorted packed colors of the color map and their class indices, see build_color_lookup
+COLOR_LOOKUP = build_color_lookup()
+
+
+def get_palette():
+    """Returns the colors of the classes as a (num_classes, 3) uint8 array"""
+    return np.array([config.color_map[k] for k in range(config.num_classes)], dtype=np.uint8)
 
 
 def create_output_from_prediction(prediction):
-    single_layer = np.argmax(prediction, axis=-1)
-    output = np.zeros(prediction.shape[:2] + (3,))
-    for k in range(config.num_classes):
-        output[single_layer == k] = config.color_map[k]
-    return np.uint8(output)
+    return get_palette()[np.argmax(prediction, axis=-1)]
 
 
 def dice_coef(y_true, y_pred, index, smooth=1e-10):
@@ -37,6 +63,20 @@ def dice_coef_multilabel(y_true, y_pred):
     return dice
 
 
+def sparse_to_one_hot(y_true, y_pred):
+    """One-hot encodes the class indices of a sparse target batch on the device; the pixels of UNKNOWN_CLASS are all zeros, like in the dense targets"""
+    y_true = K.cast(K.reshape(y_true, K.shape(y_pred)[:-1]), 'int32')
+    return K.cast(K.one_hot(y_true, config.num_classes), K.dtype(y_pred))
+
+
+def sparse_dice_coef_multilabel(y_true, y_pred):
+    return dice_coef_multilabel(sparse_to_one_hot(y_true, y_pred), y_pred)
+
+
+def sparse_tversky_loss(y_true, y_pred, alpha=0.5, beta=0.5):
+    return tversky_loss(sparse_to_one_hot(y_true, y_pred), y_pred, alpha, beta)
+
+
 def tversky_loss(y_true, y_pred, alpha=0.5, beta=0.5):
     ones = K.ones(K.shape(y_true))
     p0 = y_pred  # probe that voxels are class i